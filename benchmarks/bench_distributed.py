@@ -0,0 +1,52 @@
+"""
+Scaling of distributed training with the number of local workers
+
+    python benchmarks/bench_distributed.py --input input.toml --log-vars log_vars.toml \
+        --train-vars train_vars.toml --workers 1 2 4 8 --rounds 200
+"""
+import argparse
+import json
+import time
+
+from cand_class.distributed import train_distributed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--input', required=True, help='input toml, see config_reader.convertDF')
+    parser.add_argument('--log-vars', required=True)
+    parser.add_argument('--train-vars', required=True)
+    parser.add_argument('--mass-var', default='mass')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--rounds', type=int, default=100)
+    parser.add_argument('--max-depth', type=int, default=6)
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    parser.add_argument('--output', default='bench_distributed.json')
+    args = parser.parse_args()
+
+    model_params = {'n_estimators': args.rounds, 'max_depth': args.max_depth, 'n_jobs': args.threads_per_worker}
+
+    report = []
+    for n_workers in args.workers:
+        start = time.perf_counter()
+        booster, stats = train_distributed(args.input, args.mass_var, args.log_vars, args.train_vars,
+                                           model_params, n_workers=n_workers)
+        wall = time.perf_counter() - start
+        train_time = max(res['train_time'] for res in stats)
+        report.append({'workers': n_workers, 'wall_time': wall, 'train_time': train_time,
+                       'load_time': max(res['load_time'] for res in stats),
+                       'rows': sum(res['rows'] for res in stats), 'trees': booster.num_boosted_rounds()})
+
+    base = report[0]['train_time'] * report[0]['workers']
+    print('%8s %10s %10s %10s %8s' % ('workers', 'rows', 'train [s]', 'wall [s]', 'speedup'))
+    for res in report:
+        res['speedup'] = base / res['train_time']
+        print('%8d %10d %10.2f %10.2f %8.2f' % (res['workers'], res['rows'], res['train_time'],
+                                               res['wall_time'], res['speedup']))
+
+    with open(args.output, 'w', encoding="utf-8") as out_file:
+        json.dump(report, out_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
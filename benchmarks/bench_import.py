@@ -0,0 +1,78 @@
+"""
+Import time and heavy dependencies of the cand_class core modules
+
+    python benchmarks/bench_import.py --repeat 5 --max-seconds 1.0 --output import_report.json
+
+Every module is imported in a fresh interpreter (python -X importtime) --repeat
+times, the median self+cumulative time of the module is reported together with
+the heavy packages it pulled in. The benchmark fails if a core module imports one
+of the --forbidden packages or takes longer than --max-seconds, so regressions of
+the lazy imports (see cand_class.lazy) are caught.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+
+import numpy as np
+
+CORE_MODULES = ['cand_class.features', 'cand_class.model_io', 'cand_class.tree_eval', 'cand_class.backends',
+                'cand_class.scoring', 'cand_class.loader', 'cand_class.bootstrap', 'cand_class.config_reader',
+                'cand_class.helper', 'cand_class.service', 'cand_class.binned_training']
+FORBIDDEN = ['matplotlib', 'xgboost', 'sklearn', 'scipy', 'hipe4ml', 'treelite', 'ROOT']
+
+_PROBE = ('import sys, {module}; '
+          'print(",".join(name for name in {forbidden!r} if name in sys.modules))')
+
+
+def import_time(module, forbidden):
+    """
+    Cumulative import time in seconds of module in a fresh interpreter and
+    the forbidden packages it loaded
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           _PROBE.format(module=module, forbidden=forbidden)],
+                          capture_output=True, text=True, check=True)
+    cumulative = None
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and line.split('|')[-1].strip() == module:
+            cumulative = int(line.split('|')[1]) * 1e-6
+    loaded = [name for name in proc.stdout.strip().split(',') if name]
+    return cumulative, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modules', nargs='+', default=CORE_MODULES)
+    parser.add_argument('--forbidden', nargs='*', default=FORBIDDEN,
+                        help='packages a core module must not import')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-seconds', type=float, default=1.0, help='import time budget per module')
+    parser.add_argument('--output', default='import_report.json')
+    args = parser.parse_args()
+
+    report = {'python': platform.python_version(), 'max_seconds': args.max_seconds, 'modules': {}}
+    failed = []
+    for module in args.modules:
+        timings = []
+        for _ in range(args.repeat):
+            seconds, loaded = import_time(module, args.forbidden)
+            timings.append(seconds)
+        median = float(np.median(timings))
+        report['modules'][module] = {'seconds': median, 'min_seconds': float(min(timings)), 'heavy': loaded}
+        print('%-28s %7.3f s  %s' % (module, median, ', '.join(loaded)))
+        if loaded or median > args.max_seconds:
+            failed.append(module)
+
+    with open(args.output, 'w', encoding="utf-8") as out_file:
+        json.dump(report, out_file, indent=2)
+
+    if failed:
+        print('Import regressions in '+', '.join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
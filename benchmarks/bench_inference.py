@@ -0,0 +1,127 @@
+"""
+Latency and throughput of one trained model in every available inference backend
+
+    python benchmarks/bench_inference.py --model xgb_model.json --lib xgb_model.so \
+        --data candidates.root --tree t --threads 1 2 4 8 --output inference_report.json
+
+Scores of all backends are first checked against Booster.inplace_predict (--tolerance).
+Then single-candidate latency (p50/p99), throughput for --batch-sizes and throughput
+scaling with --threads are measured. Without --data the candidates are generated with
+cand_class.synthetic.
+"""
+import argparse
+import hashlib
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import uproot
+import xgboost as xgb
+
+from cand_class.artifact import is_artifact, read_spec
+from cand_class.backends import load_backends
+from cand_class.features import feature_matrix, required_branches
+from cand_class.model_io import booster_features, load_booster
+
+
+def load_candidates(args, features):
+    if args.data is None:
+        from cand_class.synthetic import generate_candidates
+
+        rng = np.random.default_rng(0)
+        df = pd.concat([generate_candidates(args.n_candidates // 2, True, rng),
+                        generate_candidates(args.n_candidates - args.n_candidates // 2, False, rng)],
+                       ignore_index=True)
+    else:
+        with uproot.open(args.data) as root_file:
+            df = root_file[args.tree].arrays(required_branches(features), entry_stop=args.n_candidates,
+                                             library='pd')
+    return feature_matrix(df, features)
+
+
+def latency(backend, x, n_calls):
+    timings = np.empty(n_calls)
+    for i in range(n_calls):
+        row = x[i % len(x)][None, :]
+        start = time.perf_counter()
+        backend.predict(row)
+        timings[i] = time.perf_counter() - start
+    return {'p50_us': float(np.percentile(timings, 50) * 1e6), 'p99_us': float(np.percentile(timings, 99) * 1e6)}
+
+
+def throughput(backend, x, batch_size, min_time):
+    n_batches = max(1, len(x) // batch_size)
+    done = 0
+    start = time.perf_counter()
+    while True:
+        for i in range(n_batches):
+            backend.predict(x[i*batch_size:(i+1)*batch_size])
+            done += min(batch_size, len(x))
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return done / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='trained model (.json/.ubj or pickle)')
+    parser.add_argument('--lib', default=None, help='treelite library from helper.save_model_lib')
+    parser.add_argument('--data', default=None, help='ROOT file with candidates')
+    parser.add_argument('--tree', default='t')
+    parser.add_argument('--n-candidates', type=int, default=200000)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 256, 4096, 65536])
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--latency-calls', type=int, default=2000)
+    parser.add_argument('--min-time', type=float, default=1.0, help='seconds per throughput point')
+    parser.add_argument('--tolerance', type=float, default=1e-5)
+    parser.add_argument('--output', default='inference_report.json')
+    args = parser.parse_args()
+
+    if is_artifact(args.model):
+        # content hash of the model, features, log transforms and threshold
+        model_hash = read_spec(args.model)['sha256']
+    else:
+        with open(args.model, 'rb') as inp_file:
+            model_hash = hashlib.sha256(inp_file.read()).hexdigest()
+    booster = load_booster(args.model)
+    x = load_candidates(args, booster_features(booster))
+
+    report = {'model': args.model, 'model_sha256': model_hash, 'n_candidates': len(x),
+              'n_trees': booster.num_boosted_rounds(), 'python': sys.version.split()[0],
+              'xgboost': xgb.__version__, 'machine': platform.machine(), 'backends': {}}
+
+    backends, _ = load_backends(args.model, lib_path=args.lib, nthread=1)
+    reference = backends['booster_inplace'].predict(x)
+    for name, backend in backends.items():
+        max_diff = float(np.max(np.abs(backend.predict(x) - reference)))
+        report['backends'][name] = {'max_abs_diff': max_diff, 'agrees': max_diff <= args.tolerance,
+                                    'latency': latency(backend, x, args.latency_calls),
+                                    'throughput': {}, 'thread_scaling': {}}
+        for batch_size in args.batch_sizes:
+            report['backends'][name]['throughput'][str(batch_size)] = throughput(backend, x, batch_size,
+                                                                                 args.min_time)
+        print('%-16s diff %.2e  p50 %8.1f us  p99 %8.1f us  %s' % (
+            name, max_diff, report['backends'][name]['latency']['p50_us'],
+            report['backends'][name]['latency']['p99_us'],
+            '  '.join('%s: %.3g/s' % item for item in report['backends'][name]['throughput'].items())))
+
+    for nthread in args.threads:
+        backends, _ = load_backends(args.model, lib_path=args.lib, nthread=nthread)
+        for name, backend in backends.items():
+            rate = throughput(backend, x, max(args.batch_sizes), args.min_time)
+            report['backends'][name]['thread_scaling'][str(nthread)] = rate
+            print('%-16s %3d threads  %.3g candidates/s' % (name, nthread, rate))
+
+    with open(args.output, 'w', encoding="utf-8") as out_file:
+        json.dump(report, out_file, indent=2)
+
+    if not all(res['agrees'] for res in report['backends'].values()):
+        print('Backends disagree beyond tolerance '+str(args.tolerance))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
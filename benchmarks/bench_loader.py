@@ -0,0 +1,64 @@
+"""
+Read throughput of loader.ChunkLoader for a grid of decompression threads and read-ahead depths
+
+    python benchmarks/bench_loader.py --files /storage/candidates_*.root --tree t \
+        --io-threads 1 2 4 8 --prefetch 0 1 2 4 --work-ms 20 --output loader_report.json
+
+Every configuration reads the files once and spends --work-ms of CPU per chunk as a
+stand-in for the transformation and scoring. The report holds the wall time, MB/s and
+the loader counters (bytes read, decompression and stall time); the configuration with
+the lowest stall time is the one to use on that storage system. Run it with a cold page
+cache (or on files larger than the memory) to measure the disk rather than the memory.
+"""
+import argparse
+import json
+import platform
+import time
+
+from cand_class.loader import ChunkLoader
+
+
+def busy(seconds):
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        pass
+
+
+def run(files, tree, branches, step_size, io_threads, prefetch, work):
+    loader = ChunkLoader(files, tree, branches, step_size, io_threads, prefetch)
+    start = time.perf_counter()
+    for _ in loader:
+        busy(work)
+    wall_time = time.perf_counter() - start
+    return dict(loader.stats.as_dict(), io_threads=io_threads, prefetch=prefetch, wall_time=wall_time,
+                mb_per_s=loader.stats.bytes_read / 2**20 / wall_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', nargs='+', required=True)
+    parser.add_argument('--tree', required=True)
+    parser.add_argument('--branches', nargs='*', default=None, help='all branches by default')
+    parser.add_argument('--step-size', type=int, default=100000)
+    parser.add_argument('--io-threads', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--prefetch', nargs='+', type=int, default=[0, 2])
+    parser.add_argument('--work-ms', type=float, default=0., help='CPU time spent per chunk')
+    parser.add_argument('--output', default='loader_report.json')
+    args = parser.parse_args()
+
+    report = {'python': platform.python_version(), 'files': args.files, 'work_ms': args.work_ms, 'runs': []}
+    print('%10s %8s %9s %8s %11s %9s' % ('io_threads', 'prefetch', 'wall [s]', 'MB/s', 'decomp [s]', 'stall [s]'))
+    for io_threads in args.io_threads:
+        for prefetch in args.prefetch:
+            res = run(args.files, args.tree, args.branches, args.step_size, io_threads, prefetch,
+                      args.work_ms / 1000)
+            report['runs'].append(res)
+            print('%10d %8d %9.2f %8.1f %11.2f %9.2f' % (io_threads, prefetch, res['wall_time'], res['mb_per_s'],
+                                                         res['decompress_time'], res['stall_time']))
+
+    with open(args.output, 'w', encoding="utf-8") as out_file:
+        json.dump(report, out_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
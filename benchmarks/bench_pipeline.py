@@ -0,0 +1,172 @@
+"""
+Timing and memory scaling of the data pipeline stages on synthetic samples
+
+    python benchmarks/bench_pipeline.py --sizes 1e5 1e6 1e7 --output bench_pipeline.json
+    python benchmarks/bench_pipeline.py --sizes 1e5 1e6 --baseline baseline.json --threshold 0.25
+
+Every size is generated with cand_class.synthetic (half signal, half background) and
+convertDF, transform_df_to_log, xgb_matr, AMS, ApplyXGB.hist_variables and, if PyROOT is
+available, HistBuilder.hist_variables_root are run on it with cand_class.profiling enabled.
+A discarded run of the smallest size comes first, so import and first-call costs are not timed.
+With --baseline the script exits with status 1 if any stage got slower than
+(1 + threshold) times the stored wall time for the same size.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_pdf import PdfPages
+
+from cand_class import profiling
+from cand_class.apply_model import ApplyXGB
+from cand_class.config_reader import convertDF, read_log_vars, read_train_vars
+from cand_class.helper import AMS, transform_df_to_log, xgb_matr
+from cand_class.synthetic import generate_dataset
+
+
+STAGES = ['convertDF', 'transform_df_to_log', 'xgb_matr', 'AMS', 'ApplyXGB.hist_variables',
+          'HistBuilder.hist_variables_root']
+
+
+def proxy_scores(df):
+    # cheap stand-in for a trained model, separates signal and background reasonably
+    z = 0.8*df['log(ldl)'] - 0.5*df['log(chi2geo)'] - 0.8*df['log(distance)'] - 3
+    return (1 / (1 + np.exp(-z))).to_numpy()
+
+
+def run_size(n_rows, work_dir, trace_memory):
+    paths = generate_dataset(work_dir, n_rows // 2, n_rows - n_rows // 2, seed=n_rows)
+    non_log_x, log_x = read_log_vars(paths['log_vars_toml'])
+    train_vars = read_train_vars(paths['train_vars_toml'])
+
+    profiling.reset()
+    profiling.enable(trace_memory=trace_memory)
+
+    signal, background = convertDF(paths['input_toml'], 'mass')
+    df = pd.concat([signal.get_data_frame(), background.get_data_frame()], ignore_index=True)
+    df = transform_df_to_log(df, non_log_x + log_x, non_log_x, log_x)
+
+    half = len(df) // 2
+    shuffled = df.sample(frac=1, random_state=1).reset_index(drop=True)
+    x_train, x_test = shuffled.iloc[:half], shuffled.iloc[half:]
+    y_train, y_test = x_train['issignal'].to_numpy(), x_test['issignal'].to_numpy()
+    xgb_matr(x_train, y_train, x_test, y_test, train_vars)
+
+    p_train, p_test = proxy_scores(x_train), proxy_scores(x_test)
+    thr_train, thr_test, _ = AMS(y_train, p_train, y_test, p_test, work_dir)
+
+    test_df = x_test.copy()
+    test_df['xgb_preds1'] = (p_test > thr_test).astype(int)
+    apply_xgb = ApplyXGB(x_train, x_test, p_train, p_test, y_train, y_test, work_dir)
+    apply_xgb.hist_variables('mass', test_df, 'issignal', 'xgb_preds1', 'test',
+                             PdfPages(os.path.join(work_dir, 'hists.pdf')))
+
+    # hists_root imports without PyROOT, so the check is on ROOT itself
+    if importlib.util.find_spec('ROOT') is not None:
+        from cand_class.hists_root import HistBuilder
+
+        dfs_orig = test_df[test_df['issignal'] == 1].drop(columns=['issignal', 'xgb_preds1'])
+        dfb_orig = test_df[test_df['issignal'] == 0].drop(columns=['issignal', 'xgb_preds1'])
+        cut = test_df['xgb_preds1'] == 1
+        dfs_cut = test_df[cut & (test_df['issignal'] == 1)].drop(columns=['issignal', 'xgb_preds1'])
+        dfb_cut = test_df[cut & (test_df['issignal'] == 0)].drop(columns=['issignal', 'xgb_preds1'])
+        difference_s = pd.concat([dfs_orig, dfs_cut]).drop_duplicates(keep=False)
+        HistBuilder(work_dir).hist_variables_root('mass', dfs_orig, dfb_orig, dfs_cut, dfb_cut,
+                                                  difference_s, 'test')
+
+    profiling.disable()
+    summary = profiling.summary()
+    return {stage: summary[stage] for stage in STAGES if stage in summary}
+
+
+def scaling_exponents(report):
+    """
+    Slope of log(wall time) versus log(rows) per stage, 1 means linear scaling
+    """
+    sizes = sorted(int(size) for size in report)
+    exponents = {}
+    for stage in STAGES:
+        points = [(size, report[str(size)][stage]['wall_time']) for size in sizes if stage in report[str(size)]]
+        if len(points) > 1:
+            x, y = np.log([p[0] for p in points]), np.log([max(p[1], 1e-9) for p in points])
+            exponents[stage] = float(np.polyfit(x, y, 1)[0])
+    return exponents
+
+
+def compare_to_baseline(report, baseline, threshold):
+    regressions = []
+    for size, stages in report.items():
+        for stage, res in stages.items():
+            base = baseline.get(size, {}).get(stage)
+            if base is not None and res['wall_time'] > (1 + threshold) * base['wall_time']:
+                regressions.append('%s at %s rows: %.3f s vs baseline %.3f s'
+                                   % (stage, size, res['wall_time'], base['wall_time']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=float, nargs='+', default=[1e5, 1e6])
+    parser.add_argument('--output', default='bench_pipeline.json')
+    parser.add_argument('--baseline', default=None, help='stored report to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative slow-down')
+    parser.add_argument('--trace-memory', action='store_true')
+    parser.add_argument('--work-dir', default=None, help='directory for the synthetic samples')
+    parser.add_argument('--plot', default=None, help='png file with the scaling curves')
+    args = parser.parse_args()
+
+    # discarded run of the smallest size, so lazy imports (xgboost, matplotlib) and first-call
+    # costs do not end up in the timings of the first size
+    with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+        run_size(int(min(args.sizes)), work_dir, False)
+
+    report = {}
+    for size in args.sizes:
+        n_rows = int(size)
+        with tempfile.TemporaryDirectory(dir=args.work_dir) as work_dir:
+            report[str(n_rows)] = run_size(n_rows, work_dir, args.trace_memory)
+
+        print('rows = %d' % n_rows)
+        for stage, res in report[str(n_rows)].items():
+            print('  %-34s %10.3f s  %10.3f s cpu  %8.1f MB rss' % (stage, res['wall_time'], res['cpu_time'],
+                                                                   res['peak_rss'] / 2**20))
+
+    exponents = scaling_exponents(report)
+    for stage, exponent in exponents.items():
+        print('scaling exponent %-34s %.2f' % (stage, exponent))
+
+    with open(args.output, 'w', encoding="utf-8") as out_file:
+        json.dump({'stages': report, 'scaling_exponents': exponents}, out_file, indent=2)
+
+    if args.plot is not None:
+        import matplotlib.pyplot as plt
+
+        fig, ax = plt.subplots(figsize=(8, 6))
+        for stage in STAGES:
+            points = [(int(size), res[stage]['wall_time']) for size, res in report.items() if stage in res]
+            if points:
+                ax.plot(*zip(*sorted(points)), marker='o', label=stage)
+        ax.set_xscale('log')
+        ax.set_yscale('log')
+        ax.set_xlabel('rows', fontsize=15)
+        ax.set_ylabel('wall time, s', fontsize=15)
+        ax.legend()
+        fig.tight_layout()
+        fig.savefig(args.plot)
+
+    if args.baseline is not None:
+        with open(args.baseline, encoding="utf-8") as inp_file:
+            baseline = json.load(inp_file)['stages']
+        regressions = compare_to_baseline(report, baseline, args.threshold)
+        if regressions:
+            print('Performance regressions:\n  '+'\n  '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Local load test of the micro-batching scoring service
+
+    python benchmarks/bench_service.py --model xgb_model.json --clients 1 8 32 --candidates 1 16
+    python benchmarks/bench_service.py --url http://127.0.0.1:8765 --clients 16
+    python benchmarks/bench_service.py --socket /tmp/cand_class.sock --clients 16
+
+With --model the service is started inside this process (on a free port or on --socket
+if given); otherwise an already running `cand_class serve` is used. Every client thread
+keeps one connection and sends requests of --candidates synthetic candidates back to
+back for --duration seconds. Client-side latency percentiles, throughput and the server
+counters are printed and written to --output.
+"""
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+
+from cand_class.service import ServiceClient, make_server
+from cand_class.synthetic import generate_candidates
+
+
+def client_loop(client_args, requests, duration, latencies):
+    client = ServiceClient(**client_args)
+    stop = time.perf_counter() + duration
+    i = 0
+    while time.perf_counter() < stop:
+        start = time.perf_counter()
+        client.predict(requests[i % len(requests)])
+        latencies.append(time.perf_counter() - start)
+        i += 1
+    client.close()
+
+
+def run_point(client_args, requests, n_clients, duration):
+    latencies = [[] for _ in range(n_clients)]
+    threads = [threading.Thread(target=client_loop, args=(client_args, requests, duration, latencies[i]))
+               for i in range(n_clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    latencies = np.concatenate([np.array(lat) for lat in latencies])
+    n_candidates = len(requests[0][next(iter(requests[0]))])
+    return {'requests': len(latencies), 'requests_per_s': len(latencies) / elapsed,
+            'candidates_per_s': len(latencies) * n_candidates / elapsed,
+            'p50_ms': float(np.percentile(latencies, 50) * 1e3),
+            'p99_ms': float(np.percentile(latencies, 99) * 1e3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=None, help='start the service in-process with this model')
+    parser.add_argument('--backend', default='booster_inplace')
+    parser.add_argument('--url', default=None, help='running HTTP service')
+    parser.add_argument('--socket', default=None, help='Unix socket of the service')
+    parser.add_argument('--max-batch', type=int, default=4096)
+    parser.add_argument('--max-delay-ms', type=float, default=2.0)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--candidates', type=int, nargs='+', default=[1, 32], help='candidates per request')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per point')
+    parser.add_argument('--output', default='service_report.json')
+    args = parser.parse_args()
+
+    server = None
+    if args.model is not None:
+        server = make_server(args.model, socket_path=args.socket, port=0, backend=args.backend,
+                             max_batch=args.max_batch, max_delay_ms=args.max_delay_ms)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        if args.socket is None:
+            args.url = 'http://127.0.0.1:'+str(server.server_address[1])
+    client_args = {'socket_path': args.socket} if args.socket is not None else {'url': args.url}
+
+    rng = np.random.default_rng(0)
+    report = {'backend': args.backend, 'max_batch': args.max_batch, 'max_delay_ms': args.max_delay_ms,
+              'points': []}
+    for n_candidates in args.candidates:
+        requests = []
+        for _ in range(64):
+            df = generate_candidates(n_candidates, bool(rng.integers(2)), rng)
+            requests.append({col: df[col].tolist() for col in df.columns})
+        for n_clients in args.clients:
+            point = run_point(client_args, requests, n_clients, args.duration)
+            point.update({'clients': n_clients, 'candidates_per_request': n_candidates})
+            report['points'].append(point)
+            print('%4d clients %5d cand/req  %8.0f req/s  %10.0f cand/s  p50 %7.2f ms  p99 %7.2f ms' % (
+                n_clients, n_candidates, point['requests_per_s'], point['candidates_per_s'],
+                point['p50_ms'], point['p99_ms']))
+
+    client = ServiceClient(**client_args)
+    report['server'] = client.stats()
+    client.close()
+    print('server: %d batches, mean batch size %.1f, queue depth %d' % (
+        report['server']['batches'], report['server']['mean_batch_size'], report['server']['queue_depth']))
+
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+        server.batcher.stop()
+
+    with open(args.output, 'w', encoding="utf-8") as out_file:
+        json.dump(report, out_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
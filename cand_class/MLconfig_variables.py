@@ -1,13 +1,18 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
-from scipy.stats import sem
-from scipy.stats import binned_statistic as b_s
-import matplotlib as mpl
+from cand_class.column_stats import ColumnStats
+from cand_class.lazy import lazy_import
+from cand_class.plotting import ImageLayer, binned_moments, hist2d_counts, use_headless
+from cand_class.profiling import profiled
 
-from hipe4ml import plot_utils
+# plotting dependencies are imported on first use, see cand_class.lazy
+plt = lazy_import('matplotlib.pyplot', 'plot')
+stats = lazy_import('scipy.stats', 'plot')
+plot_utils = lazy_import('hipe4ml.plot_utils', 'plot')
 
+
+@profiled(rows=lambda res, *args, **kwargs: len(args[0]) + len(args[1]))
 def correlation_matrix(bgr, sign, vars_to_draw, leg_labels, output_path):
     res_s_b = plot_utils.plot_corr([bgr, sign], vars_to_draw, leg_labels)
     res_s_b[0].savefig(output_path+'/'+'corr_matrix_bgr.png')
@@ -15,6 +20,7 @@ def correlation_matrix(bgr, sign, vars_to_draw, leg_labels, output_path):
 
 
 
+@profiled(rows=0)
 def calculate_correlation(df, vars_to_corr, target_var) :
     """
     Calculates correlations with target variable variable and standart errors
@@ -41,11 +47,12 @@ def calculate_correlation(df, vars_to_corr, target_var) :
 
         cov = (df[j] - mean_j) * (df[target_var] - mean) / (sigma*sigma_j)
         correlation.append(cov.mean())
-        error.append(sem(cov))
+        error.append(stats.sem(cov))
 
     return correlation, error
 
 
+@profiled()
 def plot1Dcorrelation(vars_to_draw,var_to_corr, corr_signal, corr_signal_errors, corr_bg, corr_bg_errors, output_path):
     """
     Plots correlations
@@ -67,21 +74,22 @@ def plot1Dcorrelation(vars_to_draw,var_to_corr, corr_signal, corr_signal_errors,
           path that contains output plot
     """
 
+    use_headless()
     fig, ax = plt.subplots(figsize=(10,6))
-    plt.errorbar(vars_to_draw, corr_signal, yerr=corr_signal_errors, fmt='--o')
-    plt.errorbar(vars_to_draw, corr_bg, yerr=corr_bg_errors, fmt='--o')
+    ax.errorbar(vars_to_draw, corr_signal, yerr=corr_signal_errors, fmt='--o')
+    ax.errorbar(vars_to_draw, corr_bg, yerr=corr_bg_errors, fmt='--o')
     ax.grid(zorder=0)
-    ax.set_xticklabels(vars_to_draw, fontsize=15, rotation =70)
-    # ax.set_yticklabels([-0.5,-0.4,  -0.2,0, -0.2, 0.4], fontsize=25)
+    ax.set_xticks(range(len(vars_to_draw)), vars_to_draw, fontsize=15, rotation =70)
     ax.yaxis.set_tick_params(labelsize=15)
-    plt.legend(('signal','background'), fontsize = 15)
-    plt.title('Correlation of all variables with '+ var_to_corr+' along with SEM', fontsize = 18)
-    plt.ylabel('Correlation coefficient', fontsize = 15)
+    ax.legend(('signal','background'), fontsize = 15)
+    ax.set_title('Correlation of all variables with '+ var_to_corr+' along with SEM', fontsize = 18)
+    ax.set_ylabel('Correlation coefficient', fontsize = 15)
     fig.tight_layout()
     fig.savefig(output_path+'/all_vars_corr-'+ var_to_corr+'.png')
+    plt.close(fig)
 
 
-
+@profiled(rows=0)
 def profile_mass(df,variable_xaxis, sign, peak, edge_left, edge_right, pdf_key):
     """
     This function takes the entries of the variables and distributes them in 25 bins.
@@ -114,48 +122,53 @@ def profile_mass(df,variable_xaxis, sign, peak, edge_left, edge_right, pdf_key):
     if sign == 0:
         keyword = 'background'
 
+    use_headless()
     df = df[(df[variable_xaxis] < edge_right) & (df[variable_xaxis] > edge_left)]
+    mass = df[variable_xaxis].to_numpy()
+    if len(mass) == 0:
+        pdf_key.close()
+        return
+    bin_edges = np.linspace(mass.min(), mass.max(), 26)
+    bin_width = (bin_edges[1] - bin_edges[0])
+    bin_centers = bin_edges[1:] - bin_width/2
+
+    # one figure for all variables, the points of a variable are removed after its page is saved
+    fig, axs = plt.subplots(figsize=(10, 6))
+    axs.set_xlabel('Mass', fontsize=17)
+    axs.set_ylabel(" SEM ($\\dfrac{bin\\ std}{\\sqrt{bin\\ count}}$) of bin", fontsize=17)
+    axs.xaxis.set_tick_params(labelsize=16)
+    axs.yaxis.set_tick_params(labelsize=16)
+    axs.locator_params(axis='y', nbins=5)
+    axs.locator_params(axis='x', nbins=5)
 
     for var in df.columns:
         if var != variable_xaxis:
-
-            fig, axs = plt.subplots(figsize=(10, 6))
-
-            bin_means, bin_edges, binnumber = b_s(df[variable_xaxis],df[var], statistic='mean', bins=25)
-            bin_std, bin_edges, binnumber = b_s(df[variable_xaxis],df[var], statistic='std', bins=25)
-            bin_count, bin_edges, binnumber = b_s(df[variable_xaxis],df[var], statistic='count',bins= 25)
-            bin_width = (bin_edges[1] - bin_edges[0])
-            bin_centers = bin_edges[1:] - bin_width/2
-
-            nan_ind = np.where(np.isnan(bin_means))
-            bin_centers = np.delete(bin_centers, nan_ind)
-            bin_means = np.delete(bin_means, nan_ind)
-            bin_count = np.delete(bin_count, nan_ind)
-            bin_std = np.delete(bin_std , nan_ind)
-
-
-            plt.errorbar(x=bin_centers, y=bin_means, yerr=(bin_std/np.sqrt(bin_count)), linestyle='none', linewidth = 2, marker='.',mfc='red', ms=15)
-
-            plt.locator_params(axis='y', nbins=5)
-            plt.locator_params(axis='x', nbins=5)
-
-            plt.title('Mean of ' +var+ '  vs bin centers of '+variable_xaxis+ \
+            # count, mean and std of all bins from one pass
+            bin_count, bin_means, bin_std = binned_moments(mass, df[var].to_numpy(), bin_edges)
+            filled = ~np.isnan(bin_means)
+            if not filled.any():
+                continue
+
+            axs.ignore_existing_data_limits = True
+            points = axs.errorbar(x=bin_centers[filled], y=bin_means[filled],
+                                  yerr=(bin_std[filled]/np.sqrt(bin_count[filled])), linestyle='none', linewidth = 2,
+                                  marker='.',mfc='red', ms=15)
+            line = axs.vlines(x=peak,ymin=bin_means[filled].min(),ymax=bin_means[filled].max(), color='r',
+                              linestyle='-', linewidth = 3)
+            axs.set_title('Mean of ' +var+ '  vs bin centers of '+variable_xaxis+ \
                       '('+keyword+')', fontsize=19)
-            plt.xlabel('Mass', fontsize=17)
-            plt.ylabel(" SEM ($\dfrac{bin\ std}{\sqrt{bin\ count}}$) of bin", fontsize=17)
 
-
-            plt.vlines(x=peak,ymin=bin_means.min(),ymax=bin_means.max(), color='r', linestyle='-', linewidth = 3)
-
-            axs.xaxis.set_tick_params(labelsize=16)
-            axs.yaxis.set_tick_params(labelsize=16)
             fig.tight_layout()
-            plt.savefig(pdf_key,format='pdf')
+            fig.savefig(pdf_key,format='pdf')
+            points.remove()
+            line.remove()
 
+    plt.close(fig)
     pdf_key.close()
 
 
-def plot2D_all(df, sample, sgn, pdf_key):
+@profiled(rows=0)
+def plot2D_all(df, sample, sgn, pdf_key, stats=None, robust=False):
     """
     Plots 2D distribution between all the variables
     Parameters
@@ -168,37 +181,45 @@ def plot2D_all(df, sample, sgn, pdf_key):
          signal definition(0 background, 1 signal)
     pdf_key: matplotlib.backends.backend_pdf.PdfPages
         output pdf file
+    stats: column_stats.ColumnStats
+        statistics of df for the axis ranges, computed in one pass if not given
+    robust: bool
+        plot the central 99.8% quantile range of every variable
     """
-
+    if stats is None:
+        stats = ColumnStats.from_frame(df)
+
+    use_headless()
+    # one figure for all pairs, the 2D counts are drawn as an image whose data is replaced
+    fig, axs = plt.subplots(figsize=(15, 10))
+    image = ImageLayer(axs, cmap='viridis')
+    fig.colorbar(image.artist, ax=axs)
+    if sgn==1:
+        axs.set_title('Signal candidates ' + sample, fontsize = 25)
+    if sgn==0:
+        axs.set_title('Background candidates ' + sample, fontsize = 25)
+    axs.legend(handles=[], shadow=True, title=str(len(df))+ " samples")
+
+    edges = {var: stats.edges(var, 100, robust) for var in df.columns}
+    values = {var: df[var].to_numpy() for var in df.columns}
     for xvar in df.columns:
         for yvar in df.columns:
             if xvar!=yvar:
-                fig, axs = plt.subplots(figsize=(15, 10))
-                cax = plt.hist2d(df[xvar],df[yvar],range=[[df[xvar].min(), df[xvar].max()], [df[yvar].min(), df[yvar].max()]], bins=100,
-                            norm=mpl.colors.LogNorm(), cmap=plt.cm.viridis)
-
-
-                if sgn==1:
-                    plt.title('Signal candidates ' + sample, fontsize = 25)
-
-                if sgn==0:
-                    plt.title('Background candidates ' + sample, fontsize = 25)
-
-
-                plt.xlabel(xvar, fontsize=25)
-                plt.ylabel(yvar, fontsize=25)
-
-
-                mpl.pyplot.colorbar()
-
-                plt.legend(shadow=True,title =str(len(df))+ " samples")
+                image.update(hist2d_counts(values[xvar], values[yvar], edges[xvar], edges[yvar]), edges[xvar],
+                             edges[yvar])
+                axs.set_xlim(edges[xvar][0], edges[xvar][-1])
+                axs.set_ylim(edges[yvar][0], edges[yvar][-1])
+                axs.set_xlabel(xvar, fontsize=25)
+                axs.set_ylabel(yvar, fontsize=25)
 
                 fig.tight_layout()
-                plt.savefig(pdf_key,format='pdf')
+                fig.savefig(pdf_key,format='pdf')
+    plt.close(fig)
     pdf_key.close()
 
 
-def plot2D_mass(df, sample, mass_var, mass_range, sgn, peak, pdf_key):
+@profiled(rows=0)
+def plot2D_mass(df, sample, mass_var, mass_range, sgn, peak, pdf_key, stats=None, robust=False):
     """
     Plots 2D distribution between variable and invariant mass
     Parameters
@@ -217,39 +238,42 @@ def plot2D_mass(df, sample, mass_var, mass_range, sgn, peak, pdf_key):
         invariant mass value
     pdf_key: matplotlib.backends.backend_pdf.PdfPages
         output pdf file
+    stats: column_stats.ColumnStats
+        statistics of df for the axis ranges, computed in one pass if not given
+    robust: bool
+        plot the central 99.8% quantile range of every variable
     """
-
+    if stats is None:
+        stats = ColumnStats.from_frame(df)
+
+    use_headless()
+    fig, axs = plt.subplots(figsize=(6, 4))
+    image = ImageLayer(axs, cmap='viridis')
+    fig.colorbar(image.artist, ax=axs)
+    peak_line, = axs.plot([peak, peak], [0, 1], color='r', linestyle='-', linewidth = 4)
+    if sgn==1:
+        axs.set_title('Signal candidates ' + sample, fontsize = 15)
+    if sgn==0:
+        axs.set_title('Background candidates ' + sample, fontsize = 15)
+    axs.xaxis.set_tick_params(labelsize=11)
+    axs.yaxis.set_tick_params(labelsize=11)
+    axs.locator_params(axis='y', nbins=5)
+    axs.locator_params(axis='x', nbins=5)
+    axs.legend(handles=[], shadow=True, title=str(len(df))+ " samples")
+    axs.set_xlabel(mass_var, fontsize=16)
+
+    mass_edges = np.linspace(mass_range[0], mass_range[1], 101)
+    mass = df[mass_var].to_numpy()
     for var in df.columns:
         if var != mass_var:
-            fig, axs = plt.subplots(figsize=(6, 4))
-            cax = plt.hist2d(df[mass_var],df[var],range=[mass_range, [df[var].min(), df[var].max()]], bins=100,
-                        norm=mpl.colors.LogNorm(), cmap=plt.cm.viridis)
-
-
-            if sgn==1:
-                plt.title('Signal candidates ' + sample, fontsize = 15)
-
-            if sgn==0:
-                plt.title('Background candidates ' + sample, fontsize = 15)
-
-
-            plt.xlabel(mass_var, fontsize=16)
-            plt.ylabel(var, fontsize=16)
-
-            plt.vlines(x=peak,ymin=df[var].min(),ymax=df[var].max(), color='r', linestyle='-', linewidth = 4)
-
-            mpl.pyplot.colorbar()
-
-
-            axs.xaxis.set_tick_params(labelsize=11)
-            axs.yaxis.set_tick_params(labelsize=11)
-
-            plt.locator_params(axis='y', nbins=5)
-            plt.locator_params(axis='x', nbins=5)
-
-
-            plt.legend(shadow=True,title =str(len(df))+ " samples")
+            var_edges = stats.edges(var, 100, robust)
+            image.update(hist2d_counts(mass, df[var].to_numpy(), mass_edges, var_edges), mass_edges, var_edges)
+            peak_line.set_ydata([var_edges[0], var_edges[-1]])
+            axs.set_xlim(mass_edges[0], mass_edges[-1])
+            axs.set_ylim(var_edges[0], var_edges[-1])
+            axs.set_ylabel(var, fontsize=16)
 
             fig.tight_layout()
-            plt.savefig(pdf_key,format='pdf')
+            fig.savefig(pdf_key,format='pdf')
+    plt.close(fig)
     pdf_key.close()
@@ -0,0 +1,197 @@
+import argparse
+
+
+def _score(args):
+    from cand_class.scoring import read_file_list, score_files
+
+    summary = score_files(read_file_list(args.files), args.model, args.tree, args.output_path,
+                          out_format=args.format, keep_branches=args.branches,
+                          n_workers=args.workers, n_shards=args.shards, step_size=args.step_size,
+                          bins=args.bins, threshold=args.threshold, features=args.features,
+                          cascade=args.cascade, io_threads=args.io_threads, prefetch=args.prefetch,
+                          backend=args.backend)
+    print('Scored '+str(summary['candidates'])+' candidates from '+str(len(summary['files']))+' files')
+    io = summary['io']
+    print('I/O: %.1f MB read, decompression %.2f s, stalled %.2f s'
+          % (io['bytes_read'] / 2**20, io['decompress_time'], io['stall_time']))
+
+
+def _split(args):
+    from cand_class.batch import make_manifest
+    from cand_class.scoring import read_file_list
+
+    manifest_file = make_manifest(read_file_list(args.files), args.jobs, args.model, args.tree, args.binning,
+                                  args.threshold, args.output_path, sample=args.sample, label=args.label,
+                                  step_size=args.step_size)
+    print('Job manifest written to '+manifest_file)
+
+
+def _run_job(args):
+    from cand_class.batch import run_job
+
+    print('Partial result written to '+run_job(args.job))
+
+
+def _run_local(args):
+    from cand_class.batch import run_local
+
+    run_local(args.manifest, args.workers)
+
+
+def _reduce(args):
+    from cand_class.batch import reduce_partials
+
+    reduce_partials(args.manifest, args.output_path)
+
+
+def _serve(args):
+    from cand_class.service import serve
+
+    serve(args.model, socket_path=args.socket, host=args.host, port=args.port, backend=args.backend,
+          lib_path=args.lib, max_batch=args.max_batch, max_delay_ms=args.max_delay_ms,
+          threshold=args.threshold, features=args.features)
+
+
+def _update(args):
+    from cand_class.incremental import update_model
+
+    update_model(args.model, args.input, args.mass_var, args.output_path, num_boost_round=args.rounds,
+                 refresh_leaves=args.refresh_leaves, features=args.features, step_size=args.step_size,
+                 holdout_fraction=args.holdout_fraction, hash_files=not args.no_hash, cache_dir=args.cache_dir)
+    print('Updated model written to '+args.output_path)
+
+
+def _run(args):
+    from cand_class.pipeline import run_pipeline
+
+    run_pipeline(args.manifest, until=args.until, force=args.force, hash_files=args.hash_files)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cand_class', description='CBM candidates classifier tools')
+    parser.add_argument('--concurrency', default=None,
+                        help='toml file with a [concurrency] table (total_cores, outer, inner, blas_threads)')
+    parser.add_argument('--memory', default=None,
+                        help='toml file with a [memory] table (limit, chunk_fraction, spill_dir, min_rows)')
+    parser.add_argument('--profile', default=None, metavar='DIR',
+                        help='record stage timings and memory and write them to DIR')
+    parser.add_argument('--profile-format', choices=['json', 'openmetrics'], default='json')
+    parser.add_argument('--trace-memory', action='store_true', help='record tracemalloc peaks with --profile')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    score = commands.add_parser('score', help='score ROOT files with a trained model on a process pool')
+    score.add_argument('files', nargs='+', help='ROOT files or .txt/.list file lists')
+    score.add_argument('--model', required=True, help='trained model (.json/.ubj or pickle)')
+    score.add_argument('--tree', required=True, help='name of the candidate tree')
+    score.add_argument('--output-path', required=True)
+    score.add_argument('--format', choices=['root', 'parquet'], default='root')
+    score.add_argument('--branches', nargs='*', default=[], help='branches written next to the score')
+    score.add_argument('--features', nargs='*', default=None, help='train variables if not stored in the model')
+    score.add_argument('--workers', type=int, default=None)
+    score.add_argument('--shards', type=int, default=None)
+    score.add_argument('--step-size', type=int, default=None,
+                       help='candidates per chunk, sized from the memory budget by default')
+    score.add_argument('--bins', type=int, default=100)
+    score.add_argument('--threshold', type=float, default=None)
+    score.add_argument('--cascade', default=None, help='stage-one spec (json) from cascade.save_stage')
+    score.add_argument('--io-threads', type=int, default=None, help='basket decompression threads per worker')
+    score.add_argument('--prefetch', type=int, default=2, help='chunks read ahead per worker')
+    score.add_argument('--backend', choices=['booster', 'numpy'], default='booster',
+                       help='numpy shares the memory-mapped forest of a model artifact between the workers')
+    score.set_defaults(func=_score)
+
+    split = commands.add_parser('split', help='split input files into reproducible evaluation job specs')
+    split.add_argument('files', nargs='+', help='ROOT files or .txt/.list file lists')
+    split.add_argument('--jobs', type=int, required=True)
+    split.add_argument('--model', required=True)
+    split.add_argument('--tree', required=True)
+    split.add_argument('--binning', required=True, help='toml file with fixed binning')
+    split.add_argument('--threshold', type=float, required=True, help='BDT cut')
+    split.add_argument('--output-path', required=True)
+    split.add_argument('--sample', default='test')
+    split.add_argument('--label', default='issignal')
+    split.add_argument('--step-size', type=int, default=100000)
+    split.set_defaults(func=_split)
+
+    run_job = commands.add_parser('run-job', help='run one evaluation job spec')
+    run_job.add_argument('job')
+    run_job.set_defaults(func=_run_job)
+
+    run_local = commands.add_parser('run-local', help='run all jobs of a manifest as local subprocesses')
+    run_local.add_argument('manifest')
+    run_local.add_argument('--workers', type=int, default=2)
+    run_local.set_defaults(func=_run_local)
+
+    reduce = commands.add_parser('reduce', help='merge partial job results into hists.root and plots')
+    reduce.add_argument('manifest')
+    reduce.add_argument('--output-path', default=None)
+    reduce.set_defaults(func=_reduce)
+
+    serve = commands.add_parser('serve', help='long-running micro-batching scoring service')
+    serve.add_argument('--model', required=True, help='trained model (.json/.ubj or pickle)')
+    serve.add_argument('--socket', default=None, help='Unix socket path, localhost HTTP if not given')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--backend', choices=['booster_inplace', 'numpy', 'treelite', 'model_handler'],
+                       default='booster_inplace')
+    serve.add_argument('--lib', default=None, help='treelite library for --backend treelite')
+    serve.add_argument('--max-batch', type=int, default=4096, help='maximal candidates per micro-batch')
+    serve.add_argument('--max-delay-ms', type=float, default=2.0, help='latency budget for batching')
+    serve.add_argument('--threshold', type=float, default=None)
+    serve.add_argument('--features', nargs='*', default=None, help='train variables if not stored in the model')
+    serve.set_defaults(func=_serve)
+
+    update = commands.add_parser('update', help='continue training a model on newly produced data')
+    update.add_argument('--model', required=True, help='previous model (.json/.ubj or pickle)')
+    update.add_argument('--input', required=True, help='input toml of the new data')
+    update.add_argument('--mass-var', required=True, help='mass branch for the background sidebands')
+    update.add_argument('--output-path', required=True)
+    update.add_argument('--rounds', type=int, default=50, help='trees added to the model')
+    update.add_argument('--refresh-leaves', action='store_true',
+                        help='only recompute the leaf values of the existing trees')
+    update.add_argument('--features', nargs='*', default=None, help='train variables if not stored in the model')
+    update.add_argument('--step-size', type=int, default=500000)
+    update.add_argument('--holdout-fraction', type=float, default=0.1)
+    update.add_argument('--cache-dir', default=None, help='directory of the external-memory page cache')
+    update.add_argument('--no-hash', action='store_true', help='do not hash the input files for the provenance')
+    update.set_defaults(func=_update)
+
+    run = commands.add_parser('run', help='run the training pipeline of a run manifest with memoized stages')
+    run.add_argument('manifest', help='run toml, see manifest.RunManifest')
+    run.add_argument('--until', choices=['sample', 'transform', 'split', 'model', 'thresholds', 'plots'],
+                     default='plots', help='last stage to run')
+    run.add_argument('--force', nargs='*', default=[], help='stages recomputed even if cached')
+    run.add_argument('--hash-files', action='store_true', help='fingerprint input files by content')
+    run.set_defaults(func=_run)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.concurrency is not None:
+        from cand_class.concurrency import set_budget
+        from cand_class.config_reader import read_concurrency
+
+        set_budget(read_concurrency(args.concurrency))
+    if args.memory is not None:
+        from cand_class.config_reader import read_memory
+        from cand_class.memory import set_memory_budget
+
+        set_memory_budget(read_memory(args.memory))
+
+    if args.profile is None:
+        args.func(args)
+        return
+
+    from cand_class import profiling
+
+    profiling.enable(trace_memory=args.trace_memory)
+    try:
+        args.func(args)
+    finally:
+        print('Profile written to '+profiling.write_report(args.profile, args.profile_format))
+
+
+if __name__ == '__main__':
+    main()
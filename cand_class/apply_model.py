@@ -1,24 +1,22 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import xgboost as xgb
-from hipe4ml.plot_utils import plot_roc_train_test
 from cand_class.helper import *
-from sklearn.metrics import confusion_matrix, roc_curve, roc_auc_score
 
 from dataclasses import dataclass
 
-from matplotlib.font_manager import FontProperties
-
-from matplotlib.ticker import (MultipleLocator, FormatStrFormatter,
-                               AutoMinorLocator)
-
 import gc
-import matplotlib as mpl
-from cand_class.helper import *
-from hipe4ml import plot_utils
 
-mpl.rc('figure', max_open_warning = 0)
+from cand_class.column_stats import ColumnStats
+from cand_class.lazy import lazy_import
+from cand_class.plotting import StairsLayer, count_ylim, hist_counts, use_headless
+from cand_class.profiling import profiled
+
+# plotting and hipe4ml are imported on first use, see cand_class.lazy
+plt = lazy_import('matplotlib.pyplot', 'plot', on_load=lambda module: module.rc('figure', max_open_warning=0))
+mpl = lazy_import('matplotlib', 'plot')
+ticker = lazy_import('matplotlib.ticker', 'plot')
+font_manager = lazy_import('matplotlib.font_manager', 'plot')
+plot_utils = lazy_import('hipe4ml.plot_utils', 'plot')
 
 
 @dataclass
@@ -67,6 +65,18 @@ class ApplyXGB:
     __best_test_thr : int = 0
 
 
+    @classmethod
+    def from_store(cls, store, model, x_train, x_test, y_train, y_test, output_path, features=None):
+        """
+        ApplyXGB with train and test predictions read memory-mapped from a
+        score_store.ScoreStore, they are only predicted (and stored) if the
+        store has no scores of this model for these data yet
+        """
+        return cls(x_train, x_test, store.scores(model, x_train, features, name='train'),
+                   store.scores(model, x_test, features, name='test'), y_train, y_test, output_path)
+
+
+    @profiled(rows=lambda res, self, *args, **kwargs: len(self.x_train) + len(self.x_test))
     def get_predictions(self):
         """
         Makes XGB predictions
@@ -74,17 +84,20 @@ class ApplyXGB:
         Returns
         --------
 
-        Train and test dataframes with predictions
+        Train and test dataframes with predictions. They are shallow copies of
+        x_train and x_test sharing the feature columns, only the prediction
+        columns are new
         """
-        self.__train_res = self.x_train.copy()
+        self.__train_res = self.x_train.copy(deep=False)
         self.__train_res['xgb_preds'] = self.y_pred_train
 
-        self.__test_res = self.x_test.copy()
+        self.__test_res = self.x_test.copy(deep=False)
         self.__test_res['xgb_preds'] = self.y_pred_test
 
         return self.__train_res, self.__test_res
 
 
+    @profiled(rows=lambda res, self, *args, **kwargs: len(self.x_train) + len(self.x_test))
     def apply_prob_cut(self, ams, train_thr, test_thr):
         """
         Applies BDT cut on XGB probabilities and returns 'xgb_preds1' ==1 if
@@ -102,8 +115,8 @@ class ApplyXGB:
             self.__best_train_thr = train_thr
             self.__best_test_thr = test_thr
 
-        train_pred = ((self.y_pred_train > self.__best_train_thr)*1)
-        test_pred = ((self.y_pred_test > self.__best_test_thr)*1)
+        train_pred = (self.y_pred_train > self.__best_train_thr).astype(np.int8)
+        test_pred = (self.y_pred_test > self.__best_test_thr).astype(np.int8)
 
 
         self.__train_res['xgb_preds1'] = train_pred
@@ -113,6 +126,29 @@ class ApplyXGB:
         return self.__train_res, self.__test_res
 
 
+    @profiled(rows=lambda res, self, *args, **kwargs: len(self.y_test))
+    def cut_uncertainties(self, n_replicas=1000, method='poisson', cl=0.68):
+        """
+        Bootstrap confidence intervals of AUC, AMS-optimal BDT cut and
+        efficiencies on the test dataset, the efficiencies at the threshold
+        chosen in apply_prob_cut are included. Saves bootstrap.json
+
+        Returns
+        --------
+
+        dict metric -> {'value', 'low', 'high', 'std'}
+        """
+        from cand_class.bootstrap import bootstrap
+
+        threshold = self.__best_test_thr if self.__best_test_thr else None
+        intervals = bootstrap(self.y_pred_test, self.y_test, n_replicas=n_replicas, method=method,
+                              threshold=threshold, cl=cl, output_path=self.output_path)
+        for metric, res in intervals.items():
+            print('%-36s %.5f  [%.5f, %.5f]' % (metric, res['value'], res['low'], res['high']))
+        return intervals
+
+
+    @profiled()
     def print_roc(self):
         plot_utils.plot_roc_train_test(self.y_test, self.__test_res['xgb_preds1'],
         self.y_train, self.__train_res['xgb_preds1'], None, ['background', 'signal'])
@@ -121,6 +157,7 @@ class ApplyXGB:
 
 
 
+    @profiled()
     def features_importance(self, bst):
          """
          Plots confusion matrix. A Confusion Matrix C is such that Cij is equal to
@@ -151,6 +188,46 @@ class ApplyXGB:
          ax.figure.savefig(str(self.output_path)+"/xgb_train_variables_rank.png")
 
 
+    @profiled(rows=lambda res, self, *args, **kwargs: len(self.x_test))
+    def shap_importance(self, bst, features, x_range, y_range, bins=10, precision=None, pt_var='pT',
+                        rap_var='rapidity'):
+         """
+         Per-candidate TreeSHAP attribution on the test dataset, aggregated as
+         mean |SHAP value| per feature and per (rapidity, pT) bin. Physics
+         oriented replacement of features_importance
+
+         Parameters
+         ----------
+         bst: xgboost.sklearn.XGBClassifier
+               model's XGB classifier
+         features: list of str
+               train variables
+         x_range, y_range: list
+               rapidity and pT ranges of the bins
+         bins: int
+               number of bins in rapidity and pT
+         precision: float
+               sampling mode, relative precision of the per-feature means,
+               all test candidates are explained if None
+
+         Returns
+         -------
+
+             attribution.ShapSummary, saves shap_summary.json,
+             shap_importance.png and shap_pt_rap.png
+
+         """
+         from cand_class.attribution import explain, plot_shap, write_summary
+
+         summary = explain(bst, self.x_test[features], self.x_test[rap_var], self.x_test[pt_var], features,
+                           np.linspace(x_range[0], x_range[1], bins + 1),
+                           np.linspace(y_range[0], y_range[1], bins + 1), precision=precision)
+         write_summary(summary, self.output_path)
+         plot_shap(summary, self.output_path)
+         return summary
+
+
+    @profiled(rows=lambda res, self, *args, **kwargs: len(self.x_train) + len(self.x_test))
     def CM_plot_train_test(self, issignal):
          """
          Plots confusion matrix. A Confusion Matrix C is such that Cij is equal to
@@ -173,6 +250,7 @@ class ApplyXGB:
 
          """
 
+         use_headless()
          cnf_matrix_train = confusion_matrix(self.__train_res[issignal], self.__train_res['xgb_preds1'], labels=[1,0])
          np.set_printoptions(precision=2)
          fig_train, axs_train = plt.subplots(figsize=(8, 6))
@@ -183,8 +261,9 @@ class ApplyXGB:
          axs_train.yaxis.set_tick_params(labelsize=15)
 
          plot_confusion_matrix(cnf_matrix_train, classes=['signal','background'],
-          title=' Train Dataset Confusion Matrix for cut > '+"%.4f"%self.__best_train_thr)
-         plt.savefig(str(self.output_path)+'/confusion_matrix_extreme_gradient_boosting_train.png')
+          title=' Train Dataset Confusion Matrix for cut > '+"%.4f"%self.__best_train_thr, ax=axs_train)
+         fig_train.savefig(str(self.output_path)+'/confusion_matrix_extreme_gradient_boosting_train.png')
+         plt.close(fig_train)
 
 
          cnf_matrix_test = confusion_matrix(self.__test_res[issignal], self.__test_res['xgb_preds1'], labels=[1,0])
@@ -197,10 +276,12 @@ class ApplyXGB:
          axs_test.yaxis.set_tick_params(labelsize=15)
 
          plot_confusion_matrix(cnf_matrix_test, classes=['signal','background'],
-           title=' Test Dataset Confusion Matrix for cut > '+"%.4f"%self.__best_test_thr)
-         plt.savefig(str(self.output_path)+'/confusion_matrix_extreme_gradient_boosting_test.png')
+           title=' Test Dataset Confusion Matrix for cut > '+"%.4f"%self.__best_test_thr, ax=axs_test)
+         fig_test.savefig(str(self.output_path)+'/confusion_matrix_extreme_gradient_boosting_test.png')
+         plt.close(fig_test)
 
 
+    @profiled(rows=1)
     def pT_vs_rapidity(self, df, sign_label, pred_label, x_range, y_range, data_name, pt_rap):
         """
         Plots distribution in pT-rapidity phase space
@@ -265,8 +346,8 @@ class ApplyXGB:
 
 
 
-        axs[0].xaxis.set_major_locator(MultipleLocator(1))
-        axs[0].xaxis.set_major_formatter(FormatStrFormatter('%d'))
+        axs[0].xaxis.set_major_locator(ticker.MultipleLocator(1))
+        axs[0].xaxis.set_major_formatter(ticker.FormatStrFormatter('%d'))
 
         axs[0].xaxis.set_tick_params(which='both', width=2)
 
@@ -283,8 +364,8 @@ class ApplyXGB:
 
         mpl.pyplot.colorbar(im1, ax = axs[1])
 
-        axs[1].xaxis.set_major_locator(MultipleLocator(1))
-        axs[1].xaxis.set_major_formatter(FormatStrFormatter('%d'))
+        axs[1].xaxis.set_major_locator(ticker.MultipleLocator(1))
+        axs[1].xaxis.set_major_formatter(ticker.FormatStrFormatter('%d'))
 
         axs[1].xaxis.set_tick_params(which='both', width=2)
 
@@ -301,8 +382,8 @@ class ApplyXGB:
         mpl.pyplot.colorbar(im1, ax = axs[2])
 
 
-        axs[2].xaxis.set_major_locator(MultipleLocator(1))
-        axs[2].xaxis.set_major_formatter(FormatStrFormatter('%d'))
+        axs[2].xaxis.set_major_locator(ticker.MultipleLocator(1))
+        axs[2].xaxis.set_major_formatter(ticker.FormatStrFormatter('%d'))
 
         axs[2].xaxis.set_tick_params(which='both', width=2)
 
@@ -312,7 +393,8 @@ class ApplyXGB:
 
 
 
-    def hist_variables(self, mass_var, df, sign_label, pred_label,  sample, pdf_key):
+    @profiled(rows=2)
+    def hist_variables(self, mass_var, df, sign_label, pred_label,  sample, pdf_key, stats=None, robust=False):
         """
         Applied quality cuts and created distributions for all the features in pdf
         file
@@ -326,103 +408,71 @@ class ApplyXGB:
                 name of the feature to be plotted
         pdf_key: PdfPages object
                 name of pdf document with distributions
+        stats: column_stats.ColumnStats
+                statistics of df giving the common binning of all panels of a
+                feature, computed in one pass over df if not given
+        robust: bool
+                bin the central 99.8% quantile range instead of min to max
         """
 
-        dfs_orig = df[df[sign_label]==1]
-        dfb_orig = df[df[sign_label]==0]
-
-        dfs_cut = df[(df[sign_label]==1) & (df[pred_label]==1)]
-        dfb_cut = df[(df[sign_label]==0) & (df[pred_label]==1)]
-
-        diff_vars = dfs_orig.columns.drop([sign_label, pred_label])
-
-        difference_s = pd.concat([dfs_orig[diff_vars], dfs_cut[diff_vars]]).drop_duplicates(keep=False)
-
-
+        use_headless()
+        is_signal = (df[sign_label]==1).to_numpy()
+        is_cut = (df[pred_label]==1).to_numpy()
+        # 0/1: background/signal before the ML cut only, 2/3: also after it
+        groups = is_signal.astype(np.intp) + 2 * is_cut.astype(np.intp)
+        n_sgn, n_bgr = int(is_signal.sum()), int((df[sign_label]==0).sum())
+        n_sgn_cut, n_bgr_cut = int((is_signal & is_cut).sum()), int((~is_signal & is_cut).sum())
+
+        # the signal difference is the signal removed by the ML cut (group 1), no subset of df is copied
+        n_diff = n_sgn - n_sgn_cut
+
+        diff_vars = df.columns.drop([sign_label, pred_label])
+
+        if stats is None:
+            stats = ColumnStats.from_frame(df, diff_vars)
+
+        # one figure for all features, only the histogram data, limits and titles change
+        fig, ax = plt.subplots(3, figsize=(15, 10))
+        fontP = font_manager.FontProperties()
+        fontP.set_size('xx-large')
+        layers = []
+        for axis in ax[:2]:
+            layers.append([StairsLayer(axis, fill=True, alpha=0.4, color='blue', label='signal'),
+                           StairsLayer(axis, fill=True, alpha=0.4, color='red', label='background')])
+        layers.append([StairsLayer(ax[2], fill=True, alpha=0.4, color='blue', label='signal')])
+
+        if n_bgr_cut !=0:
+            title1 = 'S/B='+ str(round(n_sgn_cut/n_bgr_cut, 3))
+        else:
+            title1 = 'S = '+str(n_sgn_cut) + ' all bgr was cut'
+        titles = ['S/B='+ str(round(n_sgn/n_bgr, 3)) + '\n S samples:  '+str(n_sgn) + '\n B samples: '+
+                  str(n_bgr) + '\nquality cuts ',
+                  title1 + '\n S samples:  '+str(n_sgn_cut) + '\n B samples: '+ str(n_bgr_cut) +
+                  '\nquality cuts + ML cut',
+                  'S samples: '+str(n_diff) +'\nsignal difference']
+        for axis, title in zip(ax, titles):
+            axis.legend(shadow=True, title=title, title_fontsize=15, fontsize=15, bbox_to_anchor=(1.05, 1),
+                        loc='upper left', prop=fontP)
+            axis.xaxis.set_tick_params(labelsize=15)
+            axis.yaxis.set_tick_params(labelsize=15)
 
         for feature in diff_vars:
-            fig, ax = plt.subplots(3, figsize=(15, 10))
-
-
-            fontP = FontProperties()
-            fontP.set_size('xx-large')
-
-            ax[0].hist(dfs_orig[feature], label = 'signal', bins = 500, alpha = 0.4, color = 'blue')
-            ax[0].hist(dfb_orig[feature], label = 'background', bins = 500, alpha = 0.4, color = 'red')
-            ax[0].legend(shadow=True,title = 'S/B='+ str(round(len(dfs_orig)/len(dfb_orig), 3)) +
-
-                       '\n S samples:  '+str(dfs_orig.shape[0]) + '\n B samples: '+ str(dfb_orig.shape[0]) +
-                       '\nquality cuts ',
-                       title_fontsize=15, fontsize =15, bbox_to_anchor=(1.05, 1),
-                        loc='upper left', prop=fontP,)
-
-            ax[0].set_xlim(dfb_orig[feature].min(), dfb_orig[feature].max())
-
-            ax[0].xaxis.set_tick_params(labelsize=15)
-            ax[0].yaxis.set_tick_params(labelsize=15)
-
-            ax[0].set_title(str(feature) + ' MC '+ sample + ' before ML cut', fontsize = 25)
-            ax[0].set_xlabel(feature, fontsize = 25)
-
-            if feature!=mass_var:
-                ax[0].set_yscale('log')
-
-            fig.tight_layout()
-
-
-            if len(dfb_cut) !=0:
-                s_b_cut = round(len(dfs_cut)/len(dfb_cut), 3)
-                title1 = 'S/B='+ str(s_b_cut)
-            else:
-                title1 = 'S = '+str(len(dfs_cut)) + ' all bgr was cut'
-
-
-
-            ax[1].hist(dfs_cut[feature], label = 'signal', bins = 500, alpha = 0.4, color = 'blue')
-            ax[1].hist(dfb_cut[feature], label = 'background', bins = 500, alpha = 0.4, color = 'red')
-            ax[1].legend(shadow=True,title =  title1 +
-                       '\n S samples:  '+str(dfs_cut.shape[0]) + '\n B samples: '+ str(dfb_cut.shape[0]) +
-                       '\nquality cuts + ML cut',
-                        title_fontsize=15, fontsize =15, bbox_to_anchor=(1.05, 1),
-                        loc='upper left', prop=fontP,)
-
-
-            ax[1].set_xlim(dfb_orig[feature].min(), dfb_orig[feature].max())
-
-            ax[1].xaxis.set_tick_params(labelsize=15)
-            ax[1].yaxis.set_tick_params(labelsize=15)
-
-            ax[1].set_title(feature + ' MC '+ sample+ ' after ML cut', fontsize = 25)
-            ax[1].set_xlabel(feature, fontsize = 25)
-
-            if feature!='mass':
-                ax[1].set_yscale('log')
+            edges = stats.edges(feature, 500, robust)
+            counts = hist_counts(df[feature].to_numpy(), edges, groups, 4)
+            panels = [[counts[1] + counts[3], counts[0] + counts[2]], [counts[3], counts[2]], [counts[1]]]
+            names = [' before ML cut', ' after ML cut', ' signal difference']
+
+            for axis, axis_layers, axis_counts, name in zip(ax, layers, panels, names):
+                for layer, layer_counts in zip(axis_layers, axis_counts):
+                    layer.update(layer_counts, edges)
+                axis.set_xlim(edges[0], edges[-1])
+                count_ylim(axis, axis_counts, feature!=mass_var)
+                axis.set_title(str(feature) + ' MC '+ sample + name, fontsize = 25)
+                axis.set_xlabel(feature, fontsize = 25)
 
             fig.tight_layout()
 
+            fig.savefig(pdf_key,format='pdf')
 
-
-
-            ax[2].hist(difference_s[feature], label = 'signal', bins = 500, alpha = 0.4, color = 'blue')
-            ax[2].legend(shadow=True,title ='S samples: '+str(len(difference_s)) +'\nsignal difference',
-                        title_fontsize=15, fontsize =15, bbox_to_anchor=(1.05, 1),
-                        loc='upper left', prop=fontP,)
-
-
-            ax[2].set_xlim(dfb_orig[feature].min(), dfb_orig[feature].max())
-
-            ax[2].xaxis.set_tick_params(labelsize=15)
-            ax[2].yaxis.set_tick_params(labelsize=15)
-
-            ax[2].set_title(feature + ' MC '+ sample +' signal difference', fontsize = 25)
-            ax[2].set_xlabel(feature, fontsize = 25)
-
-            if feature!=mass_var:
-                ax[2].set_yscale('log')
-
-            fig.tight_layout()
-
-            plt.savefig(pdf_key,format='pdf')
-
-
+        plt.close(fig)
         pdf_key.close()
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import time
+
+from cand_class.lazy import lazy_import
+from cand_class.model_io import as_booster, booster_features
+from cand_class.profiling import profiled
+from cand_class.tree_eval import FlatForest
+
+xgb = lazy_import('xgboost')
+
+FORMAT_VERSION = 1
+SPEC_FILE = 'artifact.json'
+MODEL_FILE = 'model.ubj'
+FOREST_DIR = 'forest'
+
+
+def is_artifact(path):
+    return os.path.isfile(os.path.join(str(path), SPEC_FILE))
+
+
+def _file_sha256(file_name):
+    sha = hashlib.sha256()
+    with open(file_name, 'rb') as inp_file:
+        for block in iter(lambda: inp_file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _content_hash(model_sha, features, log_vars, threshold):
+    content = json.dumps({'model': model_sha, 'features': features, 'log_vars': log_vars, 'threshold': threshold},
+                         sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def log_vars_of(features):
+    """
+    Raw branches that are log-transformed for the features ('log(var)' -> var)
+    """
+    return [feature[4:-1] for feature in features if feature.startswith('log(') and feature.endswith(')')]
+
+
+@profiled()
+def save_artifact(model, output_path, features=None, threshold=None, log_vars=None, flat_forest=True):
+    """
+    Writes a model artifact directory that workers load without unpickling:
+
+        artifact.json   features, log-transform spec, threshold, hashes
+        model.ubj       booster in XGBoost UBJSON format
+        forest/*.npy    flattened trees (tree_eval.FlatForest), memory-mappable
+
+    Parameters
+    ------------------------------------------------
+    model: xgboost.Booster, XGBClassifier or hipe4ml ModelHandler
+        trained model
+    output_path: str
+        artifact directory
+    features: list of str
+        train variables if they are not stored in the model
+    threshold: float
+        chosen BDT cut (e.g. from helper.AMS), used by scoring if no other is given
+    log_vars: list of str
+        log-transformed raw branches, taken from the 'log(var)' feature names by default
+    flat_forest: bool
+        also write the flattened tree arrays (not possible for multi-class models)
+
+    Returns
+    -------
+    content hash of the artifact
+    """
+    booster = as_booster(model).copy()
+    features = booster_features(booster, features)
+    booster.feature_names = features
+    log_vars = log_vars_of(features) if log_vars is None else list(log_vars)
+
+    os.makedirs(output_path, exist_ok=True)
+    model_file = os.path.join(output_path, MODEL_FILE)
+    with open(model_file, 'wb') as out_file:
+        out_file.write(booster.save_raw('ubj'))
+
+    files = {MODEL_FILE: _file_sha256(model_file)}
+    if flat_forest:
+        forest_path = os.path.join(output_path, FOREST_DIR)
+        FlatForest.from_booster(booster).save_arrays(forest_path)
+        for file_name in sorted(os.listdir(forest_path)):
+            files[FOREST_DIR+'/'+file_name] = _file_sha256(os.path.join(forest_path, file_name))
+
+    spec = {
+        'format_version': FORMAT_VERSION,
+        'features': features,
+        'log_vars': log_vars,
+        'threshold': None if threshold is None else float(threshold),
+        'num_trees': booster.num_boosted_rounds(),
+        'xgboost_version': xgb.__version__,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'files': files,
+    }
+    # hashed as stored, so a numpy threshold verifies after loading
+    spec['sha256'] = _content_hash(files[MODEL_FILE], features, log_vars, spec['threshold'])
+    with open(os.path.join(output_path, SPEC_FILE), 'w', encoding="utf-8") as out_file:
+        json.dump(spec, out_file, indent=2)
+    return spec['sha256']
+
+
+def read_spec(path):
+    with open(os.path.join(str(path), SPEC_FILE), encoding="utf-8") as inp_file:
+        return json.load(inp_file)
+
+
+class ModelArtifact:
+    """
+    Model artifact written by save_artifact. The booster and the flattened
+    forest are loaded on first use; the forest arrays are memory-mapped
+    read-only, so all workers on a node share one copy of the model
+
+    Parameters
+    ------------------------------------------------
+    path: str
+        artifact directory
+    spec: dict
+        content of artifact.json
+    """
+
+    def __init__(self, path, spec):
+        self.path = str(path)
+        self.spec = spec
+        self._booster = None
+        self._forest = None
+
+    @classmethod
+    def load(cls, path, verify=False):
+        """
+        Reads artifact.json, with verify=True the file hashes are checked
+        and a ValueError is raised for a modified or truncated artifact
+        """
+        spec = read_spec(path)
+        if spec['format_version'] > FORMAT_VERSION:
+            raise ValueError('Artifact format '+str(spec['format_version'])+' is newer than supported '
+                             + str(FORMAT_VERSION))
+        artifact = cls(path, spec)
+        if verify:
+            artifact.verify()
+        return artifact
+
+    def verify(self):
+        for file_name, sha in self.spec['files'].items():
+            if _file_sha256(os.path.join(self.path, file_name)) != sha:
+                raise ValueError('Artifact file '+file_name+' in '+self.path+' does not match its hash')
+        if _content_hash(self.spec['files'][MODEL_FILE], self.features, self.log_vars,
+                         self.threshold) != self.sha256:
+            raise ValueError('Artifact '+self.path+' does not match its content hash')
+
+    @property
+    def features(self):
+        return self.spec['features']
+
+    @property
+    def log_vars(self):
+        return self.spec['log_vars']
+
+    @property
+    def threshold(self):
+        return self.spec['threshold']
+
+    @property
+    def sha256(self):
+        return self.spec['sha256']
+
+    def booster(self, nthread=None):
+        if self._booster is None:
+            self._booster = xgb.Booster(model_file=os.path.join(self.path, MODEL_FILE))
+            self._booster.feature_names = self.features
+        if nthread is not None:
+            self._booster.set_param({'nthread': nthread})
+        return self._booster
+
+    def forest(self, mmap_mode='r'):
+        if self._forest is None:
+            forest_path = os.path.join(self.path, FOREST_DIR)
+            if not os.path.isdir(forest_path):
+                raise ValueError('Artifact '+self.path+' has no flattened forest')
+            self._forest = FlatForest.load_arrays(forest_path, mmap_mode)
+        return self._forest
+
+    def predict(self, x, backend='booster'):
+        """
+        Scores a feature matrix (model features in training order) with the
+        booster or the memory-mapped NumPy forest ('numpy')
+        """
+        if backend == 'numpy':
+            return self.forest().predict(x)
+        return self.booster().inplace_predict(x)
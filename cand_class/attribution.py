@@ -0,0 +1,228 @@
+import json
+import os
+
+import numpy as np
+import xgboost as xgb
+
+from cand_class.concurrency import get_budget
+from cand_class.profiling import profiled
+
+
+def _shap_booster(booster, nthread):
+    if hasattr(booster, 'get_booster'):
+        booster = booster.get_booster()
+    booster = booster.copy()
+    booster.set_param({'nthread': nthread or get_budget().total_cores})
+    return booster
+
+
+def _contribs(booster, x, features):
+    dmatrix = xgb.DMatrix(np.asarray(x, dtype=np.float32), feature_names=features)
+    return booster.predict(dmatrix, pred_contribs=True)
+
+
+def _chunk_rows(n_rows, chunk_size, order=None):
+    for start in range(0, n_rows, chunk_size):
+        yield slice(start, start + chunk_size) if order is None else np.sort(order[start:start + chunk_size])
+
+
+def shap_chunks(booster, x, chunk_size=50000, nthread=None, features=None, order=None):
+    """
+    Yields TreeSHAP contributions of x chunk by chunk, (n_rows, n_features + 1)
+    with the bias in the last column. Memory stays bounded by chunk_size, only
+    the rows of a chunk are converted to float32 and explained by XGBoost with
+    nthread threads (the thread budget by default). With order (a permutation
+    of the rows) the chunks take the rows in that order, each chunk sorted
+    """
+    booster = _shap_booster(booster, nthread)
+    for rows in _chunk_rows(len(x), chunk_size, order):
+        yield _contribs(booster, x.iloc[rows] if hasattr(x, 'iloc') else x[rows], features)
+
+
+class ShapSummary:
+    """
+    Mergeable sums of per-candidate SHAP values: mean |contribution| and mean
+    contribution per feature, overall and per (x, y) bin (rapidity, pT)
+
+    Parameters
+    ------------------------------------------------
+    features: list of str
+        model features in training order
+    x_edges: np.ndarray
+        bin edges of the x variable (rapidity)
+    y_edges: np.ndarray
+        bin edges of the y variable (pT)
+    """
+
+    def __init__(self, features, x_edges, y_edges):
+        self.features = list(features)
+        self.x_edges = np.asarray(x_edges, dtype=np.float64)
+        self.y_edges = np.asarray(y_edges, dtype=np.float64)
+        n_bins = (len(self.x_edges) - 1) * (len(self.y_edges) - 1)
+        n_features = len(self.features)
+
+        self.n = 0
+        self.sum_abs = np.zeros(n_features)
+        self.sum_abs2 = np.zeros(n_features)
+        self.sum = np.zeros(n_features)
+        self.bin_n = np.zeros(n_bins)
+        self.bin_sum_abs = np.zeros((n_features, n_bins))
+
+    def fill(self, contribs, x_var, y_var):
+        """
+        Adds a chunk of contributions (bias column is ignored) of candidates
+        with bin variables x_var and y_var
+        """
+        phi = np.abs(contribs[:, :len(self.features)]).astype(np.float64)
+        self.n += len(phi)
+        self.sum_abs += phi.sum(axis=0)
+        self.sum_abs2 += (phi**2).sum(axis=0)
+        self.sum += contribs[:, :len(self.features)].sum(axis=0)
+
+        n_x = len(self.x_edges) - 1
+        x_bin = np.searchsorted(self.x_edges, x_var, side='right') - 1
+        y_bin = np.searchsorted(self.y_edges, y_var, side='right') - 1
+        inside = (x_bin >= 0) & (x_bin < n_x) & (y_bin >= 0) & (y_bin < len(self.y_edges) - 1)
+        flat_bin = (y_bin * n_x + x_bin)[inside]
+        self.bin_n += np.bincount(flat_bin, minlength=len(self.bin_n))
+        for i in range(len(self.features)):
+            self.bin_sum_abs[i] += np.bincount(flat_bin, weights=phi[inside, i], minlength=len(self.bin_n))
+
+    def merge(self, other):
+        for name in ('n', 'sum_abs', 'sum_abs2', 'sum', 'bin_n', 'bin_sum_abs'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return self
+
+    def mean_abs(self):
+        return self.sum_abs / max(self.n, 1)
+
+    def relative_error(self):
+        """
+        Relative standard error of mean |contribution| per feature
+        """
+        n = max(self.n, 2)
+        mean = self.sum_abs / n
+        var = np.maximum(self.sum_abs2 / n - mean**2, 0) * n / (n - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(mean > 0, np.sqrt(var / n) / mean, 0.0)
+
+    def bin_mean_abs(self):
+        """
+        (n_features, n_y_bins, n_x_bins) mean |contribution| per (pT, rapidity) bin, nan for empty bins
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = self.bin_sum_abs / self.bin_n
+        return mean.reshape(len(self.features), len(self.y_edges) - 1, len(self.x_edges) - 1)
+
+    def as_dict(self):
+        return {
+            'candidates': int(self.n),
+            'features': self.features,
+            'mean_abs': dict(zip(self.features, self.mean_abs().tolist())),
+            'mean': dict(zip(self.features, (self.sum / max(self.n, 1)).tolist())),
+            'relative_error': dict(zip(self.features, self.relative_error().tolist())),
+            'x_edges': self.x_edges.tolist(),
+            'y_edges': self.y_edges.tolist(),
+            'bin_candidates': self.bin_n.reshape(len(self.y_edges) - 1, len(self.x_edges) - 1).tolist(),
+            'bin_mean_abs': {feature: np.where(np.isnan(values), None, values).tolist()
+                             for feature, values in zip(self.features, self.bin_mean_abs())},
+        }
+
+
+@profiled(rows=lambda res, booster, x, *args, **kwargs: res.n)
+def explain(booster, x, x_var, y_var, features, x_edges, y_edges, precision=None, chunk_size=50000,
+            min_fraction=0.01, seed=0, nthread=None):
+    """
+    Aggregates TreeSHAP contributions per feature and per (rapidity, pT) bin
+
+    Parameters
+    ------------------------------------------------
+    booster: xgboost.Booster or XGBClassifier
+        trained model
+    x: np.ndarray or pandas.DataFrame
+        features of the candidates in training order, converted chunk by chunk
+    x_var, y_var: array
+        rapidity and pT of the candidates (bin variables)
+    features: list of str
+        model features
+    x_edges, y_edges: np.ndarray
+        rapidity and pT bin edges
+    precision: float
+        sampling mode: candidates are explained in random chunks until the
+        relative standard error of mean |contribution| of every feature with
+        at least min_fraction of the total attribution is below precision.
+        All candidates are explained if None
+    chunk_size: int
+        candidates per TreeSHAP call
+    seed: int
+        seed of the sampling order
+
+    Returns
+    -------
+    ShapSummary
+    """
+    x_var = np.asarray(x_var)
+    y_var = np.asarray(y_var)
+    summary = ShapSummary(features, x_edges, y_edges)
+
+    if precision is None:
+        order = None
+    else:
+        order = np.random.default_rng(seed).permutation(len(x))
+        # small first chunk, so easy cases stop early
+        chunk_size = min(chunk_size, max(1000, len(x) // 100))
+
+    chunks = shap_chunks(booster, x, chunk_size, nthread, features, order)
+    for rows, contribs in zip(_chunk_rows(len(x), chunk_size, order), chunks):
+        summary.fill(contribs, x_var[rows], y_var[rows])
+
+        if precision is not None:
+            mean_abs = summary.mean_abs()
+            relevant = mean_abs >= min_fraction * mean_abs.sum()
+            if summary.n >= 1000 and np.all(summary.relative_error()[relevant] < precision):
+                break
+
+    return summary
+
+
+@profiled()
+def plot_shap(summary, output_path, top=4):
+    """
+    Bar chart of mean |SHAP| per feature (shap_importance.png) and
+    (rapidity, pT) maps of the top features (shap_pt_rap.png)
+    """
+    import matplotlib.pyplot as plt
+
+    mean_abs = summary.mean_abs()
+    order = np.argsort(mean_abs)
+
+    fig, ax = plt.subplots(figsize=(8, 0.5 * len(order) + 1.5))
+    ax.barh(np.array(summary.features)[order], mean_abs[order],
+            xerr=(mean_abs * summary.relative_error())[order], color='tab:blue')
+    ax.set_xlabel('mean |SHAP value| (log-odds)', fontsize=15)
+    ax.tick_params(axis='both', labelsize=13)
+    fig.tight_layout()
+    fig.savefig(os.path.join(output_path, 'shap_importance.png'))
+    plt.close(fig)
+
+    top_features = order[::-1][:top]
+    bin_mean = summary.bin_mean_abs()
+    fig, axs = plt.subplots(1, len(top_features), figsize=(5 * len(top_features), 4.5), squeeze=False)
+    for ax, i in zip(axs[0], top_features):
+        mesh = ax.pcolormesh(summary.x_edges, summary.y_edges, np.ma.masked_invalid(bin_mean[i]),
+                             cmap='viridis', rasterized=True)
+        fig.colorbar(mesh, ax=ax)
+        ax.set_title(summary.features[i], fontsize=14)
+        ax.set_xlabel('rapidity', fontsize=13)
+        ax.set_ylabel('$p_T$, GeV/c', fontsize=13)
+    fig.tight_layout()
+    fig.savefig(os.path.join(output_path, 'shap_pt_rap.png'))
+    plt.close(fig)
+
+
+def write_summary(summary, output_path, file_name='shap_summary.json'):
+    os.makedirs(output_path, exist_ok=True)
+    file_name = os.path.join(output_path, file_name)
+    with open(file_name, 'w', encoding="utf-8") as out_file:
+        json.dump(summary.as_dict(), out_file, indent=2)
+    return file_name
@@ -0,0 +1,149 @@
+import os
+from abc import ABC, abstractmethod
+
+import numpy as np
+import pandas as pd
+
+from cand_class.lazy import lazy_import
+from cand_class.model_io import booster_features, load_booster
+
+xgb = lazy_import('xgboost')
+
+
+class Backend(ABC):
+    """
+    One way of evaluating a trained model. predict takes a float32 matrix with
+    the model features in training order and returns signal probabilities
+    """
+
+    name = None
+
+    @abstractmethod
+    def predict(self, x):
+        pass
+
+
+class ModelHandlerBackend(Backend):
+    """
+    hipe4ml ModelHandler.predict, the path used by XGBmodel.train_test_pred
+    """
+
+    name = 'model_handler'
+
+    def __init__(self, booster, features, nthread):
+        from hipe4ml.model_handler import ModelHandler
+
+        model = xgb.XGBClassifier(n_jobs=nthread)
+        model.load_model(bytearray(booster.save_raw()))
+        self.features = features
+        self.model_hdl = ModelHandler(model, features)
+
+    def predict(self, x):
+        return self.model_hdl.predict(pd.DataFrame(x, columns=self.features), output_margin=False)
+
+
+class BoosterBackend(Backend):
+    """
+    Native xgboost Booster.inplace_predict, no DMatrix construction
+    """
+
+    name = 'booster_inplace'
+
+    def __init__(self, booster, nthread):
+        self.booster = booster.copy()
+        self.booster.set_param({'nthread': nthread})
+
+    def predict(self, x):
+        return self.booster.inplace_predict(x)
+
+
+class NumpyBackend(Backend):
+    """
+    Pure-NumPy level-synchronous traversal of the flattened trees
+    (tree_eval.FlatForest), the fallback where no compiler is available.
+    NumPy runs it in a single thread, nthread is ignored. forest is e.g. the
+    memory-mapped forest of a model artifact (artifact.ModelArtifact.forest)
+    """
+
+    name = 'numpy'
+
+    def __init__(self, booster, forest=None):
+        from cand_class.tree_eval import FlatForest
+
+        self.forest = forest if forest is not None else FlatForest.from_booster(booster)
+
+    def predict(self, x):
+        return self.forest.predict(x)
+
+
+class TreeliteBackend(Backend):
+    """
+    Compiled treelite library written by helper.save_model_lib, run through
+    treelite_runtime (treelite < 3.1) or tl2cgen (treelite >= 3.1)
+    """
+
+    name = 'treelite'
+
+    def __init__(self, lib_path, nthread):
+        try:
+            import treelite_runtime as runtime
+        except ImportError:
+            import tl2cgen as runtime
+        self.runtime = runtime
+        self.predictor = runtime.Predictor(lib_path, nthread=nthread)
+
+    def predict(self, x):
+        return np.asarray(self.predictor.predict(self.runtime.DMatrix(x))).reshape(-1)
+
+
+def _artifact_forest(model_file):
+    from cand_class.artifact import ModelArtifact, is_artifact
+
+    if is_artifact(model_file) and os.path.isdir(os.path.join(str(model_file), 'forest')):
+        return ModelArtifact.load(model_file).forest()
+    return None
+
+
+def load_backends(model_file, lib_path=None, nthread=1, features=None, names=None):
+    """
+    Loads one trained model into every available backend
+
+    Parameters
+    ------------------------------------------------
+    model_file: str
+        trained model, see model_io.load_booster
+    lib_path: str
+        compiled treelite library (xgb_model.so from helper.save_model_lib),
+        the treelite backend is skipped if not given
+    nthread: int
+        threads per backend
+    features: list of str
+        train variables if they are not stored in the model
+    names: list of str
+        backends to load, all available by default
+
+    Returns
+    -------
+    dict name -> Backend and the list of model features
+    """
+    booster = load_booster(model_file)
+    features = booster_features(booster, features)
+
+    factories = {
+        'model_handler': lambda: ModelHandlerBackend(booster, features, nthread),
+        'booster_inplace': lambda: BoosterBackend(booster, nthread),
+        'numpy': lambda: NumpyBackend(booster, _artifact_forest(model_file)),
+    }
+    if lib_path is not None:
+        factories['treelite'] = lambda: TreeliteBackend(lib_path, nthread)
+
+    backends = {}
+    for name, factory in factories.items():
+        if names is not None and name not in names:
+            continue
+        try:
+            backends[name] = factory()
+        except ImportError as error:
+            print('Backend '+name+' is not available: '+str(error))
+
+    return backends, features
@@ -0,0 +1,371 @@
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import uproot
+
+from cand_class.concurrency import get_budget
+from cand_class.config_reader import read_binning
+from cand_class.features import feature_matrix, required_branches
+from cand_class.loader import ChunkLoader
+from cand_class.model_io import booster_features, load_booster
+from cand_class.profiling import profiled
+from cand_class.scoring import shard_files
+
+
+def make_manifest(files, n_jobs, model_file, tree_name, binning_file, threshold, output_path,
+                  sample='test', label='issignal', step_size=100000):
+    """
+    Splits input files into n_jobs reproducible job specs for the evaluation
+    stage. Files are sorted before splitting, so the same file list always
+    gives the same jobs. Writes output_path/manifest.json and one
+    output_path/jobs/job_NNNN.json per job
+
+    Parameters
+    ------------------------------------------------
+    files: list of str
+        input ROOT files with signal and background candidates
+    n_jobs: int
+        number of batch jobs
+    model_file: str
+        trained model, see model_io.load_booster
+    tree_name: str
+        name of the candidate tree
+    binning_file: str
+        toml file with fixed binning, see config_reader.read_binning
+    threshold: float
+        BDT cut used for the after-ML-cut histograms
+    output_path: str
+        directory for specs, partial results and the reduced output
+    sample: str
+        dataset name used in hists.root ('train' or 'test')
+    label: str
+        branch with the signal label (1 signal, 0 background)
+    step_size: int
+        number of candidates processed at once by a job
+
+    Returns
+    -------
+    path of the manifest file
+    """
+    binning = read_binning(binning_file)
+    jobs_dir = os.path.join(output_path, 'jobs')
+    partials_dir = os.path.join(output_path, 'partials')
+    os.makedirs(jobs_dir, exist_ok=True)
+    os.makedirs(partials_dir, exist_ok=True)
+
+    job_files = []
+    for job_id, job_inputs in enumerate(shard_files(sorted(files), n_jobs)):
+        spec = {
+            'job_id': job_id,
+            'files': job_inputs,
+            'tree': tree_name,
+            'model': os.path.abspath(model_file),
+            'binning': binning,
+            'threshold': float(threshold),
+            'sample': sample,
+            'label': label,
+            'step_size': int(step_size),
+            'partial': os.path.abspath(os.path.join(partials_dir, 'job_%04d.npz' % job_id)),
+        }
+        job_file = os.path.join(jobs_dir, 'job_%04d.json' % job_id)
+        with open(job_file, 'w', encoding="utf-8") as out_file:
+            json.dump(spec, out_file, indent=2)
+        job_files.append(os.path.abspath(job_file))
+
+    manifest = {'jobs': job_files, 'binning': binning, 'threshold': float(threshold), 'sample': sample}
+    manifest_file = os.path.join(output_path, 'manifest.json')
+    with open(manifest_file, 'w', encoding="utf-8") as out_file:
+        json.dump(manifest, out_file, indent=2)
+
+    return manifest_file
+
+
+class PartialResult:
+    """
+    Mergeable evaluation results of one job: fixed-binning histograms of the
+    variables before and after the ML cut, score counts per class, the pT-rapidity
+    histograms and correlation co-moments (n, sum x, sum x x^T) per class
+    """
+
+    classes = ('signal', 'background')
+
+    def __init__(self, binning):
+        self.binning = binning
+        self.variables = list(binning['variables'])
+        self.arrays = {}
+
+        n_vars = len(self.variables)
+        for cls in self.classes:
+            self.arrays[cls+'/score'] = np.zeros(binning['score_bins'], dtype=np.int64)
+            self.arrays[cls+'/n'] = np.zeros(1, dtype=np.int64)
+            self.arrays[cls+'/sum'] = np.zeros(n_vars)
+            self.arrays[cls+'/sum2'] = np.zeros((n_vars, n_vars))
+            for var in self.variables:
+                for stage in ('before', 'after'):
+                    self.arrays[cls+'/'+stage+'/'+var] = np.zeros(binning['variables'][var]['bins'], dtype=np.int64)
+            if 'pt_rap' in binning:
+                n_bins = binning['pt_rap']['bins']
+                for stage in ('before', 'after'):
+                    self.arrays[cls+'/pt_rap/'+stage] = np.zeros((n_bins, n_bins), dtype=np.int64)
+
+    def edges(self, var):
+        var_binning = self.binning['variables'][var]
+        return np.linspace(var_binning['range'][0], var_binning['range'][1], var_binning['bins'] + 1)
+
+    def fill(self, chunk, scores, label, threshold):
+        score_edges = np.linspace(0, 1, self.binning['score_bins'] + 1)
+        is_signal = chunk[label].to_numpy() == 1
+        passed = scores > threshold
+
+        for cls, mask in zip(self.classes, (is_signal, ~is_signal)):
+            self.arrays[cls+'/score'] += np.histogram(scores[mask], bins=score_edges)[0]
+
+            values = np.column_stack([chunk[var].to_numpy(dtype=np.float64)[mask] for var in self.variables])
+            finite = values[np.isfinite(values).all(axis=1)]
+            self.arrays[cls+'/n'] += len(finite)
+            self.arrays[cls+'/sum'] += finite.sum(axis=0)
+            self.arrays[cls+'/sum2'] += finite.T @ finite
+
+            for i, var in enumerate(self.variables):
+                edges = self.edges(var)
+                self.arrays[cls+'/before/'+var] += np.histogram(values[:, i], bins=edges)[0]
+                self.arrays[cls+'/after/'+var] += np.histogram(values[passed[mask], i], bins=edges)[0]
+
+            if 'pt_rap' in self.binning:
+                pt_rap = self.binning['pt_rap']
+                pt = chunk[pt_rap['labels'][0]].to_numpy()[mask]
+                rap = chunk[pt_rap['labels'][1]].to_numpy()[mask]
+                hist_range = [pt_rap['x_range'], pt_rap['y_range']]
+                for stage, sel in (('before', slice(None)), ('after', passed[mask])):
+                    self.arrays[cls+'/pt_rap/'+stage] += np.histogram2d(rap[sel], pt[sel], bins=pt_rap['bins'],
+                                                                       range=hist_range)[0].astype(np.int64)
+
+    def merge(self, other):
+        for key, value in other.arrays.items():
+            self.arrays[key] += value
+
+    def save(self, file_name):
+        np.savez(file_name, binning=json.dumps(self.binning), **self.arrays)
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as data:
+            partial = cls(json.loads(str(data['binning'])))
+            for key in partial.arrays:
+                partial.arrays[key] = data[key]
+        return partial
+
+
+@profiled()
+def run_job(job_file):
+    """
+    Runs one evaluation job: scores the job files in chunks and saves the
+    mergeable partial result to the path given in the spec
+    """
+    with open(job_file, encoding="utf-8") as inp_file:
+        spec = json.load(inp_file)
+
+    booster = load_booster(spec['model'])
+    booster.set_param({'nthread': get_budget().inner})
+    features = booster_features(booster)
+    binning = spec['binning']
+
+    extra = list(binning['variables']) + [spec['label']]
+    if 'pt_rap' in binning:
+        extra += binning['pt_rap']['labels']
+    branches = required_branches(features, extra)
+
+    partial = PartialResult(binning)
+    for _, chunk in ChunkLoader(spec['files'], spec['tree'], branches, spec['step_size']):
+        scores = np.asarray(booster.inplace_predict(feature_matrix(chunk, features)))
+        partial.fill(chunk, scores, spec['label'], spec['threshold'])
+
+    partial.save(spec['partial'])
+    return spec['partial']
+
+
+def run_local(manifest_file, n_workers=2):
+    """
+    Runs all jobs of a manifest as local subprocesses (stand-ins for batch
+    nodes), at most n_workers at a time. The cores of the thread budget are
+    split between the concurrent jobs, every job gets total_cores // n_workers
+    through a concurrency toml next to the manifest
+    """
+    with open(manifest_file, encoding="utf-8") as inp_file:
+        manifest = json.load(inp_file)
+
+    budget = get_budget()
+    output_path = os.path.dirname(os.path.abspath(manifest_file))
+    job_cores = max(1, budget.total_cores // n_workers)
+    concurrency_file = os.path.join(output_path, 'job_concurrency.toml')
+    with open(concurrency_file, 'w', encoding="utf-8") as out_file:
+        out_file.write('[concurrency]\ntotal_cores = %d\nouter = 1\nblas_threads = %d\n'
+                       % (job_cores, budget.blas_threads))
+    budget.record(output_path, 'run_local', workers=n_workers, nthread=job_cores)
+
+    command = [sys.executable, '-m', 'cand_class', '--concurrency', concurrency_file, 'run-job']
+    pending = list(manifest['jobs'])
+    running = []
+    failed = []
+    while pending or running:
+        while pending and len(running) < n_workers:
+            job_file = pending.pop(0)
+            running.append((job_file, subprocess.Popen(command + [job_file])))
+        job_file, proc = running.pop(0)
+        if proc.wait() != 0:
+            failed.append(job_file)
+
+    if failed:
+        raise RuntimeError('Failed jobs: '+', '.join(failed))
+
+
+def correlation_from_moments(n, sums, sums2):
+    """
+    Pearson correlation matrix and its standard errors from merged co-moments
+    """
+    mean = sums / n
+    cov = sums2 / n - np.outer(mean, mean)
+    sigma = np.sqrt(np.diag(cov))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = cov / np.outer(sigma, sigma)
+        error = (1 - corr**2) / np.sqrt(n - 1)
+    return corr, error
+
+
+@profiled()
+def reduce_partials(manifest_file, output_path=None):
+    """
+    Merges the partial results of all jobs in job order and writes the final
+    hists.root (same layout as HistBuilder), roc/threshold summary and plots
+
+    Returns
+    -------
+    merged PartialResult
+    """
+    with open(manifest_file, encoding="utf-8") as inp_file:
+        manifest = json.load(inp_file)
+    output_path = output_path or os.path.dirname(os.path.abspath(manifest_file))
+
+    merged = None
+    for job_file in sorted(manifest['jobs']):
+        with open(job_file, encoding="utf-8") as inp_file:
+            partial = PartialResult.load(json.load(inp_file)['partial'])
+        if merged is None:
+            merged = partial
+        else:
+            merged.merge(partial)
+
+    _write_root(merged, manifest['sample'], os.path.join(output_path, 'hists.root'))
+    summary = _score_summary(merged)
+    with open(os.path.join(output_path, 'reduce_summary.json'), 'w', encoding="utf-8") as out_file:
+        json.dump(summary, out_file, indent=2)
+    _plot(merged, summary, manifest['sample'], output_path)
+
+    return merged
+
+
+def _write_root(merged, sample, file_name):
+    arrays = merged.arrays
+    with uproot.recreate(file_name) as out_file:
+        for var in merged.variables:
+            edges = merged.edges(var)
+            sig_dir = 'Signal/'+sample+'/hists/'
+            bgr_dir = 'Background/'+sample+'/hists/'
+            out_file[sig_dir+'signal before ML '+var] = (arrays['signal/before/'+var], edges)
+            out_file[sig_dir+'signal after ML '+var] = (arrays['signal/after/'+var], edges)
+            out_file[sig_dir+'signal difference '+var] = (arrays['signal/before/'+var] - arrays['signal/after/'+var], edges)
+            out_file[bgr_dir+'background before ML '+var] = (arrays['background/before/'+var], edges)
+            out_file[bgr_dir+'background after ML '+var] = (arrays['background/after/'+var], edges)
+
+        if 'pt_rap' in merged.binning:
+            pt_rap = merged.binning['pt_rap']
+            x_edges = np.linspace(pt_rap['x_range'][0], pt_rap['x_range'][1], pt_rap['bins'] + 1)
+            y_edges = np.linspace(pt_rap['y_range'][0], pt_rap['y_range'][1], pt_rap['bins'] + 1)
+            for cls, label in (('signal', 'Signal'), ('background', 'Background')):
+                before = arrays[cls+'/pt_rap/before']
+                after = arrays[cls+'/pt_rap/after']
+                pt_dir = label+'/'+sample+'/pt_rap/'
+                out_file[pt_dir+'pT_rap_before_ML'+sample] = (before, x_edges, y_edges)
+                out_file[pt_dir+'pT_rap_after_ML_'+sample] = (after, x_edges, y_edges)
+                out_file[pt_dir+'pT_rap_diff_'+sample] = (before - after, x_edges, y_edges)
+
+
+def _score_summary(merged):
+    sig = merged.arrays['signal/score']
+    bgr = merged.arrays['background/score']
+    edges = np.linspace(0, 1, len(sig) + 1)
+
+    # efficiencies for a cut score > edge, edge running over the lower bin edges
+    tpr = np.cumsum(sig[::-1])[::-1] / max(sig.sum(), 1)
+    fpr = np.cumsum(bgr[::-1])[::-1] / max(bgr.sum(), 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ams = np.sqrt(2 * ((tpr + fpr) * np.log(1 + tpr/fpr) - tpr))
+    ams[~np.isfinite(ams)] = -np.inf
+    best = int(np.argmax(ams))
+
+    roc_fpr = np.append(fpr, 0)
+    roc_tpr = np.append(tpr, 0)
+    auc = float(np.sum((roc_fpr[:-1] - roc_fpr[1:]) * (roc_tpr[:-1] + roc_tpr[1:]) / 2))
+
+    return {'auc': auc, 'ams_best_threshold': float(edges[best]), 'ams_max': float(ams[best]),
+            'signal': int(sig.sum()), 'background': int(bgr.sum()),
+            'fpr': roc_fpr.tolist(), 'tpr': roc_tpr.tolist()}
+
+
+def _plot(merged, summary, sample, output_path):
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    fig, ax = plt.subplots(figsize=(8, 6))
+    ax.plot(summary['fpr'], summary['tpr'], label='AUC = %.4f' % summary['auc'])
+    ax.set_xlabel('FPR', fontsize=15)
+    ax.set_ylabel('TPR', fontsize=15)
+    ax.legend(fontsize=15)
+    fig.tight_layout()
+    fig.savefig(os.path.join(output_path, 'roc_curve.png'))
+    plt.close(fig)
+
+    fig, ax = plt.subplots(figsize=(12, 8))
+    score_edges = np.linspace(0, 1, merged.binning['score_bins'] + 1)
+    ax.stairs(merged.arrays['background/score'], score_edges, color='red', label='Background in predictions')
+    ax.stairs(merged.arrays['signal/score'], score_edges, color='blue', label='Signal in predictions')
+    ax.axvline(summary['ams_best_threshold'], color='black', linestyle='--')
+    ax.set_yscale('log')
+    ax.set_xlabel('Probability', fontsize=18)
+    ax.set_ylabel('Counts', fontsize=18)
+    ax.legend(fontsize=18)
+    fig.tight_layout()
+    fig.savefig(os.path.join(output_path, 'test_best_pred.png'))
+    plt.close(fig)
+
+    for cls in merged.classes:
+        corr, _ = correlation_from_moments(merged.arrays[cls+'/n'][0], merged.arrays[cls+'/sum'],
+                                           merged.arrays[cls+'/sum2'])
+        fig, ax = plt.subplots(figsize=(10, 8))
+        image = ax.imshow(corr, vmin=-1, vmax=1, cmap='coolwarm')
+        ax.set_xticks(range(len(merged.variables)))
+        ax.set_xticklabels(merged.variables, rotation=70)
+        ax.set_yticks(range(len(merged.variables)))
+        ax.set_yticklabels(merged.variables)
+        fig.colorbar(image)
+        fig.tight_layout()
+        fig.savefig(os.path.join(output_path, 'corr_matrix_'+('sign' if cls == 'signal' else 'bgr')+'.png'))
+        plt.close(fig)
+
+    pdf_key = PdfPages(os.path.join(output_path, 'hists_'+sample+'.pdf'))
+    for var in merged.variables:
+        edges = merged.edges(var)
+        fig, ax = plt.subplots(2, figsize=(15, 10))
+        for i, stage in enumerate(('before', 'after')):
+            ax[i].stairs(merged.arrays['signal/'+stage+'/'+var], edges, color='blue', label='signal')
+            ax[i].stairs(merged.arrays['background/'+stage+'/'+var], edges, color='red', label='background')
+            ax[i].set_title(var+' MC '+sample+' '+stage+' ML cut', fontsize=25)
+            ax[i].set_yscale('log')
+            ax[i].legend(fontsize=15)
+        fig.tight_layout()
+        pdf_key.savefig(fig)
+        plt.close(fig)
+    pdf_key.close()
@@ -0,0 +1,207 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from cand_class.concurrency import get_budget
+from cand_class.features import feature_matrix
+from cand_class.lazy import lazy_import
+from cand_class.model_io import native_params
+from cand_class.profiling import profiled
+
+xgb = lazy_import('xgboost')
+
+
+def assign_bins(pt, rapidity, pt_edges, y_edges):
+    """
+    Flat (pT, rapidity) bin index of every candidate, pt_bin * n_y_bins + y_bin,
+    -1 outside the edges
+    """
+    n_y = len(y_edges) - 1
+    pt_bin = np.searchsorted(pt_edges, pt, side='right') - 1
+    y_bin = np.searchsorted(y_edges, rapidity, side='right') - 1
+    inside = (pt_bin >= 0) & (pt_bin < len(pt_edges) - 1) & (y_bin >= 0) & (y_bin < n_y)
+    return np.where(inside, pt_bin * n_y + y_bin, -1)
+
+
+def split_by_bin(bins):
+    """
+    Returns {bin: row indices} with a single stable sort instead of one mask per bin
+    """
+    order = np.argsort(bins, kind='stable')
+    values, starts = np.unique(bins[order], return_index=True)
+    return dict(zip(values.tolist(), np.split(order, starts[1:])))
+
+
+class ModelBundle:
+    """
+    Per-(pT, rapidity)-bin models and a fallback model for bins without their
+    own model, with a vectorized router
+
+    Parameters
+    ------------------------------------------------
+    models: dict
+        flat bin index -> xgboost.Booster
+    fallback: xgboost.Booster
+        model for candidates in bins without a model or outside the edges
+    features: list of str
+        model features in training order
+    pt_edges, y_edges: list of float
+        bin edges
+    pt_var, rap_var: str
+        names of the pT and rapidity branches
+    """
+
+    def __init__(self, models, fallback, features, pt_edges, y_edges, pt_var='pT', rap_var='rapidity'):
+        self.models = models
+        self.fallback = fallback
+        self.features = list(features)
+        self.pt_edges = np.asarray(pt_edges, dtype=np.float64)
+        self.y_edges = np.asarray(y_edges, dtype=np.float64)
+        self.pt_var = pt_var
+        self.rap_var = rap_var
+
+    def set_nthread(self, nthread):
+        for booster in list(self.models.values()) + [self.fallback]:
+            booster.set_param({'nthread': nthread})
+
+    def predict(self, x, pt, rapidity):
+        """
+        Scores a chunk: candidates are grouped by bin with one sort and every
+        group is scored by its model in one call
+
+        Parameters
+        ------------------------------------------------
+        x: np.ndarray
+            features in training order
+        pt, rapidity: array
+            bin variables of the candidates
+        """
+        x = np.asarray(x, dtype=np.float32)
+        bins = assign_bins(np.asarray(pt), np.asarray(rapidity), self.pt_edges, self.y_edges)
+        scores = np.empty(len(x), dtype=np.float32)
+        fallback_rows = []
+        for bin_id, rows in split_by_bin(bins).items():
+            booster = self.models.get(bin_id)
+            if booster is None:
+                fallback_rows.append(rows)
+            else:
+                scores[rows] = booster.inplace_predict(x[rows])
+        if fallback_rows:
+            rows = np.concatenate(fallback_rows)
+            scores[rows] = self.fallback.inplace_predict(x[rows])
+        return scores
+
+    def predict_df(self, df):
+        """
+        Scores a DataFrame with either the model features or the raw branches
+        (see features.feature_matrix) and the pT and rapidity branches
+        """
+        if all(feature in df.columns for feature in self.features):
+            x = df[self.features].to_numpy(dtype=np.float32)
+        else:
+            x = feature_matrix(df, self.features)
+        return self.predict(x, df[self.pt_var].to_numpy(), df[self.rap_var].to_numpy())
+
+    def save(self, output_path):
+        """
+        Writes bundle.json and one XGBoost JSON model per bin to output_path
+        """
+        os.makedirs(output_path, exist_ok=True)
+        files = {}
+        for bin_id, booster in self.models.items():
+            files[str(bin_id)] = 'model_bin_%04d.json' % bin_id
+            booster.save_model(os.path.join(output_path, files[str(bin_id)]))
+        self.fallback.save_model(os.path.join(output_path, 'model_fallback.json'))
+
+        spec = {'features': self.features, 'pt_var': self.pt_var, 'rap_var': self.rap_var,
+                'pt_edges': self.pt_edges.tolist(), 'y_edges': self.y_edges.tolist(),
+                'models': files, 'fallback': 'model_fallback.json'}
+        with open(os.path.join(output_path, 'bundle.json'), 'w', encoding="utf-8") as out_file:
+            json.dump(spec, out_file, indent=2)
+        return output_path
+
+    @classmethod
+    def load(cls, path, nthread=None):
+        with open(os.path.join(path, 'bundle.json'), encoding="utf-8") as inp_file:
+            spec = json.load(inp_file)
+
+        def read(file_name):
+            booster = xgb.Booster()
+            booster.load_model(os.path.join(path, file_name))
+            return booster
+
+        bundle = cls({int(bin_id): read(file_name) for bin_id, file_name in spec['models'].items()},
+                     read(spec['fallback']), spec['features'], spec['pt_edges'], spec['y_edges'],
+                     spec['pt_var'], spec['rap_var'])
+        if nthread is not None:
+            bundle.set_nthread(nthread)
+        return bundle
+
+
+def _train_one(x, y, params, num_boost_round, features, nthread):
+    params = {key: value for key, value in params.items() if key != 'n_jobs'}
+    params['nthread'] = nthread
+    return xgb.train(params, xgb.DMatrix(x, label=y, feature_names=features), num_boost_round=num_boost_round)
+
+
+@profiled(rows=lambda res, df, *args, **kwargs: len(df))
+def train_binned(df, features, pt_edges, y_edges, model_params=None, label='issignal', pt_var='pT',
+                 rap_var='rapidity', min_candidates=1000, n_workers=None, output_path=None):
+    """
+    Trains one model per (pT, rapidity) bin plus a fallback model on all
+    candidates, concurrently on threads under the package thread budget:
+    n_workers models are trained at the same time with total_cores // n_workers
+    XGBoost threads each
+
+    Parameters
+    ------------------------------------------------
+    df: pandas.DataFrame
+        training candidates with the (log transformed) features, label, pT and rapidity
+    features: list of str
+        train variables
+    pt_edges, y_edges: list of float
+        pT and rapidity bin edges
+    model_params: dict
+        XGBClassifier parameters, e.g. ModelHandler.get_model_params() after XGBmodel.modelBO
+    label: str
+        label column, 1 for signal
+    min_candidates: int
+        bins with fewer candidates or only one class use the fallback model
+    n_workers: int
+        models trained at once, by default min(number of models, total cores)
+    output_path: str
+        if set, the bundle is saved there
+
+    Returns
+    -------
+    ModelBundle
+    """
+    params, num_boost_round = native_params(model_params or {})
+    x = df[features].to_numpy(dtype=np.float32)
+    y = df[label].to_numpy()
+    groups = split_by_bin(assign_bins(df[pt_var].to_numpy(), df[rap_var].to_numpy(), pt_edges, y_edges))
+
+    trainable = {bin_id: rows for bin_id, rows in groups.items()
+                 if bin_id >= 0 and len(rows) >= min_candidates and len(np.unique(y[rows])) == 2}
+    jobs = [(None, slice(None))] + sorted(trainable.items())
+    # largest bins first, so the pool does not end on a long job
+    jobs.sort(key=lambda job: -(len(x) if job[0] is None else len(job[1])))
+
+    budget = get_budget()
+    n_workers = max(1, min(n_workers or budget.total_cores, len(jobs)))
+    nthread = max(1, budget.total_cores // n_workers)
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {bin_id: pool.submit(_train_one, x[rows], y[rows], params, num_boost_round, features, nthread)
+                   for bin_id, rows in jobs}
+        boosters = {bin_id: future.result() for bin_id, future in futures.items()}
+
+    fallback = boosters.pop(None)
+    bundle = ModelBundle(boosters, fallback, features, pt_edges, y_edges, pt_var, rap_var)
+    print('Trained '+str(len(boosters))+' bin models and a fallback model on '+str(n_workers)+' workers')
+
+    if output_path is not None:
+        bundle.save(output_path)
+        budget.record(output_path, 'train_binned', workers=n_workers, nthread=nthread, models=len(jobs))
+    return bundle
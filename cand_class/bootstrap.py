@@ -0,0 +1,182 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from cand_class.concurrency import get_budget
+from cand_class.profiling import profiled
+
+
+def score_edges(scores, bins=2000):
+    """
+    Quantile bin edges of the pooled scores, so the resolution of the cut
+    follows the candidates (BDT scores pile up close to 0 and 1)
+    """
+    edges = np.unique(np.quantile(np.asarray(scores, dtype=np.float64), np.linspace(0, 1, bins + 1)))
+    if len(edges) < 2:
+        edges = np.array([edges[0], edges[0] + 1e-12])
+    return edges
+
+
+def logit_edges(bins=10000, limit=17.):
+    """
+    Fixed score bin edges in [0, 1], uniform in logit(score) between -limit
+    and limit, so the bins get narrow where BDT scores pile up close to 0 and
+    1 (limit 17 covers float32 probabilities) without looking at the data
+    """
+    inner = 1 / (1 + np.exp(-np.linspace(-limit, limit, max(1, bins - 1))))
+    return np.concatenate([[0.], inner, [1.]])
+
+
+def score_histograms(scores, labels, edges):
+    """
+    Signal and background score histograms
+    """
+    scores = np.asarray(scores)
+    labels = np.asarray(labels)
+    sig = np.histogram(scores[labels == 1], bins=edges)[0].astype(np.float64)
+    bgr = np.histogram(scores[labels == 0], bins=edges)[0].astype(np.float64)
+    return sig, bgr
+
+
+def metrics_from_histograms(sig, bgr, edges, threshold=None):
+    """
+    AUC, AMS-optimal cut and efficiencies of one or many replicas at once
+
+    Parameters
+    ------------------------------------------------
+    sig, bgr: np.ndarray
+        (n_replicas, n_bins) or (n_bins,) signal and background counts
+    edges: np.ndarray
+        score bin edges, a cut at edges[i] keeps the bins >= i
+    threshold: float
+        fixed BDT cut for the 'signal_efficiency_at_threshold' and
+        'background_efficiency_at_threshold' metrics
+
+    Returns
+    -------
+    dict metric -> np.ndarray (n_replicas,)
+    """
+    sig = np.atleast_2d(sig)
+    bgr = np.atleast_2d(bgr)
+
+    tpr = np.cumsum(sig[:, ::-1], axis=1)[:, ::-1] / np.maximum(sig.sum(axis=1, keepdims=True), 1)
+    fpr = np.cumsum(bgr[:, ::-1], axis=1)[:, ::-1] / np.maximum(bgr.sum(axis=1, keepdims=True), 1)
+
+    # ROC points run from (1, 1) at the lowest cut to (0, 0) above the highest
+    roc_tpr = np.concatenate([tpr, np.zeros((len(tpr), 1))], axis=1)
+    roc_fpr = np.concatenate([fpr, np.zeros((len(fpr), 1))], axis=1)
+    auc = np.sum((roc_fpr[:, :-1] - roc_fpr[:, 1:]) * (roc_tpr[:, :-1] + roc_tpr[:, 1:]) / 2, axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ams = np.sqrt(2 * ((tpr + fpr) * np.log(1 + tpr/fpr) - tpr))
+    ams[~np.isfinite(ams)] = -np.inf
+    best = np.argmax(ams, axis=1)
+    rows = np.arange(len(best))
+
+    metrics = {
+        'auc': auc,
+        'ams': ams[rows, best],
+        'ams_threshold': np.asarray(edges)[best],
+        'signal_efficiency': tpr[rows, best],
+        'background_efficiency': fpr[rows, best],
+    }
+    if threshold is not None:
+        cut_bin = min(int(np.searchsorted(edges, threshold, side='right')), tpr.shape[1] - 1)
+        metrics['signal_efficiency_at_threshold'] = tpr[:, cut_bin]
+        metrics['background_efficiency_at_threshold'] = fpr[:, cut_bin]
+    return metrics
+
+
+def resample(sig, bgr, n_replicas, method='poisson', rng=None):
+    """
+    Bootstrap replicas of binned histograms as (n_replicas, n_bins) arrays.
+    'poisson': every candidate gets a Poisson(1) weight, i.e. each bin count
+    is Poisson distributed around the observed one. 'multinomial': the total
+    number of signal and background candidates is kept fixed
+    """
+    rng = rng or np.random.default_rng()
+    if method == 'poisson':
+        return (rng.poisson(sig, size=(n_replicas, len(sig))).astype(np.float64),
+                rng.poisson(bgr, size=(n_replicas, len(bgr))).astype(np.float64))
+    if method == 'multinomial':
+        return (rng.multinomial(int(sig.sum()), sig / max(sig.sum(), 1), size=n_replicas).astype(np.float64),
+                rng.multinomial(int(bgr.sum()), bgr / max(bgr.sum(), 1), size=n_replicas).astype(np.float64))
+    raise ValueError('Unknown resampling method '+str(method))
+
+
+@profiled(rows=lambda res, scores, *args, **kwargs: len(scores))
+def bootstrap(scores, labels, n_replicas=1000, bins=2000, method='poisson', threshold=None, cl=0.68,
+              chunk_size=250, n_workers=None, seed=0, output_path=None):
+    """
+    Bootstrap confidence intervals of AUC, AMS-optimal BDT cut and signal and
+    background efficiencies. Scores are binned once, replicas are drawn as
+    whole 2D arrays of bin counts and evaluated chunk by chunk on threads
+
+    Parameters
+    ------------------------------------------------
+    scores: array
+        BDT scores
+    labels: array
+        1 for signal, 0 for background
+    n_replicas: int
+        number of bootstrap replicas
+    bins: int
+        number of quantile bins of the scores
+    method: str
+        'poisson' or 'multinomial'
+    threshold: float
+        BDT cut used for the efficiencies at a fixed threshold (e.g. the one
+        chosen by helper.AMS)
+    cl: float
+        confidence level of the central intervals
+    chunk_size: int
+        replicas evaluated at once
+    n_workers: int
+        threads, defaults to the cores of the thread budget
+    seed: int
+        random seed, results do not depend on n_workers
+    output_path: str
+        if set, the intervals are written to output_path/bootstrap.json
+
+    Returns
+    -------
+    dict metric -> {'value', 'low', 'high', 'std'}
+    """
+    edges = score_edges(scores, bins)
+    sig, bgr = score_histograms(scores, labels, edges)
+    nominal = metrics_from_histograms(sig, bgr, edges, threshold)
+
+    chunks = [min(chunk_size, n_replicas - start) for start in range(0, n_replicas, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+
+    def run_chunk(size, chunk_seed):
+        rep_sig, rep_bgr = resample(sig, bgr, size, method, np.random.default_rng(chunk_seed))
+        return metrics_from_histograms(rep_sig, rep_bgr, edges, threshold)
+
+    with ThreadPoolExecutor(max_workers=n_workers or get_budget().total_cores) as pool:
+        results = list(pool.map(run_chunk, chunks, seeds))
+
+    tail = 100 * (1 - cl) / 2
+    intervals = {}
+    for metric, value in nominal.items():
+        replicas = np.concatenate([res[metric] for res in results])
+        replicas = replicas[np.isfinite(replicas)]
+        if len(replicas) == 0:
+            # e.g. no background candidates, the AMS is undefined
+            intervals[metric] = {'value': float('nan'), 'low': float('nan'), 'high': float('nan'),
+                                 'std': float('nan')}
+            continue
+        intervals[metric] = {'value': float(value[0]),
+                             'low': float(np.percentile(replicas, tail)),
+                             'high': float(np.percentile(replicas, 100 - tail)),
+                             'std': float(np.std(replicas))}
+
+    if output_path is not None:
+        os.makedirs(output_path, exist_ok=True)
+        with open(os.path.join(output_path, 'bootstrap.json'), 'w', encoding="utf-8") as out_file:
+            json.dump({'n_replicas': n_replicas, 'method': method, 'cl': cl, 'bins': len(edges) - 1,
+                       'metrics': intervals}, out_file, indent=2)
+
+    return intervals
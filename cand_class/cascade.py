@@ -0,0 +1,236 @@
+import json
+import os
+
+import numpy as np
+import tomli
+
+from cand_class.features import feature_matrix, required_branches
+from cand_class.profiling import profiled
+
+
+class RectangularCuts:
+    """
+    Stage-one filter of vectorized rectangular cuts, a candidate survives if
+    low <= value <= high for every cut branch (None means unbounded)
+
+    Parameters
+    ------------------------------------------------
+    cuts: dict
+        branch -> (low, high)
+    """
+
+    kind = 'cuts'
+
+    def __init__(self, cuts):
+        self.cuts = {branch: tuple(limits) for branch, limits in cuts.items()}
+        self.branches = list(self.cuts)
+
+    @classmethod
+    def from_config(cls, inp_file, mass_var='mass', signal_df=None, variables=(), signal_efficiency=0.999):
+        """
+        Mass window of the [peak_range] table of the input toml (the range the
+        classifier was trained on, bgr_left_edge to bgr_right_edge), optionally
+        tightened by two-sided signal quantile cuts on variables that keep
+        signal_efficiency of signal_df per variable
+
+        Parameters
+        ------------------------------------------------
+        inp_file: str
+            input toml, see config_reader.convertDF
+        mass_var: str
+            name of the mass branch
+        signal_df: pandas.DataFrame
+            signal candidates with raw branches
+        variables: list of str
+            raw branches cut on signal quantiles
+        signal_efficiency: float
+            signal fraction kept by each quantile cut
+        """
+        with open(str(inp_file), "rb") as inp_file:
+            peak_range = tomli.load(inp_file)['peak_range']
+
+        cuts = {mass_var: (peak_range['bgr_left_edge'], peak_range['bgr_right_edge'])}
+        tail = (1 - signal_efficiency) / 2
+        for var in variables:
+            values = signal_df[var].to_numpy()
+            values = values[np.isfinite(values)]
+            cuts[var] = (float(np.quantile(values, tail)), float(np.quantile(values, 1 - tail)))
+        return cls(cuts)
+
+    def mask(self, df):
+        """
+        Boolean array of the candidates passing all cuts
+        """
+        passed = np.ones(len(df), dtype=bool)
+        for branch, (low, high) in self.cuts.items():
+            values = df[branch].to_numpy()
+            if low is not None:
+                passed &= values >= low
+            if high is not None:
+                passed &= values <= high
+        return passed
+
+    def to_dict(self, spec_file=None):
+        return {'type': self.kind, 'cuts': {branch: list(limits) for branch, limits in self.cuts.items()}}
+
+
+class ShallowStage:
+    """
+    Stage-one filter of a small shallow booster, a candidate survives if its
+    score is above threshold
+
+    Parameters
+    ------------------------------------------------
+    booster: xgboost.Booster
+        shallow model
+    features: list of str
+        model features in training order
+    threshold: float
+        score cut
+    """
+
+    kind = 'booster'
+
+    def __init__(self, booster, features, threshold):
+        self.booster = booster
+        self.features = list(features)
+        self.threshold = float(threshold)
+        self.branches = required_branches(self.features)
+
+    @classmethod
+    def train(cls, x_train, y_train, features, signal_efficiency=0.99, n_estimators=20, max_depth=2,
+              nthread=1):
+        """
+        Trains the shallow booster on the training sample of the full model and
+        sets the threshold to keep signal_efficiency of the training signal
+
+        Parameters
+        ------------------------------------------------
+        x_train: pandas.DataFrame
+            training candidates with the (already log transformed) features
+        y_train: array
+            labels, 1 for signal
+        features: list of str
+            features used by the shallow model
+        """
+        import xgboost as xgb
+
+        y_train = np.asarray(y_train)
+        x = x_train[features].to_numpy(dtype=np.float32)
+        params = {'objective': 'binary:logistic', 'max_depth': max_depth, 'eta': 0.3, 'nthread': nthread,
+                  'tree_method': 'hist'}
+        booster = xgb.train(params, xgb.DMatrix(x, label=y_train, feature_names=list(features)),
+                            num_boost_round=n_estimators)
+
+        scores = booster.inplace_predict(x[y_train == 1])
+        threshold = float(np.quantile(scores, 1 - signal_efficiency))
+        return cls(booster, features, threshold)
+
+    def mask(self, df):
+        """
+        Boolean array of the candidates above threshold, df holds either the
+        raw branches or the already transformed features
+        """
+        if all(feature in df.columns for feature in self.features):
+            x = df[self.features].to_numpy(dtype=np.float32)
+        else:
+            x = feature_matrix(df, self.features)
+        return np.asarray(self.booster.inplace_predict(x)) > self.threshold
+
+    def to_dict(self, spec_file='stage_one.json'):
+        # the booster goes next to the spec as <spec stem>_model.json, so specs in one directory do not share it
+        spec_file = os.path.abspath(spec_file)
+        model_file = os.path.splitext(spec_file)[0]+'_model.json'
+        if model_file == spec_file:
+            raise ValueError('The stage-one model file would overwrite the spec '+spec_file)
+        self.booster.save_model(model_file)
+        return {'type': self.kind, 'model': os.path.basename(model_file), 'features': self.features,
+                'threshold': self.threshold}
+
+
+def save_stage(stage, file_name):
+    """
+    Writes a stage-one spec (json) usable by scoring.score_files(cascade=file_name).
+    A shallow booster is stored next to it as <spec stem>_model.json, e.g.
+    stage_one_model.json for stage_one.json
+    """
+    # the booster is written before the spec is opened
+    spec = stage.to_dict(file_name)
+    with open(file_name, 'w', encoding="utf-8") as out_file:
+        json.dump(spec, out_file, indent=2)
+    return file_name
+
+
+def load_stage(file_name):
+    with open(file_name, encoding="utf-8") as inp_file:
+        spec = json.load(inp_file)
+
+    if spec['type'] == 'cuts':
+        return RectangularCuts(spec['cuts'])
+
+    import xgboost as xgb
+
+    booster = xgb.Booster()
+    booster.load_model(os.path.join(os.path.dirname(os.path.abspath(file_name)), spec['model']))
+    return ShallowStage(booster, spec['features'], spec['threshold'])
+
+
+@profiled(rows=lambda res, stage, df, *args, **kwargs: len(df))
+def cascade_report(stage, df, full_scores, labels, threshold, output_path=None):
+    """
+    Efficiency loss of the stage-one filter against the full model on a
+    validation sample
+
+    Parameters
+    ------------------------------------------------
+    stage: RectangularCuts or ShallowStage
+        stage-one filter
+    df: pandas.DataFrame
+        validation candidates with the raw branches needed by stage
+    full_scores: array
+        full-model scores of df
+    labels: array
+        1 for signal, 0 for background
+    threshold: float
+        BDT cut of the full model
+    output_path: str
+        if set, the report is written to output_path/cascade_report.json
+
+    Returns
+    -------
+    dict with stage-one pass fractions, full-model signal efficiency with and
+    without stage one, the relative signal loss and the fraction of candidates
+    the full model still has to score
+    """
+    passed = stage.mask(df)
+    labels = np.asarray(labels)
+    selected = np.asarray(full_scores) > threshold
+    signal = labels == 1
+    background = ~signal
+
+    def fraction(num, den):
+        return float(np.count_nonzero(num) / max(1, np.count_nonzero(den)))
+
+    report = {
+        'stage': stage.kind,
+        'candidates': int(len(labels)),
+        'stage_one_pass_fraction': fraction(passed, np.ones_like(passed)),
+        'stage_one_signal_efficiency': fraction(passed & signal, signal),
+        'stage_one_background_efficiency': fraction(passed & background, background),
+        'full_signal_efficiency': fraction(selected & signal, signal),
+        'cascade_signal_efficiency': fraction(selected & passed & signal, signal),
+        'full_background_efficiency': fraction(selected & background, background),
+        'cascade_background_efficiency': fraction(selected & passed & background, background),
+        # selected signal candidates of the full model lost by stage one
+        'signal_loss': fraction(selected & ~passed & signal, selected & signal),
+    }
+
+    if output_path is not None:
+        os.makedirs(output_path, exist_ok=True)
+        with open(os.path.join(output_path, 'cascade_report.json'), 'w', encoding="utf-8") as out_file:
+            json.dump(report, out_file, indent=2)
+
+    print('Stage one keeps %.1f%% of the candidates, signal loss after the BDT cut %.3f%%'
+          % (100 * report['stage_one_pass_fraction'], 100 * report['signal_loss']))
+    return report
+
@@ -0,0 +1,278 @@
+import json
+
+import numpy as np
+
+from cand_class.memory import get_memory_budget
+
+
+class QuantileSketch:
+    """
+    Mergeable approximate quantiles of a stream of values (a KLL-like
+    compactor): every level keeps at most k values, a full level is sorted
+    and every other value moves up one level with twice the weight. The rank
+    error is of the order of (number of levels) / k
+
+    Parameters
+    ------------------------------------------------
+    k: int
+        values kept per level
+    """
+
+    def __init__(self, k=2048):
+        self.k = int(k)
+        self.levels = [np.empty(0)]
+        self.count = 0
+        # alternating offsets of the compactions, so their rounding errors cancel
+        self._offsets = [0]
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self._compress()
+        return self
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.k:
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                    self._offsets.append(0)
+                items = np.sort(items)
+                # an odd value out stays on this level
+                keep = items[-1:] if len(items) % 2 else items[:0]
+                items = items[:len(items) - len(keep)]
+                offset = self._offsets[level]
+                self._offsets[level] = 1 - offset
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], items[offset::2]])
+                self.levels[level] = keep
+            level += 1
+
+    def merge(self, other):
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+                self._offsets.append(0)
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self._compress()
+        return self
+
+    def quantile(self, q):
+        """
+        Approximate quantiles q (scalar or array in [0, 1]), nan if empty
+        """
+        q = np.asarray(q, dtype=np.float64)
+        values = np.concatenate(self.levels)
+        if len(values) == 0:
+            return np.full(q.shape, np.nan)[()]
+        weights = np.concatenate([np.full(len(items), 2.**level) for level, items in enumerate(self.levels)])
+        order = np.argsort(values)
+        # rank of the middle of the weight each value stands for
+        values, weights = values[order], weights[order]
+        ranks = np.cumsum(weights) - weights / 2
+        index = np.searchsorted(ranks, q * weights.sum(), side='left')
+        return values[np.clip(index, 0, len(values) - 1)][()]
+
+    def as_dict(self):
+        return {'k': self.k, 'count': self.count, 'offsets': self._offsets,
+                'levels': [items.tolist() for items in self.levels]}
+
+    @classmethod
+    def from_dict(cls, info):
+        sketch = cls(info['k'])
+        sketch.count = info['count']
+        sketch._offsets = list(info['offsets'])
+        sketch.levels = [np.asarray(items, dtype=np.float64) for items in info['levels']]
+        return sketch
+
+
+class ColumnStats:
+    """
+    Per-column statistics of a dataset filled chunk by chunk in one vectorized
+    pass and mergeable between chunks, files and jobs: number of values, NaN,
+    +inf and -inf counts, non-positive count (values a log transformation
+    turns into NaN or -inf), minimum and maximum of the finite values and a
+    QuantileSketch (and the smallest positive value, the lower edge after a log
+    transformation). Histogram and plot ranges are taken from it instead of
+    recomputing min()/max() of the data for every plot
+
+        stats = ColumnStats.from_frame(df)
+        edges = stats.edges('pT', 500)
+
+    Parameters
+    ------------------------------------------------
+    columns: list of str
+        columns to track, by default the numeric columns of the first chunk
+    k: int
+        size of the quantile sketches
+    """
+
+    def __init__(self, columns=None, k=2048):
+        self.columns = None if columns is None else list(columns)
+        self.k = k
+        self.stats = {}
+
+    def _init_column(self, column):
+        self.stats[column] = {'count': 0, 'nan': 0, 'posinf': 0, 'neginf': 0, 'nonpositive': 0,
+                              'min': np.inf, 'max': -np.inf, 'min_positive': np.inf,
+                              'sketch': QuantileSketch(self.k)}
+
+    def update(self, df):
+        """
+        Adds a chunk (pandas.DataFrame)
+        """
+        if self.columns is None:
+            self.columns = [column for column in df.columns if np.issubdtype(df[column].dtype, np.number)]
+        for column in self.columns:
+            if column not in self.stats:
+                self._init_column(column)
+            values = df[column].to_numpy(dtype=np.float64)
+            finite = np.isfinite(values)
+            col = self.stats[column]
+            col['count'] += len(values)
+            col['nan'] += int(np.count_nonzero(np.isnan(values)))
+            col['posinf'] += int(np.count_nonzero(values == np.inf))
+            col['neginf'] += int(np.count_nonzero(values == -np.inf))
+            col['nonpositive'] += int(np.count_nonzero(values <= 0))
+            if finite.any():
+                values = values[finite]
+                col['min'] = min(col['min'], float(values.min()))
+                col['max'] = max(col['max'], float(values.max()))
+                positive = values[values > 0]
+                if len(positive):
+                    col['min_positive'] = min(col['min_positive'], float(positive.min()))
+                col['sketch'].update(values)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the statistics of another ColumnStats, e.g. of another file or job
+        """
+        if self.columns is None:
+            self.columns = list(other.columns or [])
+        for column, other_col in other.stats.items():
+            if column not in self.stats:
+                self._init_column(column)
+                if column not in self.columns:
+                    self.columns.append(column)
+            col = self.stats[column]
+            for key in ('count', 'nan', 'posinf', 'neginf', 'nonpositive'):
+                col[key] += other_col[key]
+            col['min'] = min(col['min'], other_col['min'])
+            col['max'] = max(col['max'], other_col['max'])
+            col['min_positive'] = min(col['min_positive'], other_col['min_positive'])
+            col['sketch'].merge(other_col['sketch'])
+        return self
+
+    @classmethod
+    def from_frame(cls, df, columns=None, chunk_size=None, k=2048):
+        """
+        Statistics of a DataFrame filled in chunks of chunk_size rows, by
+        default sized from the memory budget
+        """
+        stats = cls(columns, k)
+        if chunk_size is None:
+            # a float64 copy and the finite mask of one column at a time
+            chunk_size = get_memory_budget().chunk_rows(24)
+        for start in range(0, max(len(df), 1), chunk_size):
+            stats.update(df.iloc[start:start + chunk_size])
+        return stats
+
+    def __contains__(self, column):
+        return column in self.stats
+
+    def __getitem__(self, column):
+        return self.stats[column]
+
+    def quantile(self, column, q):
+        return self.stats[column]['sketch'].quantile(q)
+
+    def range(self, column, robust=False, quantiles=(0.001, 0.999)):
+        """
+        (low, high) of the finite values of column. With robust the range
+        covers the given quantiles instead of the extreme values, so that a
+        few outliers do not squeeze the distribution into a couple of bins
+        """
+        col = self.stats[column]
+        if col['count'] == col['nan'] + col['posinf'] + col['neginf']:
+            return 0., 1.
+        low, high = col['min'], col['max']
+        if robust:
+            low, high = (float(value) for value in self.quantile(column, quantiles))
+        if high <= low:
+            # constant column, widen by half a unit (or half the value)
+            half = 0.5 * max(abs(low), 1.)
+            return low - half, high + half
+        return low, high
+
+    def edges(self, column, bins, robust=False, quantiles=(0.001, 0.999)):
+        """
+        bins + 1 uniform bin edges over range(column)
+        """
+        low, high = self.range(column, robust, quantiles)
+        return np.linspace(low, high, int(bins) + 1)
+
+    def log_transformed(self, log_vars):
+        """
+        Statistics after helper.transform_df_to_log: log is monotonic, so the
+        range and quantiles of log(var) follow from those of the positive
+        values of var. Non-positive values of var are counted as NaN of
+        log(var) (zeros actually become -inf), the non-positive count of
+        log(var) is unknown (None)
+        """
+        transformed = ColumnStats([], self.k)
+        for column in self.columns or []:
+            col = dict(self.stats[column])
+            if column in log_vars:
+                old_sketch = col['sketch']
+                sketch = QuantileSketch(self.k)
+                sketch.levels = [np.log(items[items > 0]) for items in old_sketch.levels]
+                sketch._offsets = list(old_sketch._offsets)
+                sketch.count = col['count'] - col['nan'] - col['posinf'] - col['nonpositive']
+                positive = col['min_positive'] < np.inf
+                col.update({'nan': col['nan'] + col['nonpositive'], 'neginf': 0, 'nonpositive': None,
+                            'min': float(np.log(col['min_positive'])) if positive else np.inf,
+                            'max': float(np.log(col['max'])) if positive else -np.inf,
+                            'min_positive': np.inf, 'sketch': sketch})
+                column = 'log('+column+')'
+            transformed.columns.append(column)
+            transformed.stats[column] = col
+        return transformed
+
+    def summary(self):
+        """
+        Columns with non-finite values, e.g. to warn before plotting
+        """
+        lines = []
+        for column in self.columns or []:
+            col = self.stats[column]
+            if col['nan'] or col['posinf'] or col['neginf']:
+                lines.append('%s: %d NaN, %d +inf, %d -inf of %d' % (column, col['nan'], col['posinf'],
+                                                                     col['neginf'], col['count']))
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return {'k': self.k, 'columns': self.columns,
+                'stats': {column: dict(col, sketch=col['sketch'].as_dict()) for column, col in self.stats.items()}}
+
+    @classmethod
+    def from_dict(cls, info):
+        stats = cls(info['columns'], info['k'])
+        stats.stats = {column: dict(col, sketch=QuantileSketch.from_dict(col['sketch']))
+                       for column, col in info['stats'].items()}
+        return stats
+
+    def save(self, file_name):
+        with open(str(file_name), 'w', encoding="utf-8") as out_file:
+            json.dump(self.as_dict(), out_file)
+
+    @classmethod
+    def load(cls, file_name):
+        with open(str(file_name), encoding="utf-8") as inp_file:
+            return cls.from_dict(json.load(inp_file))
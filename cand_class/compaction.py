@@ -0,0 +1,313 @@
+import copy
+import json
+import os
+import time
+
+import numpy as np
+import xgboost as xgb
+from sklearn.metrics import roc_auc_score, roc_curve
+
+from cand_class.profiling import profiled
+from cand_class.tree_eval import FlatForest
+
+
+def model_json(booster):
+    """
+    Parsed XGBoost JSON model of a Booster
+    """
+    return json.loads(bytes(booster.save_raw(raw_format='json')))
+
+
+def booster_from_json(model, nthread=None):
+    booster = xgb.Booster(model_file=bytearray(json.dumps(model).encode('utf-8')))
+    if nthread is not None:
+        booster.set_param({'nthread': nthread})
+    return booster
+
+
+def tree_contributions(model, x, chunk_size=20000):
+    """
+    Yields (rows, per-tree margin contributions) chunks of shape (n_rows, n_trees)
+    """
+    forest = FlatForest.from_json(model)
+    for start in range(0, len(x), chunk_size):
+        rows = slice(start, start + chunk_size)
+        yield rows, forest.value[forest.leaf_indices(x[rows])], forest.base_margin
+
+
+def best_iteration(model, x_val, y_val):
+    """
+    Number of trees with the lowest validation log loss, computed from the
+    per-tree contributions in one pass over the sample
+    """
+    y_val = np.asarray(y_val, dtype=np.float64)
+    n_trees = len(model['learner']['gradient_booster']['model']['trees'])
+    losses = np.zeros(n_trees)
+    for rows, contrib, base_margin in tree_contributions(model, x_val):
+        margin = np.full(len(contrib), base_margin, dtype=np.float64)
+        y = y_val[rows]
+        for tree in range(n_trees):
+            margin += contrib[:, tree]
+            # log(1 + exp(-m)) for signal, log(1 + exp(m)) for background
+            losses[tree] += np.sum(np.logaddexp(0, np.where(y == 1, -margin, margin)))
+    return int(np.argmin(losses)) + 1
+
+
+def _set_trees(model, keep):
+    gbtree = model['learner']['gradient_booster']['model']
+    if int(gbtree['gbtree_model_param'].get('num_parallel_tree', 1)) != 1:
+        raise ValueError('Boosted random forests (num_parallel_tree > 1) are not supported')
+
+    gbtree['trees'] = [gbtree['trees'][i] for i in keep]
+    gbtree['tree_info'] = [gbtree['tree_info'][i] for i in keep]
+    for i, tree in enumerate(gbtree['trees']):
+        tree['id'] = i
+    gbtree['gbtree_model_param']['num_trees'] = str(len(keep))
+    if 'iteration_indptr' in gbtree:
+        gbtree['iteration_indptr'] = list(range(len(keep) + 1))
+
+    attributes = model['learner'].get('attributes', {})
+    if 'best_iteration' in attributes:
+        attributes['best_iteration'] = str(len(keep) - 1)
+        attributes['best_ntree_limit'] = str(len(keep))
+
+
+def prune_trees(model, tolerance):
+    """
+    Drops the trees with the smallest maximal |leaf value| as long as their sum
+    stays below tolerance, so no margin changes by more than tolerance.
+    Returns the number of dropped trees
+    """
+    trees = model['learner']['gradient_booster']['model']['trees']
+    weight = np.array([np.max(np.abs(np.where(np.array(tree['left_children']) == -1,
+                                              tree['split_conditions'], 0))) for tree in trees])
+    order = np.argsort(weight, kind='stable')
+    n_drop = int(np.searchsorted(np.cumsum(weight[order]), tolerance, side='right'))
+    n_drop = min(n_drop, len(trees) - 1)
+    _set_trees(model, sorted(order[n_drop:].tolist()))
+    return n_drop
+
+
+def _prune_tree_leaves(tree, tolerance):
+    left, right = tree['left_children'], tree['right_children']
+    value = [float(v) for v in tree['split_conditions']]
+    hess = tree['sum_hessian']
+    is_leaf = [child == -1 for child in left]
+    error = [0.0] * len(left)
+
+    preorder, stack = [], [0]
+    while stack:
+        node = stack.pop()
+        preorder.append(node)
+        if left[node] != -1:
+            stack.extend((right[node], left[node]))
+
+    # children first: merge two sibling leaves into their parent if every
+    # candidate below changes its contribution by at most tolerance
+    n_merged = 0
+    for node in reversed(preorder):
+        l_node, r_node = left[node], right[node]
+        if l_node == -1 or not (is_leaf[l_node] and is_leaf[r_node]):
+            continue
+        h_sum = hess[l_node] + hess[r_node]
+        merged = ((hess[l_node] * value[l_node] + hess[r_node] * value[r_node]) / h_sum if h_sum > 0
+                  else (value[l_node] + value[r_node]) / 2)
+        err = max(error[l_node] + abs(value[l_node] - merged), error[r_node] + abs(value[r_node] - merged))
+        if err <= tolerance:
+            is_leaf[node] = True
+            value[node] = merged
+            error[node] = err
+            n_merged += 1
+
+    if n_merged == 0:
+        return 0
+
+    # renumber the kept nodes breadth first
+    order, new_id = [0], {0: 0}
+    for node in order:
+        if not is_leaf[node]:
+            for child in (left[node], right[node]):
+                new_id[child] = len(order)
+                order.append(child)
+
+    new_tree = {key: [] for key in ('base_weights', 'default_left', 'left_children', 'loss_changes', 'parents',
+                                    'right_children', 'split_conditions', 'split_indices', 'split_type',
+                                    'sum_hessian')}
+    parents = {0: 2147483647}
+    for node in order:
+        leaf = is_leaf[node]
+        if not leaf:
+            parents[left[node]] = new_id[node]
+            parents[right[node]] = new_id[node]
+        new_tree['base_weights'].append(value[node] if leaf else tree['base_weights'][node])
+        new_tree['default_left'].append(0 if leaf else tree['default_left'][node])
+        new_tree['left_children'].append(-1 if leaf else new_id[left[node]])
+        new_tree['right_children'].append(-1 if leaf else new_id[right[node]])
+        new_tree['loss_changes'].append(0.0 if leaf else tree['loss_changes'][node])
+        new_tree['parents'].append(parents[node])
+        new_tree['split_conditions'].append(value[node] if leaf else tree['split_conditions'][node])
+        new_tree['split_indices'].append(0 if leaf else tree['split_indices'][node])
+        new_tree['split_type'].append(0 if leaf else tree['split_type'][node])
+        new_tree['sum_hessian'].append(hess[node])
+
+    tree.update(new_tree)
+    tree['tree_param']['num_nodes'] = str(len(order))
+    tree['tree_param']['num_deleted'] = '0'
+    return len(left) - len(order)
+
+
+def prune_leaves(model, tolerance):
+    """
+    Collapses sibling leaves into their parent (hessian-weighted value) while
+    the contribution of every candidate to the tree changes by at most
+    tolerance. Returns the number of removed nodes
+    """
+    trees = model['learner']['gradient_booster']['model']['trees']
+    for tree in trees:
+        if any(tree.get('split_type', [])):
+            raise ValueError('Categorical splits are not supported')
+    return sum(_prune_tree_leaves(tree, tolerance) for tree in trees)
+
+
+def feature_bin_edges(x, max_bin=256):
+    """
+    Quantile bin edges per feature column of x, like the XGBoost hist method
+    """
+    quantiles = np.linspace(0, 1, max_bin + 1)
+    edges = []
+    for column in np.asarray(x, dtype=np.float32).T:
+        column = column[np.isfinite(column)]
+        edges.append(np.unique(np.quantile(column, quantiles).astype(np.float32)) if len(column) else
+                     np.array([], dtype=np.float32))
+    return edges
+
+
+def quantize_thresholds(model, edges):
+    """
+    Moves every split threshold to the nearest bin edge of its feature, see
+    feature_bin_edges. Returns the number of changed thresholds
+    """
+    n_changed = 0
+    for tree in model['learner']['gradient_booster']['model']['trees']:
+        conditions = tree['split_conditions']
+        for node, (child, feature) in enumerate(zip(tree['left_children'], tree['split_indices'])):
+            feature_edges = edges[feature]
+            if child == -1 or len(feature_edges) == 0:
+                continue
+            pos = int(np.searchsorted(feature_edges, conditions[node]))
+            neighbours = feature_edges[max(pos - 1, 0):pos + 1]
+            nearest = neighbours[np.argmin(np.abs(neighbours - conditions[node]))]
+            if np.float32(nearest) != np.float32(conditions[node]):
+                conditions[node] = float(nearest)
+                n_changed += 1
+    return n_changed
+
+
+def _model_stats(booster, x_val, y_val, nthread, n_repeat):
+    model = model_json(booster)
+    trees = model['learner']['gradient_booster']['model']['trees']
+    booster.set_param({'nthread': nthread})
+
+    timings = []
+    for _ in range(n_repeat):
+        start = time.perf_counter()
+        scores = booster.inplace_predict(x_val)
+        timings.append(time.perf_counter() - start)
+
+    fpr, tpr, thresholds = roc_curve(y_val, scores, drop_intermediate=False, pos_label=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ams = np.sqrt(2 * ((tpr + fpr) * np.log(1 + tpr/fpr) - tpr))
+    ams[~np.isfinite(ams)] = -np.inf
+    best = int(np.argmax(ams))
+
+    stats = {
+        'trees': len(trees),
+        'nodes': int(sum(len(tree['left_children']) for tree in trees)),
+        'distinct_thresholds': int(len({(tree['split_indices'][i], tree['split_conditions'][i])
+                                        for tree in trees for i in range(len(tree['left_children']))
+                                        if tree['left_children'][i] != -1})),
+        'auc': float(roc_auc_score(y_val, scores)),
+        'ams': float(ams[best]),
+        'ams_threshold': float(min(thresholds[best], 1)),
+        'predict_seconds': float(min(timings)),
+    }
+    return stats, scores
+
+
+@profiled(rows=lambda res, booster, x_val, *args, **kwargs: len(x_val))
+def compact_model(booster, x_val, y_val, truncate=True, tree_tolerance=0.0, leaf_tolerance=0.0,
+                  edges=None, output_path=None, nthread=1, n_repeat=5):
+    """
+    Compacts a trained booster for faster inference and reports the change in
+    AUC, AMS and prediction time on a validation sample
+
+    Parameters
+    ------------------------------------------------
+    booster: xgboost.Booster or XGBClassifier
+        trained model, e.g. XGBmodel.get_mode_booster() after train_test_pred
+    x_val: np.ndarray or pandas.DataFrame
+        validation features in training order
+    y_val: array
+        validation labels
+    truncate: bool
+        keep only the trees up to the iteration with the lowest validation log loss
+    tree_tolerance: float
+        drop whole trees whose summed maximal |leaf value| stays below it
+    leaf_tolerance: float
+        merge sibling leaves changing a tree contribution by at most it
+    edges: list of np.ndarray
+        per-feature bin edges (feature_bin_edges) to quantize thresholds to
+    output_path: str
+        if set, compact_model.json and compaction_report.json are written there
+    nthread: int
+        threads for the timing of both models
+
+    Returns
+    -------
+    compact xgboost.Booster and report dict
+    """
+    if hasattr(booster, 'get_booster'):
+        booster = booster.get_booster()
+    x_val = np.asarray(x_val, dtype=np.float32)
+    y_val = np.asarray(y_val)
+
+    model = model_json(booster)
+    compact = copy.deepcopy(model)
+    n_trees = len(model['learner']['gradient_booster']['model']['trees'])
+    steps = {}
+
+    if truncate:
+        n_best = best_iteration(compact, x_val, y_val)
+        _set_trees(compact, list(range(n_best)))
+        steps['truncated_trees'] = n_trees - n_best
+    if tree_tolerance > 0:
+        steps['pruned_trees'] = prune_trees(compact, tree_tolerance)
+    if leaf_tolerance > 0:
+        steps['pruned_nodes'] = prune_leaves(compact, leaf_tolerance)
+    if edges is not None:
+        steps['quantized_thresholds'] = quantize_thresholds(compact, edges)
+
+    compact_booster = booster_from_json(compact)
+    original_stats, original_scores = _model_stats(booster_from_json(model), x_val, y_val, nthread, n_repeat)
+    compact_stats, compact_scores = _model_stats(compact_booster, x_val, y_val, nthread, n_repeat)
+
+    report = {
+        'steps': steps,
+        'original': original_stats,
+        'compact': compact_stats,
+        'delta_auc': compact_stats['auc'] - original_stats['auc'],
+        'delta_ams': compact_stats['ams'] - original_stats['ams'],
+        'max_abs_score_diff': float(np.max(np.abs(compact_scores - original_scores))),
+        'speedup': original_stats['predict_seconds'] / max(compact_stats['predict_seconds'], 1e-12),
+    }
+
+    if output_path is not None:
+        os.makedirs(output_path, exist_ok=True)
+        compact_booster.save_model(os.path.join(output_path, 'compact_model.json'))
+        with open(os.path.join(output_path, 'compaction_report.json'), 'w', encoding="utf-8") as out_file:
+            json.dump(report, out_file, indent=2)
+
+    print('Compaction: %d -> %d trees, %d -> %d nodes, AUC %+.5f, AMS %+.4f, speed-up %.2fx' % (
+        original_stats['trees'], compact_stats['trees'], original_stats['nodes'], compact_stats['nodes'],
+        report['delta_auc'], report['delta_ams'], report['speedup']))
+    return compact_booster, report
@@ -0,0 +1,110 @@
+import os
+from dataclasses import asdict, dataclass
+
+from cand_class.run_metadata import read_run_metadata, update_run_metadata
+
+
+BLAS_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def available_cores():
+    """
+    Number of cores this process may run on (respects taskset/cgroup affinity)
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@dataclass
+class ThreadBudget:
+    """
+    Splits the core budget between outer parallelism (Bayesian optimization
+    trials, CV folds, scoring worker processes) and inner parallelism (XGBoost
+    threads inside each outer worker), so that outer * inner never exceeds
+    total_cores
+
+    Attributes
+    ----------
+    total_cores : int
+        cores available to the package, defaults to the process affinity
+    outer : int
+        number of concurrent trials/folds/worker processes
+    inner : int
+        XGBoost threads per outer worker
+    blas_threads : int
+        threads of NumPy/BLAS pools
+    """
+
+    total_cores: int = None
+    outer: int = None
+    inner: int = None
+    blas_threads: int = 1
+
+    def __post_init__(self):
+        self.total_cores = max(1, int(self.total_cores or available_cores()))
+
+        if self.outer is None and self.inner is None:
+            self.outer = 1
+        if self.outer is None:
+            self.outer = self.total_cores // self.inner
+        if self.inner is None:
+            self.inner = self.total_cores // self.outer
+
+        self.outer = max(1, min(int(self.outer), self.total_cores))
+        self.inner = max(1, min(int(self.inner), self.total_cores // self.outer))
+        self.blas_threads = max(1, int(self.blas_threads))
+
+    def apply(self):
+        """
+        Limits NumPy/BLAS/OpenMP pools of this process and of the processes it
+        starts afterwards
+        """
+        for var in BLAS_ENV_VARS:
+            os.environ[var] = str(self.blas_threads)
+
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            return
+        threadpool_limits(self.blas_threads)
+
+    def as_dict(self):
+        return asdict(self)
+
+    def record(self, output_path, stage=None, **allocation):
+        """
+        Writes the budget and, if stage is given, the effective allocation of
+        that stage (for example workers=4, nthread=16) to
+        output_path/run_metadata.json
+        """
+        concurrency = read_run_metadata(output_path).get('concurrency', {})
+        concurrency['budget'] = self.as_dict()
+        if stage is not None:
+            concurrency[stage] = allocation
+        update_run_metadata(output_path, 'concurrency', concurrency)
+
+
+_budget = None
+
+
+def set_budget(budget):
+    """
+    Sets the package-wide thread budget and applies it to this process
+    """
+    global _budget
+    _budget = budget
+    _budget.apply()
+    return _budget
+
+
+def get_budget():
+    """
+    Returns the package-wide thread budget, by default all cores go to XGBoost
+    threads of a single outer worker
+    """
+    global _budget
+    if _budget is None:
+        _budget = ThreadBudget()
+    return _budget
@@ -1,46 +1,76 @@
-from hipe4ml.tree_handler import TreeHandler
 import tomli
 import sys
 
+from cand_class.concurrency import ThreadBudget
+from cand_class.lazy import lazy_import
+from cand_class.loader import read_tree
+from cand_class.memory import MemoryBudget
+from cand_class.profiling import profiled
 
-def convertDF(input_file, mass_var):
+tree_handler = lazy_import('hipe4ml.tree_handler', 'train')
+
+
+@profiled(rows=lambda res, *args, **kwargs: res[0].get_n_cand() + res[1].get_n_cand())
+def convertDF(input_file, mass_var, io_threads=None, prefetch=2, stats=None, column_stats=None):
     """
     Opens input file in toml format, retrives signal, background and deploy data
-    like TreeHandler objects
+    like TreeHandler objects. The trees are read with loader.read_tree
 
     Parameters
     ------------------------------------------------
     df: str
-        input toml file
+        input toml file, or its already parsed content (e.g. manifest.RunManifest.inputs)
+    io_threads: int
+        basket decompression threads
+    prefetch: int
+        chunks read ahead while the previous one is converted
+    stats: loader.LoaderStats
+        collects bytes read, decompression and stall time
+    column_stats: dict
+        'signal' and 'background' column_stats.ColumnStats filled while the
+        trees are read (all candidates, before the subset selection)
     """
-    with open(str(input_file), encoding="utf-8") as inp_file:
-        inp_info = tomli.load(inp_file)
-
-    signal = TreeHandler(inp_info["signal"]["path"], inp_info["signal"]["tree"])
-    background = TreeHandler(inp_info["background"]["path"], inp_info["background"]["tree"])
-
+    column_stats = column_stats or {}
+    if isinstance(input_file, dict):
+        inp_info = input_file
+    else:
+        with open(str(input_file), "rb") as inp_file:
+            inp_info = tomli.load(inp_file)
+
+    signal = tree_handler.TreeHandler()
+    signal.set_data_frame(read_tree(inp_info["signal"]["path"], inp_info["signal"]["tree"],
+                                    io_threads=io_threads, prefetch=prefetch, stats=stats,
+                                    column_stats=column_stats.get("signal")))
+    background = tree_handler.TreeHandler()
+    background.set_data_frame(read_tree(inp_info["background"]["path"], inp_info["background"]["tree"],
+                                        io_threads=io_threads, prefetch=prefetch, stats=stats,
+                                        column_stats=column_stats.get("background")))
+
+    selection = sideband_selection(inp_info, mass_var)
 
+    signalH = signal.get_subset(size = inp_info["number_of_events"]["number_of_signal_events"])
+    bkgH = background.get_subset(selection, size=inp_info["number_of_events"]["number_of_background_events"])
 
+    return signalH, bkgH
 
 
+def sideband_selection(inp_info, mass_var):
+    """
+    Returns the background sideband selection string built from the
+    [peak_range] table of the parsed input toml
+    """
     bgr_left_edge = inp_info["peak_range"]["bgr_left_edge"]
     bgr_right_edge = inp_info["peak_range"]["bgr_right_edge"]
 
     peak_left_edge = inp_info["peak_range"]["sgn_left_edge"]
     peak_right_edge = inp_info["peak_range"]["sgn_right_edge"]
 
-
-    selection = str(bgr_left_edge)+'< '+mass_var+' <'+str(peak_left_edge)+' or '+str(peak_right_edge)+\
+    return str(bgr_left_edge)+'< '+mass_var+' <'+str(peak_left_edge)+' or '+str(peak_right_edge)+\
     '< '+mass_var+' <'+str(bgr_right_edge)
 
-    signalH = signal.get_subset(size = inp_info["number_of_events"]["number_of_signal_events"])
-    bkgH = background.get_subset(selection, size=inp_info["number_of_events"]["number_of_background_events"])
-
-    return signalH, bkgH
-
 
 def read_log_vars(inp_file):
-    with open(str(inp_file), encoding="utf-8") as inp_file:
+    with open(str(inp_file), "rb") as inp_file:
         inp_dict = tomli.load(inp_file)
 
     return inp_dict['non_log_scale']['variables'], inp_dict['log_scale']['variables']
@@ -48,6 +78,56 @@ def read_log_vars(inp_file):
 
 
 def read_train_vars(inp_file):
-    with open(str(inp_file), encoding="utf-8") as inp_file:
+    with open(str(inp_file), "rb") as inp_file:
         inp_dict = tomli.load(inp_file)
     return  inp_dict['train_vars']
+
+
+def read_binning(inp_file):
+    """
+    Reads fixed binning used by mergeable batch-job histograms
+
+    Parameters
+    ------------------------------------------------
+    inp_file: str
+        toml file with [score] bins, [variables.<name>] bins and range,
+        and [pt_rap] bins, x_range (rapidity) and y_range (pT)
+    """
+    with open(str(inp_file), "rb") as inp_file:
+        inp_dict = tomli.load(inp_file)
+
+    binning = {'score_bins': inp_dict.get('score', {}).get('bins', 100), 'variables': {}}
+
+    for var, var_binning in inp_dict['variables'].items():
+        binning['variables'][var] = {'bins': int(var_binning['bins']),
+                                     'range': [float(edge) for edge in var_binning['range']]}
+
+    if 'pt_rap' in inp_dict:
+        binning['pt_rap'] = {'bins': int(inp_dict['pt_rap'].get('bins', 100)),
+                             'x_range': [float(edge) for edge in inp_dict['pt_rap']['x_range']],
+                             'y_range': [float(edge) for edge in inp_dict['pt_rap']['y_range']],
+                             'labels': inp_dict['pt_rap'].get('labels', ['pT', 'rapidity'])}
+
+    return binning
+
+
+def read_concurrency(inp_file):
+    """
+    Reads the [concurrency] table (total_cores, outer, inner, blas_threads)
+    of a toml file into a ThreadBudget, missing keys are derived from the others
+    """
+    with open(str(inp_file), "rb") as inp_file:
+        inp_dict = tomli.load(inp_file)
+
+    return ThreadBudget(**inp_dict.get('concurrency', {}))
+
+
+def read_memory(inp_file):
+    """
+    Reads the [memory] table (limit, chunk_fraction, spill_dir, min_rows)
+    of a toml file into a MemoryBudget
+    """
+    with open(str(inp_file), "rb") as inp_file:
+        inp_dict = tomli.load(inp_file)
+
+    return MemoryBudget(**inp_dict.get('memory', {}))
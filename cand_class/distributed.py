@@ -0,0 +1,169 @@
+import multiprocessing as mp
+import os
+import queue
+import time
+
+import pandas as pd
+import tomli
+import uproot
+import xgboost as xgb
+from hipe4ml.tree_handler import TreeHandler
+
+from cand_class.concurrency import get_budget
+from cand_class.config_reader import read_log_vars, read_train_vars, sideband_selection
+from cand_class.helper import transform_df_to_log
+from cand_class.model_io import native_params
+from cand_class.profiling import profiled
+
+
+def load_shard(input_file, mass_var, rank, n_workers):
+    """
+    Loads the rank-th shard of the signal and background samples described in
+    the input toml (same format as for config_reader.convertDF). Every file is
+    split into n_workers contiguous entry ranges, so no worker reads the full
+    sample. The requested numbers of events are divided between the workers
+
+    Returns
+    -------
+    signal and background TreeHandler objects of the shard
+    """
+    with open(str(input_file), "rb") as inp_file:
+        inp_info = tomli.load(inp_file)
+
+    handlers = []
+    for sample, n_events_key in (('signal', 'number_of_signal_events'),
+                                 ('background', 'number_of_background_events')):
+        paths = inp_info[sample]["path"]
+        paths = paths if isinstance(paths, list) else [paths]
+        tree = inp_info[sample]["tree"]
+
+        frames = []
+        for path in paths:
+            with uproot.open(path) as root_file:
+                n_entries = root_file[tree].num_entries
+            frames.append(TreeHandler(path, tree, entry_start=n_entries*rank//n_workers,
+                                      entry_stop=n_entries*(rank+1)//n_workers).get_data_frame())
+
+        handler = TreeHandler()
+        handler.set_data_frame(pd.concat(frames, ignore_index=True))
+
+        if sample == 'background':
+            # select first, so the size is capped by the candidates left in the sidebands
+            handler.apply_preselections(sideband_selection(inp_info, mass_var), inplace=True)
+        size = inp_info["number_of_events"][n_events_key] // n_workers
+        handlers.append(handler.get_subset(size=min(size, handler.get_n_cand())))
+
+    return handlers[0], handlers[1]
+
+
+def _start_tracker(n_workers):
+    # the tracker api changed in xgboost 2.0
+    if hasattr(xgb.tracker.RabitTracker, 'worker_args'):
+        tracker = xgb.tracker.RabitTracker(host_ip='127.0.0.1', n_workers=n_workers, sortby='task')
+        tracker.start()
+        return tracker, tracker.worker_args(), 'dmlc_task_id'
+
+    tracker = xgb.tracker.RabitTracker(host_ip='127.0.0.1', n_workers=n_workers, sortby='task')
+    tracker.start(n_workers)
+    args = tracker.worker_envs()
+    args['DMLC_NUM_WORKER'] = n_workers
+    return tracker, args, 'DMLC_TASK_ID'
+
+
+def _train_worker(rank, n_workers, comm_args, input_file, mass_var, log_vars_file, train_vars_file,
+                  label, params, num_boost_round, results):
+    load_start = time.perf_counter()
+    signal, background = load_shard(input_file, mass_var, rank, n_workers)
+    df = pd.concat([signal.get_data_frame().assign(**{label: 1}),
+                    background.get_data_frame().assign(**{label: 0})], ignore_index=True)
+
+    non_log_x, log_x = read_log_vars(log_vars_file)
+    df = transform_df_to_log(df, non_log_x + log_x, non_log_x, log_x)
+    features = read_train_vars(train_vars_file)
+    dtrain = xgb.DMatrix(df[features], label=df[label])
+    load_time = time.perf_counter() - load_start
+
+    with xgb.collective.CommunicatorContext(**comm_args):
+        train_start = time.perf_counter()
+        booster = xgb.train(params, dtrain, num_boost_round)
+        train_time = time.perf_counter() - train_start
+
+    model = bytes(booster.save_raw()) if rank == 0 else None
+    results.put({'rank': rank, 'rows': len(df), 'load_time': load_time, 'train_time': train_time, 'model': model})
+
+
+@profiled(rows=lambda res, *args, **kwargs: sum(stat['rows'] for stat in res[1]))
+def train_distributed(input_file, mass_var, log_vars_file, train_vars_file, model_params, n_workers=2,
+                      label='issignal', output_path=None, model_name='xgb_model_distributed.json'):
+    """
+    Trains one booster with n_workers local processes using XGBoost collective
+    communication. Every worker loads only its shard of the training sample
+    (see load_shard), histograms are all-reduced between the workers, so the
+    result is a single model trained on the union of the shards
+
+    Parameters
+    ------------------------------------------------
+    input_file: str
+        input toml with signal and background samples, see config_reader.convertDF
+    mass_var: str
+        name of the invariant mass variable (used for the background sidebands)
+    log_vars_file: str
+        toml with log and non-log variables, see config_reader.read_log_vars
+    train_vars_file: str
+        toml with train variables, see config_reader.read_train_vars
+    model_params: dict
+        XGBClassifier parameters, for example ModelHandler.get_model_params()
+    n_workers: int
+        number of worker processes
+    label: str
+        name of the signal label column
+    output_path: str
+        if set, the model is saved to output_path/model_name
+
+    Returns
+    -------
+    trained xgboost.Booster and list of per-worker statistics
+    """
+    params, num_boost_round = native_params(model_params)
+    params.setdefault('nthread', max(1, get_budget().total_cores // n_workers))
+    params.setdefault('tree_method', 'hist')
+
+    tracker, comm_args, task_key = _start_tracker(n_workers)
+
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    workers = []
+    for rank in range(n_workers):
+        worker_args = dict(comm_args)
+        worker_args[task_key] = str(rank)
+        workers.append(ctx.Process(target=_train_worker, args=(rank, n_workers, worker_args, input_file, mass_var,
+                                                               log_vars_file, train_vars_file, label, params,
+                                                               num_boost_round, results)))
+    for worker in workers:
+        worker.start()
+
+    stats = []
+    while len(stats) < n_workers:
+        try:
+            stats.append(results.get(timeout=1))
+        except queue.Empty:
+            failed = [str(worker.exitcode) for worker in workers if worker.exitcode not in (None, 0)]
+            if failed:
+                for worker in workers:
+                    worker.terminate()
+                raise RuntimeError('Distributed training workers failed with exit codes '+', '.join(failed))
+    for worker in workers:
+        worker.join()
+    tracker.join()
+
+    stats = sorted(stats, key=lambda res: res['rank'])
+
+    booster = xgb.Booster()
+    booster.load_model(bytearray(stats[0].pop('model')))
+    for res in stats[1:]:
+        res.pop('model')
+
+    if output_path is not None:
+        booster.save_model(os.path.join(output_path, model_name))
+
+    return booster, stats
@@ -0,0 +1,298 @@
+import json
+import os
+from contextlib import ExitStack
+
+import numpy as np
+import pandas as pd
+
+from cand_class.bootstrap import logit_edges, metrics_from_histograms
+from cand_class.features import feature_matrix, required_branches
+from cand_class.loader import ChunkLoader
+from cand_class.memory import get_memory_budget
+from cand_class.model_io import as_booster, booster_features, load_booster
+from cand_class.profiling import profiled
+
+
+def _model_booster(model):
+    if isinstance(model, (str, os.PathLike)):
+        return load_booster(model)
+    return as_booster(model)
+
+
+def _dataset_chunks(dataset, branches, label, step_size):
+    """
+    Yields (chunk, labels) of a DataFrame or of {'files', 'tree', 'label'} ROOT
+    files; label is a column/branch name or a fixed 0/1 for the whole dataset
+    """
+    if isinstance(dataset, pd.DataFrame):
+        for start in range(0, len(dataset), step_size):
+            chunk = dataset.iloc[start:start + step_size]
+            yield chunk, _labels(chunk, label)
+        return
+
+    label = dataset.get('label', label)
+    read = branches + ([label] if isinstance(label, str) and label not in branches else [])
+    if not read:
+        # all scores come from the store and the label is fixed, nothing to read
+        n_rows = _n_rows(dataset)
+        for start in range(0, n_rows, step_size):
+            chunk = pd.DataFrame(index=pd.RangeIndex(start, min(start + step_size, n_rows)))
+            yield chunk, _labels(chunk, label)
+        return
+    for _, chunk in ChunkLoader(dataset['files'], dataset['tree'], read, step_size):
+        yield chunk, _labels(chunk, label)
+
+
+def _n_rows(dataset):
+    if isinstance(dataset, pd.DataFrame):
+        return len(dataset)
+    import uproot
+
+    files = [dataset['files']] if isinstance(dataset['files'], str) else dataset['files']
+    n_rows = 0
+    for file_name in files:
+        with uproot.open(file_name) as root_file:
+            n_rows += root_file[dataset['tree']].num_entries
+    return n_rows
+
+
+def _labels(chunk, label):
+    if isinstance(label, str):
+        return chunk[label].to_numpy().astype(np.int8)
+    return np.full(len(chunk), label, dtype=np.int8)
+
+
+class ScoreHistograms:
+    """
+    Signal and background score histograms per (model, dataset) on fixed
+    bins of the probability, filled chunk by chunk and mergeable. Every
+    metric and plot of the evaluation is derived from them. The bins are
+    uniform in logit(score) (bootstrap.logit_edges) and closed on the right,
+    so bins >= i hold the candidates with score > edges[i]; the given
+    thresholds are added as edges, so the confusion counts at them are exact
+
+    Parameters
+    ------------------------------------------------
+    models: list of str
+        model names
+    datasets: list of str
+        dataset names
+    bins: int
+        number of score bins in [0, 1]
+    thresholds: list of float
+        BDT cuts added to the edges
+    """
+
+    def __init__(self, models, datasets, bins=10000, thresholds=()):
+        self.models = list(models)
+        self.datasets = list(datasets)
+        self.edges = np.union1d(logit_edges(bins), np.clip(np.asarray(list(thresholds), dtype=np.float64), 0, 1))
+        n_bins = len(self.edges) - 1
+        self.sig = np.zeros((len(self.models), len(self.datasets), n_bins))
+        self.bgr = np.zeros((len(self.models), len(self.datasets), n_bins))
+
+    def fill(self, model, dataset, scores, labels):
+        n_bins = len(self.edges) - 1
+        index = np.searchsorted(self.edges, np.asarray(scores, dtype=np.float64), side='left') - 1
+        index = np.clip(index, 0, n_bins - 1)
+        i, j = self.models.index(model), self.datasets.index(dataset)
+        self.sig[i, j] += np.bincount(index[labels == 1], minlength=n_bins)
+        self.bgr[i, j] += np.bincount(index[labels == 0], minlength=n_bins)
+
+    def merge(self, other):
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Score histograms with different bin edges cannot be merged')
+        self.sig += other.sig
+        self.bgr += other.bgr
+        return self
+
+    def confusion(self, model, dataset, threshold):
+        """
+        [[TP, FN], [FP, TN]] at the cut score > threshold, the layout of
+        confusion_matrix(labels=[1, 0]) in ApplyXGB.CM_plot_train_test. Exact
+        if threshold is one of the edges, otherwise the cut is moved up to the
+        next edge
+        """
+        i, j = self.models.index(model), self.datasets.index(dataset)
+        cut = int(np.searchsorted(self.edges, threshold, side='left'))
+        sig, bgr = self.sig[i, j], self.bgr[i, j]
+        return np.array([[sig[cut:].sum(), sig[:cut].sum()], [bgr[cut:].sum(), bgr[:cut].sum()]], dtype=np.int64)
+
+    def roc(self, model, dataset):
+        i, j = self.models.index(model), self.datasets.index(dataset)
+        tpr = np.concatenate([np.cumsum(self.sig[i, j][::-1])[::-1], [0]]) / max(self.sig[i, j].sum(), 1)
+        fpr = np.concatenate([np.cumsum(self.bgr[i, j][::-1])[::-1], [0]]) / max(self.bgr[i, j].sum(), 1)
+        return fpr, tpr
+
+
+@profiled(rows=lambda res, *args, **kwargs: res[1].attrs['candidates'])
+def evaluate_models(models, datasets, label='issignal', bins=10000, step_size=None, thresholds=None,
+                    reference=None, nthread=None, score_store=None):
+    """
+    Evaluates M models on N datasets reading every dataset once: each chunk is
+    transformed once per distinct feature list and scored by all models in the
+    same loop, only binned score histograms are kept
+
+    Parameters
+    ------------------------------------------------
+    models: dict
+        name -> model file (see model_io.load_booster), Booster, XGBClassifier
+        or ModelHandler
+    datasets: dict
+        name -> pandas.DataFrame (model features or raw branches plus label) or
+        {'files': [...], 'tree': 't', 'label': 'issignal' or 0/1}
+    label: str
+        label column of DataFrame datasets, 1 for signal
+    bins: int
+        score bins in [0, 1], uniform in logit(score) (see ScoreHistograms)
+    step_size: int
+        candidates per chunk, by default sized from the memory budget (the
+        branches read, their feature matrices and the scores of all models)
+    thresholds: dict
+        model -> BDT cut for the confusion matrices, by default the AMS-optimal
+        cut of the model on the reference dataset
+    reference: str
+        dataset the default thresholds are taken from, by default the first
+        one with signal and background
+    score_store: score_store.ScoreStore
+        scores of (model, dataset) pairs in the store are read from it instead
+        of predicted, new ones are added; a dataset with all scores stored is
+        only read for its labels
+
+    Returns
+    -------
+    ScoreHistograms and a DataFrame with one row per (model, dataset): auc,
+    ams, ams_threshold, efficiencies, threshold and confusion matrix counts.
+    The metrics comparing signal with background are NaN for datasets with
+    candidates of one label only (e.g. a fixed label)
+    """
+    boosters = {name: _model_booster(model) for name, model in models.items()}
+    features = {name: booster_features(booster) for name, booster in boosters.items()}
+    if nthread is not None:
+        for booster in boosters.values():
+            booster.set_param({'nthread': nthread})
+
+    model_keys = {}
+    if score_store is not None:
+        from cand_class.score_store import dataset_key, model_key
+
+        model_keys = {name: model_key(booster) for name, booster in boosters.items()}
+
+    thresholds = dict(thresholds or {})
+    hists = ScoreHistograms(boosters, datasets, bins, thresholds.values())
+    n_candidates = 0
+    for dataset_name, dataset in datasets.items():
+        stored, entries = {}, {}
+        with ExitStack() as stack:
+            for model_name in (boosters if score_store is not None else []):
+                keys = (model_keys[model_name], dataset_key(dataset, features[model_name]))
+                if keys in score_store:
+                    stored[model_name] = score_store.get(*keys)
+                else:
+                    entries[model_name] = stack.enter_context(score_store.open_entry(
+                        *keys, _n_rows(dataset), features=features[model_name], name=dataset_name))
+            to_predict = [name for name in boosters if name not in stored]
+            read = required_branches([feature for name in to_predict for feature in features[name]])
+            rows_per_chunk = step_size or get_memory_budget().chunk_rows(12 * len(read) + 4 * len(boosters) + 8)
+
+            offset = 0
+            for chunk, labels in _dataset_chunks(dataset, read, label, rows_per_chunk):
+                n_candidates += len(chunk)
+                rows = slice(offset, offset + len(chunk))
+                offset += len(chunk)
+                matrices = {}
+                for model_name, booster in boosters.items():
+                    if model_name in stored:
+                        hists.fill(model_name, dataset_name, stored[model_name][rows], labels)
+                        continue
+                    key = tuple(features[model_name])
+                    if key not in matrices:
+                        if all(feature in chunk.columns for feature in key):
+                            matrices[key] = chunk[list(key)].to_numpy(dtype=np.float32)
+                        else:
+                            matrices[key] = feature_matrix(chunk, list(key))
+                    scores = booster.inplace_predict(matrices[key])
+                    if model_name in entries:
+                        entries[model_name][rows] = scores
+                    hists.fill(model_name, dataset_name, scores, labels)
+
+    # the labels are the same for all models
+    one_label = (hists.sig[0].sum(axis=1) == 0) | (hists.bgr[0].sum(axis=1) == 0)
+    both_labels = [name for name, one in zip(hists.datasets, one_label) if not one]
+    reference = reference or (both_labels[0] if both_labels else hists.datasets[0])
+    rows = []
+    for i, model_name in enumerate(hists.models):
+        metrics = metrics_from_histograms(hists.sig[i], hists.bgr[i], hists.edges)
+        for values in metrics.values():
+            values[one_label] = np.nan
+        thresholds.setdefault(model_name, float(metrics['ams_threshold'][hists.datasets.index(reference)]))
+        if np.isnan(thresholds[model_name]):
+            raise ValueError('Dataset '+reference+' has candidates of one label only, '
+                             'pass the threshold of model '+model_name)
+        for j, dataset_name in enumerate(hists.datasets):
+            (tp, fn), (fp, tn) = hists.confusion(model_name, dataset_name, thresholds[model_name])
+            row = {'model': model_name, 'dataset': dataset_name,
+                   'candidates': int(hists.sig[i, j].sum() + hists.bgr[i, j].sum())}
+            row.update({metric: float(values[j]) for metric, values in metrics.items()})
+            row.update({'threshold': thresholds[model_name], 'tp': int(tp), 'fn': int(fn), 'fp': int(fp),
+                        'tn': int(tn)})
+            rows.append(row)
+
+    table = pd.DataFrame(rows)
+    table.attrs['candidates'] = n_candidates
+    return hists, table
+
+
+@profiled()
+def plot_comparison(hists, output_path):
+    """
+    ROC curves of all models per dataset (roc_comparison_<dataset>.png) and
+    score distributions of signal and background (scores_<dataset>.png)
+    """
+    import matplotlib.pyplot as plt
+
+    n_bins = len(hists.edges) - 1
+    # coarser bins for the distributions, the fine ones are for the metrics
+    group = max(1, n_bins // 100)
+    n_coarse = n_bins // group
+    for j, dataset_name in enumerate(hists.datasets):
+        fig, ax = plt.subplots(figsize=(8, 7))
+        for model_name in hists.models:
+            fpr, tpr = hists.roc(model_name, dataset_name)
+            auc = float(np.sum((fpr[:-1] - fpr[1:]) * (tpr[:-1] + tpr[1:]) / 2))
+            ax.plot(fpr, tpr, label=model_name+' (AUC = %.4f)' % auc)
+        ax.plot([0, 1], [0, 1], linestyle='--', color='grey')
+        ax.set_xlabel('False positive rate', fontsize=15)
+        ax.set_ylabel('True positive rate', fontsize=15)
+        ax.set_title(dataset_name, fontsize=16)
+        ax.legend(fontsize=12)
+        fig.tight_layout()
+        fig.savefig(os.path.join(output_path, 'roc_comparison_'+dataset_name+'.png'))
+        plt.close(fig)
+
+        fig, ax = plt.subplots(figsize=(10, 7))
+        coarse_edges = hists.edges[::group][:n_coarse + 1]
+        for i, model_name in enumerate(hists.models):
+            for counts, style, sample in ((hists.sig[i, j], '-', 'signal'), (hists.bgr[i, j], '--', 'background')):
+                coarse = counts[:n_coarse * group].reshape(n_coarse, group).sum(axis=1)
+                ax.stairs(coarse, coarse_edges, linestyle=style, color='C%d' % i, label=model_name+' '+sample)
+        ax.set_yscale('log')
+        # the bins are uniform in logit(score)
+        ax.set_xscale('logit')
+        ax.set_xlabel('BDT score', fontsize=15)
+        ax.set_ylabel('Counts', fontsize=15)
+        ax.set_title(dataset_name, fontsize=16)
+        ax.legend(fontsize=11)
+        fig.tight_layout()
+        fig.savefig(os.path.join(output_path, 'scores_'+dataset_name+'.png'))
+        plt.close(fig)
+
+
+def write_tables(table, output_path, file_name='model_comparison'):
+    """
+    Writes the metric table as csv and json
+    """
+    os.makedirs(output_path, exist_ok=True)
+    table.to_csv(os.path.join(output_path, file_name+'.csv'), index=False)
+    with open(os.path.join(output_path, file_name+'.json'), 'w', encoding="utf-8") as out_file:
+        json.dump(table.to_dict(orient='records'), out_file, indent=2)
@@ -0,0 +1,49 @@
+import numpy as np
+
+
+def raw_branch(feature):
+    """
+    Returns the tree branch a feature is computed from, i.e. 'log(chi2)' -> 'chi2'
+    (see helper.transform_df_to_log for the naming convention)
+    """
+    if feature.startswith('log(') and feature.endswith(')'):
+        return feature[4:-1]
+    return feature
+
+
+def required_branches(features, extra=()):
+    """
+    Returns the unique list of tree branches needed to build features and
+    any extra branches that should be read along
+    """
+    branches = []
+    for name in [raw_branch(feature) for feature in features] + list(extra):
+        if name not in branches:
+            branches.append(name)
+    return branches
+
+
+def feature_matrix(df, features, dtype=np.float32):
+    """
+    Builds the model input matrix from raw branches
+
+    Parameters
+    ------------------------------------------------
+    df: pandas.DataFrame
+        chunk of candidates with raw branches
+    features: list of str
+        model features in training order, 'log(var)' features are computed
+        as natural logarithm of var
+    dtype: numpy dtype
+        dtype of the returned matrix
+    """
+    matrix = np.empty((len(df), len(features)), dtype=dtype)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, feature in enumerate(features):
+            values = df[raw_branch(feature)].to_numpy()
+            if feature != raw_branch(feature):
+                values = np.log(values)
+            matrix[:, i] = values
+
+    return matrix
@@ -1,14 +1,34 @@
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 
-import xgboost as xgb
-from sklearn.metrics import confusion_matrix, roc_curve, roc_auc_score
 from numpy import sqrt, log, argmax
 import itertools
-import treelite
 
+from cand_class.concurrency import get_budget
+from cand_class.lazy import lazy_import
+from cand_class.plotting import count_ylim, hist_counts, use_headless
+from cand_class.profiling import profiled
 
+# heavy dependencies are imported on first use, see cand_class.lazy
+plt = lazy_import('matplotlib.pyplot', 'plot')
+xgb = lazy_import('xgboost')
+metrics = lazy_import('sklearn.metrics', 'train')
+treelite = lazy_import('treelite', 'treelite')
+
+
+def confusion_matrix(*args, **kwargs):
+    return metrics.confusion_matrix(*args, **kwargs)
+
+
+def roc_curve(*args, **kwargs):
+    return metrics.roc_curve(*args, **kwargs)
+
+
+def roc_auc_score(*args, **kwargs):
+    return metrics.roc_auc_score(*args, **kwargs)
+
+
+@profiled(rows=0)
 def transform_df_to_log(df, vars, non_log_x, log_x):
     """
     Transforms DataFrame to DataFrame with features in log scale
@@ -31,6 +51,7 @@ def transform_df_to_log(df, vars, non_log_x, log_x):
     return df_new
 
 
+@profiled(rows=lambda res, *args, **kwargs: len(args[0]) + len(args[2]))
 def xgb_matr(x_train, y_train, x_test, y_test, cuts):
     """
     To make machine learning algorithms more efficient on unseen data we divide
@@ -52,33 +73,30 @@ def xgb_matr(x_train, y_train, x_test, y_test, cuts):
     return dtrain, dtest
 
 
-def AMS(y_true, y_predict, y_true1, y_predict1, output_path):
-    roc_auc=roc_auc_score(y_true, y_predict)
-    fpr, tpr, thresholds = roc_curve(y_true, y_predict,drop_intermediate=False ,pos_label=1)
-
-    for i in range(len(thresholds)):
-        if thresholds[i] > 1:
-            thresholds[i]-=1
+def ams_threshold(y_true, y_predict):
+    """
+    BDT cut maximising the approximate median significance on one dataset
 
-    S0 = sqrt(2 * ((tpr + fpr) * log((1 + tpr/fpr)) - tpr))
-    S0 = S0[~np.isnan(S0)]
-    S0 = S0[~np.isinf(S0)]
+    Returns
+    -------
+    best threshold, fpr and tpr of the ROC curve
+    """
+    fpr, tpr, thresholds = roc_curve(y_true, y_predict, drop_intermediate=False, pos_label=1)
+    # the first threshold is max(score) + 1 (or inf), the cut that keeps nothing
+    thresholds[thresholds > 1] -= 1
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        S0 = sqrt(2 * ((tpr + fpr) * log((1 + tpr/fpr)) - tpr))
+    # mask rather than drop non-finite values, so xi stays aligned with thresholds
+    S0[~np.isfinite(S0)] = -np.inf
     xi = argmax(S0)
-    S0_best_threshold = (thresholds[xi])
-
-    roc_auc1=roc_auc_score(y_true1, y_predict1)
-    fpr1, tpr1, thresholds1 = roc_curve(y_true1, y_predict1,drop_intermediate=False ,pos_label=1)
-
-    for i in range(len(thresholds1)):
-        if thresholds1[i] > 1:
-            thresholds1[i]-=1
+    return thresholds[xi], fpr, tpr
 
-    S01 = sqrt(2 * ((tpr1 + fpr1) * log((1 + tpr1/fpr1)) - tpr1))
-    S01 = S01[~np.isnan(S01)]
-    S01 = S01[~np.isinf(S01)]
-    xi1 = argmax(S01)
-    S0_best_threshold1 = (thresholds[xi1])
 
+@profiled(rows=lambda res, *args, **kwargs: len(args[0]) + len(args[2]))
+def AMS(y_true, y_predict, y_true1, y_predict1, output_path):
+    S0_best_threshold, fpr, tpr = ams_threshold(y_true, y_predict)
+    S0_best_threshold1, fpr1, tpr1 = ams_threshold(y_true1, y_predict1)
 
     roc_curve_data = dict()
     roc_curve_data["fpr_train"] = fpr
@@ -90,10 +108,15 @@ def AMS(y_true, y_predict, y_true1, y_predict1, output_path):
     return S0_best_threshold, S0_best_threshold1, roc_curve_data
 
 
+@profiled()
 def plot_confusion_matrix(cm, classes,
                           normalize=False,
                           title='Confusion matrix',
-                          cmap=plt.cm.Blues):
+                          cmap=None, ax=None):
+    if cmap is None:
+        cmap = plt.cm.Blues
+    if ax is None:
+        ax = plt.gca()
     if normalize:
         cm = cm.astype('float') / cm.sum(axis=1)[:, np.newaxis]
         print("Normalized confusion matrix")
@@ -102,62 +125,58 @@ def plot_confusion_matrix(cm, classes,
 
     print(cm)
 
-    # plt.subplots(figsize=(12, 9))
-    # plt.figure(figsize = (6, 5))
-    plt.imshow(cm, interpolation='nearest', cmap=cmap)
+    image = ax.imshow(cm, interpolation='nearest', cmap=cmap)
 
-    plt.title(title, fontsize = 20)
-    plt.colorbar()
+    ax.set_title(title, fontsize = 20)
+    ax.figure.colorbar(image, ax=ax)
     tick_marks = np.arange(len(classes))
-    plt.xticks(tick_marks, classes, rotation=45)
-    plt.yticks(tick_marks, classes)
+    ax.set_xticks(tick_marks, classes, rotation=45)
+    ax.set_yticks(tick_marks, classes)
 
     fmt = '.2f' if normalize else 'd'
     thresh = cm.max() / 2.
     for i, j in itertools.product(range(cm.shape[0]), range(cm.shape[1])):
-        plt.text(j, i, format(cm[i, j], fmt),
-                 horizontalalignment="center",
-                 color="white" if cm[i, j] > thresh else "black", size = 15)
+        ax.text(j, i, format(cm[i, j], fmt),
+                horizontalalignment="center",
+                color="white" if cm[i, j] > thresh else "black", size = 15)
 
-    plt.tight_layout()
-    plt.ylabel('True label',fontsize = 15)
-    plt.xlabel('Predicted label',fontsize = 15)
+    ax.figure.tight_layout()
+    ax.set_ylabel('True label',fontsize = 15)
+    ax.set_xlabel('Predicted label',fontsize = 15)
 
 
-def preds_prob(df, preds, true, dataset, output_path):
+@profiled(rows=0)
+def preds_prob(df, preds, true, dataset, output_path, bins=100):
+    """
+    Distribution of the model output for all candidates and for the signal
+    and background among them. The scores are binned once (one bincount pass
+    split by the true label) and the figure is drawn from the counts
+    """
+    use_headless()
     if dataset =='train':
         label1 = 'XGB Predictions on the training data set'
     else:
         label1 = 'XGB Predictions on the test data set'
+    edges = np.linspace(0, 1, bins + 1)
+    counts = hist_counts(df[preds].to_numpy(), edges, (df[true].to_numpy() == 1).astype(np.intp), 2)
+    hist1, hist = counts
+    center = (edges[:-1] + edges[1:]) / 2
+
     fig, ax = plt.subplots(figsize=(12, 8))
-    bins1=100
-    plt.hist(df[preds], bins=bins1,facecolor='green',alpha = 0.3, label=label1)
-    TP = df[(df[true]==1)]
-    TN = df[(df[true]==0)]
-    #TP[preds].plot.hist(ax=ax, bins=bins1,facecolor='blue', histtype='stepfilled',alpha = 0.3, label='True Positives/signal in predictions')
-    hist, bins = np.histogram(TP[preds], bins=bins1)
-    err = np.sqrt(hist)
-    center = (bins[:-1] + bins[1:]) / 2
-
-
-    hist1, bins1 = np.histogram(TN[preds], bins=bins1)
-    err1 = np.sqrt(hist1)
-    plt.errorbar(center, hist1, yerr=err1, fmt='o',
-                 c='Red', label='Background in predictions')
-
-    plt.errorbar(center, hist, yerr=err, fmt='o',
-                 c='blue', label='Signal in predictions')
-
-    ax.set_yscale('log')
-    plt.xlabel('Probability',fontsize=18)
-    plt.ylabel('Counts', fontsize=18)
-    plt.legend(fontsize=18)
+    ax.stairs(hist + hist1, edges, fill=True, facecolor='green', alpha=0.3, label=label1)
+    ax.errorbar(center, hist1, yerr=np.sqrt(hist1), fmt='o', c='Red', label='Background in predictions')
+    ax.errorbar(center, hist, yerr=np.sqrt(hist), fmt='o', c='blue', label='Signal in predictions')
+
+    count_ylim(ax, [hist + hist1], log=True)
+    ax.set_xlabel('Probability',fontsize=18)
+    ax.set_ylabel('Counts', fontsize=18)
+    ax.legend(fontsize=18)
     ax.set_xticks(np.arange(0,1.1,0.1))
     ax.tick_params(axis='both', which='major', labelsize=18)
     ax.tick_params(axis='both', which='minor', labelsize=16)
-    plt.show()
     fig.tight_layout()
     fig.savefig(str(output_path)+'/test_best_pred.png')
+    plt.close(fig)
 
 
 def diff_SB(df, signal_label):
@@ -179,16 +198,20 @@ def diff_SB_cut(df, target_label):
 
 
 
-def save_model_lib(bst_model, output_path):
-    bst = bst_model.get_booster()
+@profiled()
+def save_model_lib(bst_model, output_path, parallel_comp=None):
+    # XGBClassifier or a plain Booster (e.g. from compaction.compact_model)
+    bst = bst_model.get_booster() if hasattr(bst_model, 'get_booster') else bst_model
+    if parallel_comp is None:
+        parallel_comp = get_budget().total_cores
 
     #create an object out of your model, bst in our case
     model = treelite.Model.from_xgboost(bst)
     #use GCC compiler
     toolchain = 'gcc'
-    #parallel_comp can be changed upto as many processors as one have
+    #parallel_comp defaults to the cores of the thread budget
     model.export_lib(toolchain=toolchain, libpath=output_path+'/xgb_model.so',
-                     params={'parallel_comp': 4}, verbose=True)
+                     params={'parallel_comp': parallel_comp}, verbose=True)
 
 
     # Operating system of the target machine
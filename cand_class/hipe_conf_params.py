@@ -1,11 +1,16 @@
-from hipe4ml.model_handler import ModelHandler
 from dataclasses import dataclass
-import xgboost as xgb
 
-import matplotlib.pyplot as plt
-from hipe4ml import plot_utils
+import numpy as np
 
-import xgboost as xgb
+from cand_class.concurrency import get_budget
+from cand_class.lazy import lazy_import
+from cand_class.plotting import hist_counts, use_headless
+from cand_class.profiling import profiled
+
+# training and plotting dependencies are imported on first use, see cand_class.lazy
+xgb = lazy_import('xgboost')
+plt = lazy_import('matplotlib.pyplot', 'plot')
+model_handler = lazy_import('hipe4ml.model_handler', 'train')
 
 
 @dataclass
@@ -14,25 +19,48 @@ class XGBmodel():
     hyper_pars_ranges: dict
     train_test_data: list
     output_path : str
-    __model_hdl: ModelHandler = (None, None, None)
+    __model_hdl: 'ModelHandler' = (None, None, None)
     metrics: str = 'roc_auc'
     nfold: int = 3
     init_points: int = 1
     n_iter: int = 2
-    n_jobs: int = -1
+    n_jobs: int = None
+    thread_budget: object = None
+
+
 
 
+    def budget(self):
+        """
+        Thread budget of this model, falls back to the package-wide one
+        (see concurrency.set_budget)
+        """
+        return self.thread_budget if self.thread_budget is not None else get_budget()
 
 
+    @profiled(rows=lambda res, self: len(self.train_test_data[0]))
     def modelBO(self):
-        model_clf = xgb.XGBClassifier()
-        self.__model_hdl = ModelHandler(model_clf, self.features_for_train)
+        budget = self.budget()
+        n_jobs = self.n_jobs if self.n_jobs is not None else budget.outer
+
+        model_clf = xgb.XGBClassifier(n_jobs=budget.inner)
+        self.__model_hdl = model_handler.ModelHandler(model_clf, self.features_for_train)
         self.__model_hdl.optimize_params_bayes(self.train_test_data, self.hyper_pars_ranges,
-         self.metrics, self.nfold, self.init_points, self.n_iter, self.n_jobs)
+         self.metrics, self.nfold, self.init_points, self.n_iter, n_jobs)
+
+        budget.record(self.output_path, 'modelBO', trials=n_jobs, nthread=budget.inner)
 
 
 
+    @profiled(rows=lambda res, self: len(self.train_test_data[0]) + len(self.train_test_data[2]))
     def train_test_pred(self):
+        budget = self.budget()
+        # the final fit runs alone, so it gets all cores
+        model_params = dict(self.__model_hdl.get_model_params())
+        model_params['n_jobs'] = budget.total_cores
+        self.__model_hdl.set_model_params(model_params)
+        budget.record(self.output_path, 'train_test_pred', nthread=budget.total_cores)
+
         self.__model_hdl.train_test_model(self.train_test_data)
 
         y_pred_train = self.__model_hdl.predict(self.train_test_data[0], False)
@@ -42,12 +70,65 @@ class XGBmodel():
         return y_pred_train, y_pred_test
 
 
+    @profiled(rows=lambda res, self, *args, **kwargs: len(self.train_test_data[0]))
+    def train_stage_one(self, signal_efficiency=0.99, n_estimators=20, max_depth=2):
+        """
+        Trains a small shallow booster on the same training sample as the cheap
+        stage one of cascade scoring (see cascade.ShallowStage)
+        """
+        from cand_class.cascade import ShallowStage
+
+        return ShallowStage.train(self.train_test_data[0], self.train_test_data[1], self.features_for_train,
+                                  signal_efficiency, n_estimators, max_depth, self.budget().total_cores)
+
+
+    @profiled()
+    def compact(self, x_val, y_val, **kwargs):
+        """
+        Compacts the trained model in place (see compaction.compact_model),
+        validated on x_val, y_val. They must be independent of both the
+        training and the test sample, otherwise the truncation and the
+        tolerances are tuned on the sample the model is evaluated on. Returns
+        the compaction report
+        """
+        from cand_class.compaction import compact_model
+
+        if x_val is None or y_val is None:
+            raise ValueError('compact needs a validation sample independent of the train and test samples')
+        x_val = x_val[self.features_for_train] if hasattr(x_val, 'columns') else x_val
+        kwargs.setdefault('output_path', self.output_path)
+        kwargs.setdefault('nthread', self.budget().total_cores)
+        compact_booster, report = compact_model(self.get_mode_booster(), x_val, y_val, **kwargs)
+        self.get_mode_booster().load_model(bytearray(compact_booster.save_raw()))
+        return report
+
+
+    @profiled()
     def save_predictions(self, filename):
         print(self.__model_hdl.get_original_model())
         self.__model_hdl.dump_original_model(self.output_path+'/'+filename, xgb_format=False)
 
 
+    def save_artifact(self, dirname='model_artifact', threshold=None):
+        """
+        Saves the trained model as a model artifact (see artifact.save_artifact)
+        next to the other outputs, workers load it much faster than the pickle
+        """
+        from cand_class.artifact import save_artifact
+
+        return save_artifact(self.__model_hdl, self.output_path+'/'+dirname, self.features_for_train, threshold)
+
+
+    @profiled()
     def load_model(self, filename):
+        from cand_class.artifact import ModelArtifact, is_artifact
+
+        if is_artifact(filename):
+            artifact = ModelArtifact.load(filename)
+            model_clf = xgb.XGBClassifier(n_jobs=self.budget().total_cores)
+            model_clf.load_model(artifact.path+'/model.ubj')
+            self.__model_hdl = model_handler.ModelHandler(model_clf, artifact.features)
+            return
         self.__model_hdl.load_model_handler(filename)
 
 
@@ -55,10 +136,49 @@ class XGBmodel():
         return self.__model_hdl.model
 
 
-    def plot_dists(self):
-
+    @profiled()
+    def plot_dists(self, y_pred_train=None, y_pred_test=None, bins=100):
+        """
+        Model output of background and signal, training set as filled
+        histograms and test set as points, normalized to unit area (the plot of
+        hipe4ml.plot_utils.plot_output_train_test). The outputs of
+        train_test_pred can be passed in instead of predicting again; every
+        sample is binned once and drawn from the counts
+        """
+        use_headless()
+        x_train, y_train, x_test, y_test = self.train_test_data
+        if y_pred_train is None:
+            y_pred_train = self.__model_hdl.predict(x_train, False)
+        if y_pred_test is None:
+            y_pred_test = self.__model_hdl.predict(x_test, False)
+        y_pred_train, y_pred_test = np.asarray(y_pred_train), np.asarray(y_pred_test)
+        y_train, y_test = np.asarray(y_train).astype(np.intp), np.asarray(y_test).astype(np.intp)
+
+        low = min(y_pred_train.min(), y_pred_test.min())
+        high = max(y_pred_train.max(), y_pred_test.max())
+        edges = np.linspace(low, high, bins + 1) if high > low else np.linspace(low - 0.5, low + 0.5, bins + 1)
+        width = np.diff(edges)
+        center = (edges[:-1] + edges[1:]) / 2
+        counts_train = hist_counts(y_pred_train, edges, y_train, 2)
+        counts_test = hist_counts(y_pred_test, edges, y_test, 2)
+
+        fig, ax = plt.subplots()
         leg_labels = ['background', 'signal']
-        ml_out_fig = plot_utils.plot_output_train_test(self.__model_hdl, self.train_test_data, 100,
-                                               False, leg_labels, True, density=True)
-
-        plt.savefig(str(self.output_path)+'/thresholds.png')
+        densities = []
+        for label, color, train, test in zip(leg_labels, ['b', 'r'], counts_train, counts_test):
+            n_train, n_test = max(train.sum(), 1), max(test.sum(), 1)
+            densities.append(train / (n_train * width))
+            ax.stairs(densities[-1], edges, fill=True, color=color, alpha=0.5, label=label+' pdf Training Set')
+            ax.errorbar(center, test / (n_test * width), yerr=np.sqrt(test) / (n_test * width), fmt='o', c=color,
+                        label=label+' pdf Test Set')
+        positive = np.concatenate(densities)
+        positive = positive[positive > 0]
+        if len(positive):
+            ax.set_yscale('log')
+            ax.set_ylim(positive.min() / 2, positive.max() * 2)
+        ax.set_xlabel('BDT output', fontsize=13, ha='right', position=(1, 20))
+        ax.set_ylabel('Counts (arb. units)', fontsize=13, horizontalalignment='left')
+        ax.legend(frameon=False, fontsize=12, loc='best')
+
+        fig.savefig(str(self.output_path)+'/thresholds.png')
+        plt.close(fig)
@@ -1,11 +1,16 @@
-import ROOT
-
 from array import array
 
 from cand_class.helper import *
 
 from dataclasses import dataclass
 
+from cand_class.column_stats import ColumnStats
+from cand_class.lazy import lazy_import
+from cand_class.profiling import profiled
+
+# PyROOT is not on PyPI, it comes with a ROOT installation
+ROOT = lazy_import('ROOT', hint='install ROOT with its Python bindings (https://root.cern)')
+
 @dataclass
 class HistBuilder:
 
@@ -58,6 +63,7 @@ class HistBuilder:
         __hist_out.Close()
 
 
+    @profiled()
     def roc_curve_root(self):
         __hist_out = ROOT.TFile(self.output_path+'/'+self.root_output_name, "UPDATE");
 
@@ -106,6 +112,7 @@ class HistBuilder:
 
         __hist_out.Close()
 
+    @profiled(rows=1)
     def pt_rap_root(self, df_orig, df_cut, difference, sign, x_range, y_range, data_name):
 
         if sign ==0:
@@ -191,7 +198,9 @@ class HistBuilder:
         __hist_out.Close()
 
 
-    def hist_variables_root(self, mass_var, dfs_orig, dfb_orig, dfs_cut, dfb_cut,difference_s, sample):
+    @profiled(rows=lambda res, self, *args, **kwargs: sum(len(df) for df in args[1:6]))
+    def hist_variables_root(self, mass_var, dfs_orig, dfb_orig, dfs_cut, dfb_cut,difference_s, sample, stats=None,
+                            robust=False):
         """
         Applied quality cuts and created distributions for all the features in pdf
         file
@@ -205,7 +214,15 @@ class HistBuilder:
                 name of the feature to be plotted
         pdf_key: PdfPages object
                 name of pdf document with distributions
+        stats: column_stats.ColumnStats
+                statistics of signal and background before the cut, all five
+                histograms of a feature share its binning (so they can be
+                divided or subtracted), computed in one pass if not given
+        robust: bool
+                bin the central 99.8% quantile range instead of min to max
         """
+        if stats is None:
+            stats = ColumnStats.from_frame(dfs_orig).merge(ColumnStats.from_frame(dfb_orig))
 
         __hist_out = ROOT.TFile(self.output_path+'/'+self.root_output_name, "UPDATE");
         __hist_out.cd()
@@ -225,7 +242,7 @@ class HistBuilder:
 
 
             dfs_orig_root = ROOT.TH1D('signal before ML '+feature, 'signal before ML '+feature, 500,
-            min(dfs_orig[feature].values.tolist()), max(dfs_orig[feature].values.tolist()))
+            *stats.range(feature, robust))
 
             for i in range(len(dfs_orig_feat)):
                 dfs_orig_root.Fill(dfs_orig_feat[i])
@@ -235,7 +252,7 @@ class HistBuilder:
             dfs_orig_root.Draw()
 
             dfb_orig_root = ROOT.TH1D('background before ML '+feature, 'background before ML '+feature, 500,
-            min(dfb_orig[feature].values.tolist()), max(dfb_orig[feature].values.tolist()))
+            *stats.range(feature, robust))
 
             for i in range(len(dfb_orig_feat)):
                 dfb_orig_root.Fill(dfb_orig_feat[i])
@@ -245,7 +262,7 @@ class HistBuilder:
 
 
             dfs_cut_root = ROOT.TH1D('signal after ML '+feature, 'signal after ML '+feature, 500,
-            min(dfs_cut[feature].values.tolist()), max(dfs_cut[feature].values.tolist()))
+            *stats.range(feature, robust))
 
             for i in range(len(dfs_cut_feat)):
                 dfs_cut_root.Fill(dfs_cut_feat[i])
@@ -255,7 +272,7 @@ class HistBuilder:
 
 
             dfb_cut_root = ROOT.TH1D('background after ML '+feature, 'background after ML '+feature, 500,
-            min(dfb_cut[feature].values.tolist()), max(dfb_cut[feature].values.tolist()))
+            *stats.range(feature, robust))
 
             for i in range(len(dfb_cut_feat)):
                 dfb_cut_root.Fill(dfb_cut_feat[i])
@@ -265,7 +282,7 @@ class HistBuilder:
 
 
             dfs_diff_root = ROOT.TH1D('signal difference '+feature, 'signal difference '+feature, 500,
-            min(difference_s[feature].values.tolist()), max(difference_s[feature].values.tolist()))
+            *stats.range(feature, robust))
 
             for i in range(len(dfs_diff_feat)):
                 dfs_diff_root.Fill(dfs_diff_feat[i])
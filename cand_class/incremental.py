@@ -0,0 +1,309 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import tomli
+import xgboost as xgb
+from sklearn.metrics import log_loss, roc_auc_score
+
+from cand_class.concurrency import get_budget
+from cand_class.features import feature_matrix, required_branches
+from cand_class.loader import ChunkLoader, LoaderStats
+from cand_class.model_io import booster_features, load_booster, native_params
+from cand_class.profiling import profiled
+from cand_class.run_metadata import read_run_metadata, update_run_metadata
+
+
+def file_provenance(file_name, hash_file=True):
+    """
+    Path, size, modification time and (optionally) sha256 of an input file
+    """
+    stat = os.stat(file_name)
+    info = {'path': os.path.abspath(file_name), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if hash_file:
+        sha = hashlib.sha256()
+        with open(file_name, 'rb') as inp_file:
+            for block in iter(lambda: inp_file.read(1 << 20), b''):
+                sha.update(block)
+        info['sha256'] = sha.hexdigest()
+    return info
+
+
+def read_sources(input_file, mass_var):
+    """
+    Signal and background sources of an input toml (see config_reader.convertDF),
+    background is restricted to the sidebands of [peak_range]. The path may
+    be one file or a list of files
+
+    Returns
+    -------
+    list of dicts with files, tree, label and mass window
+    """
+    with open(str(input_file), "rb") as inp_file:
+        inp_info = tomli.load(inp_file)
+
+    peak = inp_info['peak_range']
+    sources = []
+    for sample, label in (('signal', 1), ('background', 0)):
+        paths = inp_info[sample]['path']
+        sources.append({
+            'files': [paths] if isinstance(paths, str) else list(paths),
+            'tree': inp_info[sample]['tree'],
+            'label': label,
+            'sidebands': None if label == 1 else [(peak['bgr_left_edge'], peak['sgn_left_edge']),
+                                                  (peak['sgn_right_edge'], peak['bgr_right_edge'])],
+        })
+    return sources
+
+
+class CandidateIter(xgb.DataIter):
+    """
+    Streams labelled candidates from ROOT files chunk by chunk into an
+    external-memory DMatrix. A deterministic fraction of every chunk is kept
+    in memory as held-out sample instead (up to max_holdout candidates, an
+    equal share per label, later candidates of a label are all trained on),
+    the split is the same in every pass XGBoost makes over the data
+
+    Parameters
+    ------------------------------------------------
+    sources: list of dict
+        from read_sources
+    features: list of str
+        model features, computed from raw branches
+    mass_var: str
+        mass branch for the sideband selection
+    step_size: int
+        candidates per chunk
+    holdout_fraction: float
+        fraction of candidates held out
+    max_holdout: int
+        largest held-out sample, split equally between the labels
+    cache_prefix: str
+        prefix of the XGBoost page cache files
+    """
+
+    def __init__(self, sources, features, mass_var, step_size=500000, holdout_fraction=0.1,
+                 max_holdout=1000000, cache_prefix=None, seed=0):
+        self.sources = sources
+        self.features = features
+        self.mass_var = mass_var
+        self.step_size = step_size
+        self.holdout_fraction = holdout_fraction
+        self.max_holdout = max_holdout
+        self.seed = seed
+        self.holdout_x, self.holdout_y = [], []
+        self.n_holdout = 0
+        # the quota is split between the labels, so one large source cannot fill the held-out sample alone
+        labels = sorted({source['label'] for source in sources})
+        self._label_quota = max_holdout // max(1, len(labels))
+        self._label_held = dict.fromkeys(labels, 0)
+        # held-out candidates allowed per chunk, fixed in the first pass
+        self._quota = {}
+        self.counts = {}
+        self.first_pass = True
+        self.io_stats = LoaderStats()
+        self._chunks = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def _generate(self):
+        branches = required_branches(self.features, [self.mass_var])
+        for source_id, source in enumerate(self.sources):
+            # the next chunk is read while XGBoost consumes the current one
+            loader = ChunkLoader(source['files'], source['tree'], branches, self.step_size, stats=self.io_stats)
+            chunk_id, previous = 0, None
+            for file_name, chunk in loader:
+                if file_name != previous:
+                    chunk_id, previous = 0, file_name
+                yield source_id, source['files'].index(file_name), chunk_id, source, file_name, chunk
+                chunk_id += 1
+
+    def next(self, input_data):
+        if self._chunks is None:
+            self._chunks = self._generate()
+        for source_id, file_id, chunk_id, source, file_name, chunk in self._chunks:
+            if source['sidebands'] is not None:
+                mass = chunk[self.mass_var].to_numpy()
+                keep = np.zeros(len(chunk), dtype=bool)
+                for low, high in source['sidebands']:
+                    keep |= (mass > low) & (mass < high)
+                chunk = chunk[keep]
+            if len(chunk) == 0:
+                continue
+
+            x = feature_matrix(chunk, self.features)
+            y = np.full(len(x), source['label'], dtype=np.float32)
+            rng = np.random.default_rng([self.seed, source_id, file_id, chunk_id])
+            held = rng.random(len(x)) < self.holdout_fraction
+            key = (source_id, file_id, chunk_id)
+            if self.first_pass:
+                self._quota[key] = self._label_quota - self._label_held[source['label']]
+            # once max_holdout is reached the candidates are trained on
+            held &= np.cumsum(held) <= self._quota.get(key, 0)
+
+            if self.first_pass:
+                counts = self.counts.setdefault(file_name, {'label': source['label'], 'train': 0, 'holdout': 0})
+                counts['train'] += int(np.count_nonzero(~held))
+                counts['holdout'] += int(np.count_nonzero(held))
+                if held.any():
+                    self.holdout_x.append(x[held])
+                    self.holdout_y.append(y[held])
+                    self.n_holdout += int(np.count_nonzero(held))
+                    self._label_held[source['label']] += int(np.count_nonzero(held))
+
+            if (~held).any():
+                input_data(data=x[~held], label=y[~held])
+                return 1
+        return 0
+
+    def reset(self):
+        if self._chunks is not None:
+            self.first_pass = False
+            # stops the read-ahead of an interrupted pass
+            self._chunks.close()
+        self._chunks = None
+
+    def holdout(self):
+        if not self.holdout_x:
+            return np.empty((0, len(self.features)), dtype=np.float32), np.empty(0, dtype=np.float32)
+        return np.concatenate(self.holdout_x), np.concatenate(self.holdout_y)
+
+
+def training_params(booster, params=None):
+    """
+    Booster parameters to continue training with: the XGBClassifier parameters
+    stored in the model (models saved through the scikit-learn interface) updated
+    with params. The external-memory path needs the hist tree method
+    """
+    stored = {}
+    sklearn_attr = booster.attr('scikit_learn')
+    if sklearn_attr is not None:
+        allowed = xgb.XGBClassifier().get_params()
+        stored = {key: value for key, value in json.loads(sklearn_attr).items()
+                  if key in allowed and value is not None and key not in ('n_estimators', 'n_jobs', 'missing')}
+    native, _ = native_params(stored)
+    native.update(params or {})
+    native['tree_method'] = 'hist'
+    return native
+
+
+def _metrics(booster, x, y):
+    scores = booster.inplace_predict(x) if len(x) else np.empty(0)
+    if len(np.unique(y)) < 2:
+        return {'auc': None, 'log_loss': None}
+    return {'auc': float(roc_auc_score(y, scores)),
+            'log_loss': float(log_loss(y, np.clip(scores, 1e-7, 1 - 1e-7)))}
+
+
+@profiled(rows=lambda res, *args, **kwargs: res[1]['candidates']['train'])
+def update_model(model_file, input_file, mass_var, output_path, num_boost_round=50, refresh_leaves=False,
+                 params=None, features=None, step_size=500000, holdout_fraction=0.1, max_holdout=1000000,
+                 hash_files=True, cache_dir=None, model_name='model_updated.json'):
+    """
+    Continues training an existing model on new data without starting from
+    scratch. Candidates are streamed from the files of input_file through an
+    external-memory DMatrix, so the new data does not have to fit in memory
+
+    Parameters
+    ------------------------------------------------
+    model_file: str
+        previous model, see model_io.load_booster (e.g. the ModelHandler
+        pickle read by XGBmodel.load_model)
+    input_file: str
+        input toml of the new production (signal and background paths may be lists)
+    mass_var: str
+        mass branch for the background sidebands
+    output_path: str
+        output directory for the updated model and the report
+    num_boost_round: int
+        trees added on top of the previous model
+    refresh_leaves: bool
+        keep the tree structure and only recompute the leaf values on the new
+        data instead of adding trees
+    params: dict
+        booster parameters overriding the ones stored in the model
+    features: list of str
+        train variables if they are not stored in the model
+    holdout_fraction: float
+        fraction of the new candidates held out to compare the models
+    max_holdout: int
+        largest held-out sample, split equally between signal and background
+    hash_files: bool
+        store sha256 of the input files in the provenance
+
+    Returns
+    -------
+    updated xgboost.Booster and the report dict
+    """
+    start = time.perf_counter()
+    previous = load_booster(model_file)
+    features = booster_features(previous, features)
+    budget = get_budget()
+    params = training_params(previous, params)
+    params['nthread'] = budget.total_cores
+    sources = read_sources(input_file, mass_var)
+
+    with tempfile.TemporaryDirectory(dir=cache_dir) as cache:
+        data_iter = CandidateIter(sources, features, mass_var, step_size, holdout_fraction, max_holdout,
+                                  cache_prefix=os.path.join(cache, 'cache'))
+        dtrain = xgb.DMatrix(data_iter)
+        dtrain.feature_names = features
+        # the first pass over the data has filled the held-out sample
+        if holdout_fraction > 0 and len(np.unique(data_iter.holdout()[1])) < 2:
+            # the page cache is released before its directory is removed
+            del dtrain
+            raise ValueError('The held-out sample has candidates of one label only, '
+                             'the models cannot be compared on it')
+
+        if refresh_leaves:
+            params.pop('tree_method')
+            params.update({'process_type': 'update', 'updater': 'refresh', 'refresh_leaf': True})
+            updated = xgb.train(params, dtrain, num_boost_round=previous.num_boosted_rounds(),
+                                xgb_model=previous.copy())
+        else:
+            updated = xgb.train(params, dtrain, num_boost_round=num_boost_round, xgb_model=previous.copy())
+        del dtrain
+
+    x_hold, y_hold = data_iter.holdout()
+    with open(model_file, 'rb') as inp_file:
+        parent_sha = hashlib.sha256(inp_file.read()).hexdigest()
+
+    provenance = {
+        'parent_model': os.path.abspath(str(model_file)),
+        'parent_sha256': parent_sha,
+        'mode': 'refresh_leaves' if refresh_leaves else 'continue_boosting',
+        'trees_before': previous.num_boosted_rounds(),
+        'trees_after': updated.num_boosted_rounds(),
+        'params': params,
+        'files': [dict(file_provenance(file_name, hash_files), **counts)
+                  for file_name, counts in data_iter.counts.items()],
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    updated.set_attr(parent_sha256=parent_sha, update_time=provenance['time'])
+
+    before = _metrics(previous, x_hold, y_hold)
+    after = _metrics(updated, x_hold, y_hold)
+    report = {
+        'candidates': {'train': int(sum(c['train'] for c in data_iter.counts.values())),
+                       'holdout': int(len(y_hold))},
+        'previous': before,
+        'updated': after,
+        'delta_auc': None if before['auc'] is None else after['auc'] - before['auc'],
+        'delta_log_loss': None if before['log_loss'] is None else after['log_loss'] - before['log_loss'],
+        'wall_time': time.perf_counter() - start,
+        'io': data_iter.io_stats.as_dict(),
+    }
+
+    os.makedirs(output_path, exist_ok=True)
+    updated.save_model(os.path.join(output_path, model_name))
+    with open(os.path.join(output_path, 'incremental_report.json'), 'w', encoding="utf-8") as out_file:
+        json.dump({'provenance': provenance, 'comparison': report}, out_file, indent=2)
+    history = read_run_metadata(output_path).get('provenance', [])
+    update_run_metadata(output_path, 'provenance', history + [provenance])
+
+    if before['auc'] is not None:
+        print('Held-out AUC %.5f -> %.5f, log loss %.5f -> %.5f' % (before['auc'], after['auc'],
+                                                                    before['log_loss'], after['log_loss']))
+    return updated, report
@@ -0,0 +1,53 @@
+import importlib
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access, so
+    importing cand_class modules stays cheap for processes that never touch
+    plotting, training or ROOT (e.g. scoring workers)
+
+    Parameters
+    ------------------------------------------------
+    name: str
+        module to import, e.g. 'matplotlib.pyplot'
+    hint: str
+        how to install the module, added to the ImportError
+    on_load: callable
+        called with the module right after the import
+    """
+
+    def __init__(self, name, hint=None, on_load=None):
+        self.__dict__.update(_name=name, _hint=hint, _on_load=on_load, _module=None)
+
+    def _load(self):
+        if self._module is None:
+            try:
+                module = importlib.import_module(self._name)
+            except ImportError as error:
+                if self._hint is None:
+                    raise
+                raise ImportError(self._name+' is needed for this feature: '+self._hint) from error
+            if self._on_load is not None:
+                self._on_load(module)
+            self.__dict__['_module'] = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return '<lazy module '+self._name+' ('+state+')>'
+
+
+def lazy_import(name, extra=None, hint=None, on_load=None):
+    """
+    Returns a LazyModule for name. extra is the setup.py extra that installs it
+    """
+    if hint is None and extra is not None:
+        hint = 'pip install "CandidatesClassifier['+extra+']"'
+    return LazyModule(name, hint, on_load)
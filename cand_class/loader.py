@@ -0,0 +1,249 @@
+import queue
+import threading
+import time
+
+import pandas as pd
+import uproot
+
+from cand_class.concurrency import get_budget
+from cand_class.memory import get_memory_budget
+
+
+class LoaderStats:
+    """
+    I/O counters of one or more ChunkLoaders
+
+    Attributes
+    ----------
+    bytes_read : int
+        compressed bytes requested from the files
+    read_time : float
+        seconds the reader spent producing chunks (reading, decompressing and
+        converting baskets)
+    decompress_time : float
+        seconds spent in basket decompression, summed over the I/O threads
+    stall_time : float
+        seconds the consumer waited for the next chunk, the part of the I/O
+        that did not overlap with the computation
+    chunks, entries : int
+        chunks and candidates delivered
+    """
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.read_time = 0.
+        self.decompress_time = 0.
+        self.stall_time = 0.
+        self.chunks = 0
+        self.entries = 0
+        self._lock = threading.Lock()
+
+    def add_decompress(self, seconds):
+        # called from the decompression threads
+        with self._lock:
+            self.decompress_time += seconds
+
+    def merge(self, other):
+        """
+        Adds the counters of another LoaderStats or of its as_dict()
+        """
+        other = other.as_dict() if isinstance(other, LoaderStats) else other
+        self.bytes_read += other['bytes_read']
+        self.read_time += other['read_time']
+        self.decompress_time += other['decompress_time']
+        self.stall_time += other['stall_time']
+        self.chunks += other['chunks']
+        self.entries += other['entries']
+        return self
+
+    def as_dict(self):
+        return {'bytes_read': self.bytes_read, 'read_time': self.read_time,
+                'decompress_time': self.decompress_time, 'stall_time': self.stall_time,
+                'chunks': self.chunks, 'entries': self.entries}
+
+    def summary(self):
+        return ('Read %.1f MB in %d chunks: reading %.2f s, decompression %.2f s, stalled %.2f s'
+                % (self.bytes_read / 2**20, self.chunks, self.read_time, self.decompress_time, self.stall_time))
+
+
+class _TimedExecutor:
+    """
+    uproot decompression executor that runs the basket decompression on a
+    thread pool (or inline for one thread) and times it
+    """
+
+    def __init__(self, n_threads, stats):
+        self.stats = stats
+        if n_threads > 1:
+            self._executor = uproot.source.futures.ThreadPoolExecutor(n_threads)
+        else:
+            self._executor = uproot.source.futures.TrivialExecutor()
+
+    def _timed(self, task, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return task(*args, **kwargs)
+        finally:
+            self.stats.add_decompress(time.perf_counter() - start)
+
+    def submit(self, task, /, *args, **kwargs):
+        return self._executor.submit(self._timed, task, *args, **kwargs)
+
+    @property
+    def num_workers(self):
+        return getattr(self._executor, 'num_workers', 1)
+
+    @property
+    def closed(self):
+        return getattr(self._executor, 'closed', False)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait)
+
+
+class _Failure:
+
+    def __init__(self, error):
+        self.error = error
+
+
+class ChunkLoader:
+    """
+    Iterates over (file_name, chunk) of a tree in several ROOT files. Baskets
+    are decompressed on io_threads threads and a background thread reads up to
+    prefetch chunks ahead, so reading the next chunk overlaps with the
+    transformation or scoring of the current one
+
+        loader = ChunkLoader(files, 't', branches, step_size=100000)
+        for file_name, chunk in loader:
+            ...
+        print(loader.stats.summary())
+
+    Parameters
+    ------------------------------------------------
+    files: str or list of str
+        ROOT files
+    tree: str
+        tree name, the same in all files
+    branches: list of str
+        branches to read, all if None
+    step_size: int or str
+        candidates per chunk or a size like '100 MB' (see uproot.TTree.iterate)
+    io_threads: int
+        decompression threads, the inner size of the thread budget by default
+        (see concurrency.ThreadBudget)
+    prefetch: int
+        chunks read ahead, 0 reads synchronously in the consuming thread
+    library: str
+        'pd' or 'np' (see uproot.TTree.iterate)
+    stats: LoaderStats
+        counters to add to, e.g. shared by the loaders of several samples
+    """
+
+    def __init__(self, files, tree, branches=None, step_size=100000, io_threads=None, prefetch=2,
+                 library='pd', stats=None):
+        self.files = [files] if isinstance(files, str) else list(files)
+        self.tree = tree
+        self.branches = branches
+        self.step_size = step_size
+        self.io_threads = max(1, int(io_threads or get_budget().inner))
+        self.prefetch = max(0, int(prefetch))
+        self.library = library
+        self.stats = stats if stats is not None else LoaderStats()
+
+    def _chunks(self, executor):
+        for file_name in self.files:
+            with uproot.open(file_name) as root_file:
+                source = root_file.file.source
+                requested = source.num_requested_bytes
+                chunks = root_file[self.tree].iterate(self.branches, step_size=self.step_size,
+                                                      decompression_executor=executor, library=self.library)
+                while True:
+                    start = time.perf_counter()
+                    chunk = next(chunks, None)
+                    self.stats.read_time += time.perf_counter() - start
+                    self.stats.bytes_read += source.num_requested_bytes - requested
+                    requested = source.num_requested_bytes
+                    if chunk is None:
+                        break
+                    yield file_name, chunk
+
+    def _produce(self, executor, chunks, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    chunks.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for item in self._chunks(executor):
+                if not put(item):
+                    return
+        except Exception as error:  # re-raised in the consuming thread
+            put(_Failure(error))
+            return
+        put(None)
+
+    def __iter__(self):
+        executor = _TimedExecutor(self.io_threads, self.stats)
+        if self.prefetch == 0:
+            read_time = self.stats.read_time
+            try:
+                for file_name, chunk in self._chunks(executor):
+                    self.stats.chunks += 1
+                    self.stats.entries += len(chunk)
+                    yield file_name, chunk
+            finally:
+                executor.shutdown()
+            # nothing overlaps, the consumer waits for every read
+            self.stats.stall_time += self.stats.read_time - read_time
+            return
+
+        chunks = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        reader = threading.Thread(target=self._produce, args=(executor, chunks, stop), daemon=True)
+        reader.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = chunks.get()
+                self.stats.stall_time += time.perf_counter() - start
+                if item is None:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+                self.stats.chunks += 1
+                self.stats.entries += len(item[1])
+                yield item
+        finally:
+            # also reached when the consumer stops early
+            stop.set()
+            reader.join()
+            executor.shutdown()
+
+
+def read_tree(files, tree, branches=None, step_size=None, io_threads=None, prefetch=2, stats=None,
+              column_stats=None):
+    """
+    Reads a tree of one or more ROOT files into one DataFrame with a
+    ChunkLoader, converting a chunk overlaps with reading the next one.
+    A column_stats.ColumnStats given as column_stats is filled chunk by chunk
+    on the way. Chunks are sized from the memory budget by default, and the
+    table is spilled to a memory-mapped file if it does not fit next to them
+    (see memory.MemoryBudget.concat)
+    """
+    budget = get_memory_budget()
+    loader = ChunkLoader(files, tree, branches, step_size or budget.step_size(), io_threads, prefetch, 'pd', stats)
+    chunks = []
+    for _, chunk in loader:
+        if column_stats is not None:
+            column_stats.update(chunk)
+        chunks.append(chunk)
+    if not chunks:
+        return pd.DataFrame(columns=branches)
+    # the chunks are released one by one while they are copied
+    del chunk
+    return budget.concat(chunks)
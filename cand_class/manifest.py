@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+
+import tomli
+
+# stage -> (manifest sections it reads, upstream stages)
+STAGE_GRAPH = {
+    'sample': (['input', 'mass_var'], []),
+    'transform': (['log_vars'], ['sample']),
+    'split': (['split'], ['transform']),
+    'model': (['train_vars', 'model'], ['split']),
+    'thresholds': ([], ['split', 'model']),
+    'plots': (['plots'], ['split', 'model', 'thresholds']),
+}
+
+# bump to invalidate cached outputs of a stage after changing its code
+STAGE_VERSIONS = {stage: 1 for stage in STAGE_GRAPH}
+
+
+def _fingerprint(path, hash_files):
+    stat = os.stat(path)
+    info = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if hash_files:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as inp_file:
+            for block in iter(lambda: inp_file.read(1 << 20), b''):
+                sha.update(block)
+        info['sha256'] = sha.hexdigest()
+    return info
+
+
+class RunManifest:
+    """
+    All inputs of one training run, parsed and validated once. A run toml
+    points to the usual input, log_vars and train_vars tomls and holds the
+    parameters of the stages:
+
+        [run]
+        input = "input.toml"            # as for config_reader.convertDF
+        log_vars = "log_vars.toml"      # as for config_reader.read_log_vars
+        train_vars = "train_vars.toml"  # as for config_reader.read_train_vars
+        mass_var = "mass"
+        output_path = "output"
+        cache_dir = "output/.cache"     # optional
+        cache_max_gb = 20               # optional
+
+        [split]
+        test_size = 0.5
+        seed = 42
+
+        [model]
+        hyper_pars_ranges = {n_estimators = [200, 1000], max_depth = [2, 6], learning_rate = [0.01, 0.1]}
+        nfold = 3
+        init_points = 1
+        n_iter = 2
+
+        [plots]
+        pt_rap = ["pT", "rapidity"]
+        x_range = [0, 3]
+        y_range = [0, 2]
+
+    Every stage gets a cache key (stage_key) from the manifest sections it
+    reads and the keys of its upstream stages (STAGE_GRAPH), so changing for
+    example only [plots] invalidates only the plots stage
+
+    Parameters
+    ------------------------------------------------
+    run_file: str
+        run toml
+    hash_files: bool
+        fingerprint the ROOT input files by sha256 instead of size and mtime only
+    """
+
+    def __init__(self, run_file, hash_files=False):
+        self.run_file = os.path.abspath(str(run_file))
+        base = os.path.dirname(self.run_file)
+        with open(self.run_file, "rb") as inp_file:
+            run_info = tomli.load(inp_file)
+
+        problems = []
+        run = run_info.get('run', {})
+        for key in ('input', 'log_vars', 'train_vars', 'mass_var', 'output_path'):
+            if key not in run:
+                problems.append('[run] '+key+' is missing')
+        if problems:
+            raise ValueError('Invalid run manifest '+self.run_file+':\n  '+'\n  '.join(problems))
+
+        def resolve(path):
+            return path if os.path.isabs(path) else os.path.join(base, path)
+
+        self.mass_var = run['mass_var']
+        self.output_path = resolve(run['output_path'])
+        self.cache_dir = resolve(run.get('cache_dir', os.path.join(run['output_path'], '.cache')))
+        self.cache_max_bytes = int(float(run.get('cache_max_gb', 20)) * 2**30)
+
+        toml_files = {name: resolve(run[name]) for name in ('input', 'log_vars', 'train_vars')}
+        parsed = {}
+        for name, file_name in toml_files.items():
+            if not os.path.isfile(file_name):
+                problems.append(name+' file '+file_name+' does not exist')
+                continue
+            with open(file_name, "rb") as inp_file:
+                parsed[name] = tomli.load(inp_file)
+        if problems:
+            raise ValueError('Invalid run manifest '+self.run_file+':\n  '+'\n  '.join(problems))
+
+        self.inputs = parsed['input']
+        for sample in ('signal', 'background'):
+            path = self.inputs.get(sample, {}).get('path')
+            if path is None or 'tree' not in self.inputs.get(sample, {}):
+                problems.append('['+sample+'] path and tree are required in '+toml_files['input'])
+                continue
+            # ROOT file paths are relative to the working directory as in convertDF
+            paths = [path] if isinstance(path, str) else path
+            missing = [p for p in paths if not os.path.isfile(p)]
+            if missing:
+                problems.append('['+sample+'] file(s) not found: '+', '.join(missing))
+        peak = self.inputs.get('peak_range', {})
+        edges = [peak.get(key) for key in ('bgr_left_edge', 'sgn_left_edge', 'sgn_right_edge', 'bgr_right_edge')]
+        if None in edges:
+            problems.append('[peak_range] needs bgr_left_edge, sgn_left_edge, sgn_right_edge, bgr_right_edge')
+        elif edges != sorted(edges):
+            problems.append('[peak_range] edges are not ordered: '+str(edges))
+        for key in ('number_of_signal_events', 'number_of_background_events'):
+            if key not in self.inputs.get('number_of_events', {}):
+                problems.append('[number_of_events] '+key+' is missing')
+
+        try:
+            self.non_log_x = parsed['log_vars']['non_log_scale']['variables']
+            self.log_x = parsed['log_vars']['log_scale']['variables']
+        except KeyError:
+            problems.append('log_vars needs [non_log_scale] and [log_scale] variables')
+            self.non_log_x, self.log_x = [], []
+        self.train_vars = parsed['train_vars'].get('train_vars')
+        if self.train_vars is None:
+            problems.append('train_vars is missing in '+toml_files['train_vars'])
+        else:
+            known = set(self.non_log_x) | {'log('+var+')' for var in self.log_x}
+            unknown = [var for var in self.train_vars if var not in known]
+            if unknown:
+                problems.append('train variables not in the log_vars file: '+', '.join(unknown))
+
+        self.split = {'test_size': 0.5, 'seed': 42}
+        self.split.update(run_info.get('split', {}))
+        self.model = {'hyper_pars_ranges': {}, 'nfold': 3, 'init_points': 1, 'n_iter': 2, 'metrics': 'roc_auc'}
+        self.model.update(run_info.get('model', {}))
+        if not self.model['hyper_pars_ranges']:
+            problems.append('[model] hyper_pars_ranges is missing')
+        self.plots = {'pt_rap': ['pT', 'rapidity'], 'x_range': [0, 3], 'y_range': [0, 2]}
+        self.plots.update(run_info.get('plots', {}))
+
+        if problems:
+            raise ValueError('Invalid run manifest '+self.run_file+':\n  '+'\n  '.join(problems))
+
+        data_files = []
+        for sample in ('signal', 'background'):
+            path = self.inputs[sample]['path']
+            data_files += [_fingerprint(p, hash_files) for p in ([path] if isinstance(path, str) else path)]
+
+        self.sections = {
+            'input': {'config': self.inputs, 'files': data_files},
+            'mass_var': self.mass_var,
+            'log_vars': {'non_log': self.non_log_x, 'log': self.log_x},
+            'train_vars': self.train_vars,
+            'split': self.split,
+            'model': self.model,
+            'plots': self.plots,
+        }
+        self._keys = {}
+
+    def stage_key(self, stage):
+        """
+        Content hash of everything the output of stage depends on
+        """
+        if stage not in self._keys:
+            sections, upstream = STAGE_GRAPH[stage]
+            content = {'stage': stage, 'version': STAGE_VERSIONS[stage],
+                       'sections': {name: self.sections[name] for name in sections},
+                       'upstream': [self.stage_key(name) for name in upstream]}
+            self._keys[stage] = hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+        return self._keys[stage]
+
+    def as_dict(self):
+        return {'run_file': self.run_file, 'output_path': self.output_path, 'sections': self.sections,
+                'stage_keys': {stage: self.stage_key(stage) for stage in STAGE_GRAPH}}
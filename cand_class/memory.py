@@ -0,0 +1,230 @@
+import os
+import re
+import resource
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from cand_class.profiling import current_rss, peak_rss_scope
+from cand_class.run_metadata import read_run_metadata, update_run_metadata
+
+
+_SIZE_UNITS = {'': 1, 'B': 1, 'KB': 1000, 'MB': 1000**2, 'GB': 1000**3, 'TB': 1000**4,
+               'KIB': 1024, 'MIB': 1024**2, 'GIB': 1024**3, 'TIB': 1024**4}
+
+
+def available_memory():
+    """
+    Memory this process may use in bytes: the physical memory, limited by the
+    cgroup memory limit (containers, batch slots) and the address space limit
+    """
+    limits = [os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')]
+    for file_name in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(file_name, encoding="utf-8") as inp_file:
+                value = inp_file.read().strip()
+        except OSError:
+            continue
+        if value.isdigit():
+            limits.append(int(value))
+    address_space = resource.getrlimit(resource.RLIMIT_AS)[0]
+    if address_space != resource.RLIM_INFINITY:
+        limits.append(address_space)
+    return min(limits)
+
+
+def parse_size(size):
+    """
+    Bytes of a size given as a number, a string like '16 GB' or '512MiB', or
+    a percentage of available_memory() like '75%'
+    """
+    if isinstance(size, (int, float)):
+        return int(size)
+    text = str(size).strip()
+    if text.endswith('%'):
+        return int(available_memory() * float(text[:-1]) / 100)
+    match = re.fullmatch(r'([0-9.]+)\s*([A-Za-z]*)', text)
+    if match is None or match.group(2).upper() not in _SIZE_UNITS:
+        raise ValueError('Cannot parse memory size '+repr(size))
+    return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+@dataclass
+class MemoryBudget:
+    """
+    Memory the package may use. Stages query it for their chunk sizes, so
+    the same configuration reads, scores and plots in small chunks on a
+    laptop and in large ones on a big node, and tables that would not fit
+    next to what the process already holds are spilled to memory-mapped
+    temporary files
+
+    Attributes
+    ----------
+    limit : int or str
+        bytes, a size like '16 GB' or a share of the available memory like
+        '75%' (the default)
+    chunk_fraction : float
+        share of the limit one chunk of candidates may take (divided between
+        concurrent workers)
+    spill_dir : str
+        directory of the spill files, the system temporary directory by default
+    min_rows : int
+        smallest chunk in candidates
+    """
+
+    limit: object = None
+    chunk_fraction: float = 0.05
+    spill_dir: str = None
+    min_rows: int = 1000
+
+    def __post_init__(self):
+        self.limit = parse_size(self.limit if self.limit is not None else '75%')
+        self.chunk_fraction = min(max(float(self.chunk_fraction), 0.), 1.)
+        self.min_rows = max(1, int(self.min_rows))
+        self.spilled = 0
+        self.stages = {}
+
+    def chunk_bytes(self, workers=1):
+        """
+        Bytes one chunk may take in each of workers concurrent workers, at least 1 MB
+        """
+        return max(2**20, int(self.limit * self.chunk_fraction / max(1, workers)))
+
+    def chunk_rows(self, bytes_per_row, workers=1):
+        """
+        Candidates per chunk for rows of bytes_per_row bytes (including the
+        temporary copies a stage makes of them)
+        """
+        return max(self.min_rows, self.chunk_bytes(workers) // max(1, int(bytes_per_row)))
+
+    def step_size(self, workers=1):
+        """
+        Chunk size for uproot (loader.ChunkLoader) as a string like '50 MB'
+        """
+        return str(max(1, self.chunk_bytes(workers) // 10**6))+' MB'
+
+    def headroom(self):
+        """
+        Bytes left before the process reaches the limit
+        """
+        return self.limit - current_rss()
+
+    def fits(self, n_bytes):
+        return n_bytes <= self.headroom()
+
+    def empty(self, shape, dtype=np.float64):
+        """
+        Uninitialized array, in memory if it fits, otherwise memory-mapped on
+        an anonymous file in spill_dir that is removed when the array is freed
+        """
+        dtype = np.dtype(dtype)
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        if self.fits(n_bytes):
+            return np.empty(shape, dtype)
+        self.spilled += n_bytes
+        with tempfile.TemporaryFile(dir=self.spill_dir) as spill_file:
+            # the mapping keeps the file alive after it is closed
+            return np.memmap(spill_file, dtype=dtype, mode='w+', shape=shape)
+
+    def concat(self, frames):
+        """
+        pd.concat(frames, ignore_index=True). If the result does not fit and
+        all frames have the numeric columns and dtypes of the first one, the
+        columns of each dtype are copied into one spilled 2D array (see empty)
+        and the frames are released one by one while copying, so the memory
+        never holds the frames and the result at the same time. Frames with
+        different columns or dtypes are left to pd.concat. frames is emptied
+        """
+        frames[:] = [frame for frame in frames if len(frame)] or frames[:1]
+        n_bytes = sum(int(frame.memory_usage(index=False, deep=False).sum()) for frame in frames)
+        columns = list(frames[0].columns) if frames else []
+        dtypes = frames[0].dtypes if frames else None
+        numeric = len(frames) and all(isinstance(dtype, np.dtype) and dtype.kind in 'biuf' for dtype in dtypes)
+        # pd.concat fills missing columns with NaN and finds the common dtypes
+        uniform = all(len(frame.columns) == len(columns) and set(frame.columns) == set(columns)
+                      and frame.dtypes[columns].equals(dtypes) for frame in frames[1:])
+        if len(frames) < 2 or not numeric or not uniform or self.fits(n_bytes):
+            result = pd.concat(frames, ignore_index=True)
+            frames.clear()
+            return result
+
+        groups = {}
+        for column in columns:
+            groups.setdefault(dtypes[column], []).append(column)
+        n_rows = sum(len(frame) for frame in frames)
+        blocks = {dtype: self.empty((len(group), n_rows), dtype) for dtype, group in groups.items()}
+
+        start = 0
+        while frames:
+            frame = frames.pop(0)
+            for dtype, group in groups.items():
+                blocks[dtype][:, start:start + len(frame)] = frame[group].to_numpy(dtype=dtype).T
+            start += len(frame)
+            del frame
+        parts = [pd.DataFrame(blocks[dtype].T, columns=group, copy=False) for dtype, group in groups.items()]
+        return pd.concat(parts, axis=1)[columns]
+
+    @contextmanager
+    def track(self, stage, output_path=None):
+        """
+        Records the peak resident memory of the enclosed block as stage (in
+        stages, printed, and in output_path/run_metadata.json if given).
+        Nested blocks are included in the peak of the enclosing one
+
+            with budget.track('sample', output_path) as usage:
+                ...
+        """
+        usage = {'rss_start': current_rss(), 'spilled_start': self.spilled}
+        try:
+            with peak_rss_scope() as scope:
+                yield usage
+        finally:
+            peak = scope['peak']
+            usage.update({'peak_rss': peak, 'rss_end': current_rss(), 'peak_exact': scope['exact'],
+                          'spilled': self.spilled - usage.pop('spilled_start'), 'limit': self.limit})
+            self.stages[stage] = usage
+            print('Memory '+stage+': peak %.1f MB of %.1f MB' % (peak / 2**20, self.limit / 2**20)
+                  + (', spilled %.1f MB' % (usage['spilled'] / 2**20) if usage['spilled'] else '')
+                  + (', over the budget' if peak > self.limit else ''))
+            if output_path is not None:
+                self.record(output_path, stage, **usage)
+
+    def as_dict(self):
+        return {'limit': self.limit, 'chunk_fraction': self.chunk_fraction, 'spill_dir': self.spill_dir,
+                'min_rows': self.min_rows}
+
+    def record(self, output_path, stage=None, **usage):
+        """
+        Writes the budget and, if stage is given, the memory usage of that
+        stage to output_path/run_metadata.json
+        """
+        memory = read_run_metadata(output_path).get('memory', {})
+        memory['budget'] = self.as_dict()
+        if stage is not None:
+            memory[stage] = usage
+        update_run_metadata(output_path, 'memory', memory)
+
+
+_budget = None
+
+
+def set_memory_budget(budget):
+    """
+    Sets the package-wide memory budget
+    """
+    global _budget
+    _budget = budget
+    return _budget
+
+
+def get_memory_budget():
+    """
+    Returns the package-wide memory budget, by default 75% of the available memory
+    """
+    global _budget
+    if _budget is None:
+        _budget = MemoryBudget()
+    return _budget
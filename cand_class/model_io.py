@@ -0,0 +1,87 @@
+import os
+import pickle
+
+from cand_class.lazy import lazy_import
+
+xgb = lazy_import('xgboost')
+
+
+def load_booster(model_file):
+    """
+    Loads a trained model as a native xgboost Booster
+
+    Parameters
+    ------------------------------------------------
+    model_file: str
+        XGBoost model (.json, .ubj or .model), model artifact directory
+        (artifact.save_artifact), pickled hipe4ml ModelHandler
+        (ModelHandler.dump_model_handler) or pickled XGBClassifier
+        (XGBmodel.save_predictions)
+    """
+    model_file = str(model_file)
+
+    if os.path.isfile(os.path.join(model_file, 'artifact.json')):
+        # model artifact directory, see artifact.save_artifact
+        model_file = os.path.join(model_file, 'model.ubj')
+
+    if model_file.endswith(('.json', '.ubj', '.model')):
+        booster = xgb.Booster()
+        booster.load_model(model_file)
+        return booster
+
+    with open(model_file, 'rb') as inp_file:
+        model = pickle.load(inp_file)
+
+    try:
+        return as_booster(model)
+    except TypeError:
+        raise TypeError('Unsupported model type in '+model_file+': '+type(model).__name__) from None
+
+
+def as_booster(model):
+    """
+    Native booster of a hipe4ml ModelHandler, an XGBClassifier or a Booster
+    """
+    if hasattr(model, 'get_original_model'):
+        model = model.get_original_model()
+
+    if hasattr(model, 'get_booster'):
+        model = model.get_booster()
+
+    if not isinstance(model, xgb.Booster):
+        raise TypeError('Unsupported model type: '+type(model).__name__)
+
+    return model
+
+
+def booster_features(booster, features=None):
+    """
+    Returns the list of features the booster was trained on
+
+    Parameters
+    ------------------------------------------------
+    booster: xgboost.Booster
+        trained booster
+    features: list of str
+        explicit feature list, overrides the names stored in the booster
+    """
+    if features is not None:
+        return list(features)
+
+    if booster.feature_names is None:
+        raise ValueError('Model has no stored feature names, pass the list of train variables explicitly')
+
+    return list(booster.feature_names)
+
+
+def native_params(model_params):
+    """
+    Converts XGBClassifier parameters (for example ModelHandler.get_model_params()
+    after XGBmodel.modelBO) into native booster parameters and number of rounds
+    """
+    model_params = dict(model_params)
+    num_boost_round = model_params.pop('n_estimators', None) or 100
+    params = xgb.XGBClassifier(**model_params).get_xgb_params()
+    params = {key: value for key, value in params.items() if value is not None}
+    params.setdefault('eval_metric', 'auc')
+    return params, num_boost_round
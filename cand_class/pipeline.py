@@ -0,0 +1,142 @@
+import os
+import time
+
+
+from cand_class.manifest import STAGE_GRAPH, RunManifest
+from cand_class.memory import get_memory_budget
+from cand_class.profiling import profiled
+from cand_class.run_metadata import update_run_metadata
+from cand_class.stage_cache import StageCache
+
+
+def _sample(manifest):
+    from cand_class.config_reader import convertDF
+    from cand_class.loader import LoaderStats
+
+    stats = LoaderStats()
+    signal, background = convertDF(manifest.inputs, manifest.mass_var, stats=stats)
+    print(stats.summary())
+    update_run_metadata(manifest.output_path, 'loader', stats.as_dict())
+    signal_df = signal.get_data_frame().assign(issignal=1)
+    background_df = background.get_data_frame().assign(issignal=0)
+    del signal, background
+    return get_memory_budget().concat([signal_df, background_df])
+
+
+def _transform(manifest, df):
+    from cand_class.helper import transform_df_to_log
+
+    return transform_df_to_log(df, manifest.non_log_x + manifest.log_x, manifest.non_log_x, manifest.log_x)
+
+
+def _split(manifest, df):
+    from sklearn.model_selection import train_test_split
+
+    x_train, x_test = train_test_split(df, test_size=manifest.split['test_size'],
+                                       random_state=manifest.split['seed'])
+    return [x_train, x_train['issignal'].to_numpy(), x_test, x_test['issignal'].to_numpy()]
+
+
+def _model(manifest, train_test_data):
+    from cand_class.hipe_conf_params import XGBmodel
+
+    params = manifest.model
+    hyper_pars_ranges = {name: tuple(value) for name, value in params['hyper_pars_ranges'].items()}
+    xgb_model = XGBmodel(manifest.train_vars, hyper_pars_ranges, train_test_data, manifest.output_path,
+                         metrics=params['metrics'], nfold=params['nfold'], init_points=params['init_points'],
+                         n_iter=params['n_iter'])
+    xgb_model.modelBO()
+    y_pred_train, y_pred_test = xgb_model.train_test_pred()
+    return {'model': xgb_model.get_mode_booster(), 'y_pred_train': y_pred_train, 'y_pred_test': y_pred_test}
+
+
+def _thresholds(manifest, train_test_data, model):
+    from cand_class.helper import AMS
+
+    train_thr, test_thr, roc_curve_data = AMS(train_test_data[1], model['y_pred_train'], train_test_data[3],
+                                              model['y_pred_test'], manifest.output_path)
+    return {'train': float(train_thr), 'test': float(test_thr), 'roc_curve': roc_curve_data}
+
+
+def _plots(manifest, train_test_data, model, thresholds):
+    from cand_class.apply_model import ApplyXGB
+    from cand_class.helper import preds_prob
+
+    start = time.time()
+    x_train, y_train, x_test, y_test = train_test_data
+    apply_xgb = ApplyXGB(x_train, x_test, model['y_pred_train'], model['y_pred_test'], y_train, y_test,
+                         manifest.output_path)
+    apply_xgb.get_predictions()
+    train_res, test_res = apply_xgb.apply_prob_cut(0, thresholds['train'], thresholds['test'])
+    apply_xgb.CM_plot_train_test('issignal')
+    apply_xgb.pT_vs_rapidity(test_res, 'issignal', 'xgb_preds1', manifest.plots['x_range'],
+                             manifest.plots['y_range'], 'test', manifest.plots['pt_rap'])
+    preds_prob(test_res, 'xgb_preds', 'issignal', 'test', manifest.output_path)
+    return sorted(file_name for file_name in os.listdir(manifest.output_path)
+                  if os.path.getmtime(os.path.join(manifest.output_path, file_name)) >= start
+                  and file_name.endswith(('.png', '.pdf')))
+
+
+def _lineage(stage):
+    # the stage and all stages it depends on
+    stages = {stage}
+    for name in STAGE_GRAPH[stage][1]:
+        stages |= _lineage(name)
+    return stages
+
+
+STAGE_FUNCS = {'sample': _sample, 'transform': _transform, 'split': _split, 'model': _model,
+               'thresholds': _thresholds, 'plots': _plots}
+
+
+@profiled()
+def run_pipeline(run_file, until='plots', force=(), hash_files=False):
+    """
+    Runs the training pipeline of a run manifest (see manifest.RunManifest)
+    with every stage memoized on disk. A stage is only recomputed if one of
+    the manifest sections it reads or one of its upstream stages changed,
+    and its upstream outputs are only loaded when it has to be recomputed.
+    The peak memory of every stage is printed and written to run_metadata.json
+    (see memory.MemoryBudget.track)
+
+    Parameters
+    ------------------------------------------------
+    run_file: str
+        run toml
+    until: str
+        last stage to run, one of sample, transform, split, model, thresholds, plots
+    force: list of str
+        stages recomputed even if cached, together with all stages after them
+    hash_files: bool
+        fingerprint the ROOT input files by content instead of size and mtime
+
+    Returns
+    -------
+    dict stage -> output of the stages that were needed
+    """
+    manifest = RunManifest(run_file, hash_files)
+    os.makedirs(manifest.output_path, exist_ok=True)
+    cache = StageCache(manifest.cache_dir, manifest.cache_max_bytes)
+    memory = get_memory_budget()
+    outputs = {}
+
+    def output(stage):
+        if stage in outputs:
+            return outputs[stage]
+        key = manifest.stage_key(stage)
+        if _lineage(stage) & set(force):
+            cache.discard(key)
+        if stage == 'plots' and key in cache:
+            # plots live in output_path, rerun if some were removed
+            if not all(os.path.isfile(os.path.join(manifest.output_path, name)) for name in cache.get(key)):
+                cache.discard(key)
+        upstream = [] if key in cache else [output(name) for name in STAGE_GRAPH[stage][1]]
+        with memory.track(stage, manifest.output_path):
+            outputs[stage] = cache.memoize(stage, key, STAGE_FUNCS[stage], manifest, *upstream)
+        return outputs[stage]
+
+    output(until)
+    update_run_metadata(manifest.output_path, 'manifest', dict(manifest.as_dict(), cache={
+        'hits': cache.hits, 'misses': cache.misses, 'bytes': cache.size()}))
+    print('Stages cached: '+str(cache.hits)+', recomputed: '+str(cache.misses))
+    return outputs
@@ -0,0 +1,151 @@
+import os
+
+import numpy as np
+
+from cand_class.lazy import lazy_import
+from cand_class.memory import get_memory_budget
+
+mpl = lazy_import('matplotlib', 'plot')
+plt = lazy_import('matplotlib.pyplot', 'plot')
+colors = lazy_import('matplotlib.colors', 'plot')
+
+
+def use_headless():
+    """
+    Switches matplotlib to the non-interactive Agg backend on nodes without a
+    display (and when MPLBACKEND is not set), so no GUI backend is loaded and
+    nothing waits for a window
+    """
+    if os.environ.get('MPLBACKEND') or os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'):
+        return
+    if os.name == 'nt' or mpl.get_backend().lower() == 'agg':
+        return
+    plt.switch_backend('Agg')
+
+
+def _bin_index(values, edges):
+    # bin of every value, -1 outside the edges or not finite (the last edge is inclusive)
+    values = np.asarray(values, dtype=np.float64)
+    n_bins = len(edges) - 1
+    widths = np.diff(edges)
+    if np.allclose(widths, widths[0]):
+        with np.errstate(invalid='ignore'):
+            index = np.floor((values - edges[0]) * (n_bins / (edges[-1] - edges[0])))
+    else:
+        index = np.searchsorted(edges, values, side='right') - 1.
+    index[values == edges[-1]] = n_bins - 1
+    index[~((index >= 0) & (index < n_bins))] = -1
+    return index.astype(np.intp)
+
+
+def _chunks(n_rows, bytes_per_row):
+    # row slices sized from the memory budget, so the temporaries of the binning stay small
+    step = get_memory_budget().chunk_rows(bytes_per_row)
+    for start in range(0, n_rows, step):
+        yield slice(start, start + step)
+
+
+def hist_counts(values, edges, groups=None, n_groups=1):
+    """
+    Counts of values in the bins edges in one pass (np.bincount), values
+    outside the edges, NaN and inf are dropped. With groups (integer labels in
+    [0, n_groups)) the counts of all groups come from the same pass, shape
+    (n_groups, n_bins). The values are binned in chunks of the memory budget
+    """
+    n_bins = len(edges) - 1
+    counts = np.zeros(n_bins * (n_groups if groups is not None else 1), dtype=np.int64)
+    for rows in _chunks(len(values), 40):
+        index = _bin_index(values[rows], edges)
+        keep = index >= 0
+        if groups is not None:
+            index = np.asarray(groups[rows], dtype=np.intp) * n_bins + index
+        counts += np.bincount(index[keep], minlength=len(counts))
+    return counts if groups is None else counts.reshape(n_groups, n_bins)
+
+
+def hist2d_counts(x, y, xedges, yedges):
+    """
+    2D counts, shape (len(xedges) - 1, len(yedges) - 1), of the pairs with
+    both values inside the edges
+    """
+    nx, ny = len(xedges) - 1, len(yedges) - 1
+    counts = np.zeros(nx * ny, dtype=np.int64)
+    for rows in _chunks(len(x), 56):
+        ix, iy = _bin_index(x[rows], xedges), _bin_index(y[rows], yedges)
+        keep = (ix >= 0) & (iy >= 0)
+        counts += np.bincount(ix[keep] * ny + iy[keep], minlength=nx * ny)
+    return counts.reshape(nx, ny)
+
+
+def binned_moments(x, y, edges):
+    """
+    Count, mean and standard deviation (ddof=0) of y in the bins of x, empty
+    bins give NaN (the statistics of scipy.stats.binned_statistic). The
+    deviations from the bin means are summed in a second pass
+    """
+    n_bins = len(edges) - 1
+    count, total, sq = np.zeros(n_bins), np.zeros(n_bins), np.zeros(n_bins)
+    for rows in _chunks(len(x), 48):
+        index = _bin_index(x[rows], edges)
+        keep = index >= 0
+        count += np.bincount(index[keep], minlength=n_bins)
+        total += np.bincount(index[keep], weights=np.asarray(y[rows], dtype=np.float64)[keep], minlength=n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        for rows in _chunks(len(x), 48):
+            index = _bin_index(x[rows], edges)
+            keep = index >= 0
+            dev = np.asarray(y[rows], dtype=np.float64)[keep] - mean[index[keep]]
+            sq += np.bincount(index[keep], weights=dev**2, minlength=n_bins)
+        std = np.sqrt(sq / count)
+    return count, mean, std
+
+
+def count_ylim(ax, counts, log):
+    """
+    Sets the y range of count histograms, on a log axis from 0.5 so empty bins
+    do not stretch the axis
+    """
+    top = max([float(np.max(c)) for c in counts if len(c)] + [1.])
+    if log:
+        ax.set_ylim(0.5, top * 2)
+        ax.set_yscale('log')
+    else:
+        ax.set_yscale('linear')
+        ax.set_ylim(0, top * 1.05)
+
+
+class StairsLayer:
+    """
+    Histogram drawn from counts with Axes.stairs. The same artist is updated
+    for every feature, so a figure template is drawn once per page instead of
+    being rebuilt from the raw values
+    """
+
+    def __init__(self, ax, **kwargs):
+        self.artist = ax.stairs(np.zeros(1), np.arange(2), **kwargs)
+
+    def update(self, counts, edges, label=None):
+        self.artist.set_data(counts, edges)
+        if label is not None:
+            self.artist.set_label(label)
+
+
+class ImageLayer:
+    """
+    2D histogram drawn from counts on a uniform grid as an image (the same
+    picture as hist2d/pcolormesh, but a single rasterized artist whose data
+    and extent are updated for every variable pair), empty bins are left blank
+    """
+
+    def __init__(self, ax, cmap='viridis', log=True):
+        self.log = log
+        self.artist = ax.imshow(np.ma.masked_all((1, 1)), origin='lower', aspect='auto', interpolation='none',
+                                cmap=cmap, norm=colors.LogNorm(1, 10) if log else None, extent=(0, 1, 0, 1))
+
+    def update(self, counts, xedges, yedges):
+        counts = np.ma.masked_equal(np.asarray(counts, dtype=np.float64).T, 0)
+        self.artist.set_data(counts)
+        self.artist.set_extent((xedges[0], xedges[-1], yedges[0], yedges[-1]))
+        if counts.count():
+            self.artist.set_clim(counts.min(), counts.max())
@@ -0,0 +1,273 @@
+import functools
+import json
+import os
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+_state = {'enabled': False, 'trace_memory': False, 'records': [], 'stack': []}
+
+
+def enable(trace_memory=False):
+    """
+    Starts recording stage timings. With trace_memory the peak of Python
+    allocations (tracemalloc) is recorded per stage as well, which slows
+    allocation-heavy code down noticeably
+    """
+    _state['enabled'] = True
+    _state['trace_memory'] = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    _state['enabled'] = False
+    if _state['trace_memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _state['trace_memory'] = False
+
+
+def is_enabled():
+    return _state['enabled']
+
+
+def reset():
+    _state['records'] = []
+    _state['stack'] = []
+
+
+def records():
+    """
+    Returns the list of recorded stages, one dict per call
+    """
+    return list(_state['records'])
+
+
+def merge(worker_records, **labels):
+    """
+    Adds records of stages run in another process (for example the shards of
+    scoring.score_files in worker processes) below the current stage. labels
+    like shard=3 are added to every merged record
+    """
+    if not _state['enabled']:
+        return
+    depth = len(_state['stack'])
+    for record in worker_records:
+        _state['records'].append(dict(record, depth=record['depth'] + depth, **labels))
+
+
+def current_rss():
+    """
+    Resident memory of this process in bytes
+    """
+    try:
+        with open('/proc/self/statm', encoding="utf-8") as inp_file:
+            return int(inp_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return _peak_rss()
+
+
+def _peak_rss():
+    try:
+        with open('/proc/self/status', encoding="utf-8") as inp_file:
+            for line in inp_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if os.uname().sysname == 'Darwin' else rss * 1024
+
+
+def _reset_peak_rss():
+    # Linux only: makes VmHWM start again from the current resident memory
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding="utf-8") as out_file:
+            out_file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# peaks of the open measurements (stage and MemoryBudget.track): VmHWM is
+# reset when a measurement starts, so the peak reached so far is first
+# folded into all open ones
+_scopes = []
+
+
+def _fold_peak():
+    peak = _peak_rss()
+    for scope in _scopes:
+        scope['peak'] = max(scope['peak'], peak)
+
+
+@contextmanager
+def peak_rss_scope():
+    """
+    Peak resident memory of the enclosed block in bytes, yields a dict whose
+    'peak' is set when the block ends. 'exact' is False where the peak
+    cannot be reset (not Linux), the peak is then the process maximum
+
+        with peak_rss_scope() as scope:
+            ...
+        print(scope['peak'])
+    """
+    _fold_peak()
+    scope = {'peak': 0, 'exact': _reset_peak_rss()}
+    _scopes.append(scope)
+    try:
+        yield scope
+    finally:
+        _fold_peak()
+        _scopes.remove(scope)
+
+
+class _Stage:
+
+    def __init__(self, name, rows):
+        self.name = name
+        self.rows = rows
+        self.child_traced_peak = 0
+
+    def set_rows(self, rows):
+        self.rows = rows
+
+
+@contextmanager
+def stage(name, rows=None):
+    """
+    Records wall time, CPU time, rows processed and memory of the enclosed block.
+    Does nothing but yield when profiling is disabled
+
+        with profiling.stage('fill_hists', rows=len(df)) as st:
+            ...
+            if st is not None:
+                st.set_rows(n)
+    """
+    if not _state['enabled']:
+        yield None
+        return
+
+    current = _Stage(name, rows)
+    stack = _state['stack']
+    stack.append(current)
+
+    trace = _state['trace_memory'] and tracemalloc.is_tracing()
+    if trace:
+        traced_start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    rss_start = current_rss()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    try:
+        with peak_rss_scope() as scope:
+            yield current
+    finally:
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        stack.pop()
+
+        record = {'stage': name, 'depth': len(stack), 'wall_time': wall, 'cpu_time': cpu,
+                  'rows': current.rows, 'peak_rss': scope['peak'], 'peak_rss_growth': scope['peak'] - rss_start}
+        if trace:
+            traced_peak = max(tracemalloc.get_traced_memory()[1], current.child_traced_peak)
+            record['traced_peak'] = traced_peak - traced_start
+            if stack:
+                stack[-1].child_traced_peak = max(stack[-1].child_traced_peak, traced_peak)
+        _state['records'].append(record)
+
+
+def profiled(name=None, rows=None):
+    """
+    Decorator recording every call of a stage function or method with stage().
+    rows is either the index of a positional argument whose len() is the
+    number of processed rows or a callable rows(result, *args, **kwargs)
+    """
+    def decorator(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return func(*args, **kwargs)
+
+            with stage(stage_name) as current:
+                result = func(*args, **kwargs)
+                try:
+                    if isinstance(rows, int):
+                        current.set_rows(len(args[rows]))
+                    elif rows is not None:
+                        current.set_rows(rows(result, *args, **kwargs))
+                except (TypeError, IndexError, KeyError, AttributeError):
+                    # arguments passed differently than expected, keep the timing
+                    pass
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def summary():
+    """
+    Aggregates the records per stage: calls, total wall and CPU time, rows and
+    the largest memory peaks
+    """
+    stages = {}
+    for record in _state['records']:
+        agg = stages.setdefault(record['stage'], {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'rows': 0,
+                                                  'peak_rss': 0, 'traced_peak': 0})
+        agg['calls'] += 1
+        agg['wall_time'] += record['wall_time']
+        agg['cpu_time'] += record['cpu_time']
+        agg['rows'] += record['rows'] or 0
+        agg['peak_rss'] = max(agg['peak_rss'], record['peak_rss'])
+        agg['traced_peak'] = max(agg['traced_peak'], record.get('traced_peak', 0))
+    return stages
+
+
+def _openmetrics():
+    metrics = (('wall_seconds', 'wall_time', 'counter'), ('cpu_seconds', 'cpu_time', 'counter'),
+               ('rows', 'rows', 'counter'), ('calls', 'calls', 'counter'),
+               ('peak_rss_bytes', 'peak_rss', 'gauge'), ('traced_peak_bytes', 'traced_peak', 'gauge'))
+    stages = summary()
+    lines = []
+    for metric, key, metric_type in metrics:
+        full_name = 'cand_class_stage_'+metric
+        lines.append('# TYPE '+full_name+' '+metric_type)
+        for stage_name, agg in stages.items():
+            sample_name = full_name+'_total' if metric_type == 'counter' else full_name
+            lines.append(sample_name+'{stage="'+stage_name+'"} '+repr(float(agg[key])))
+    lines.append('# EOF')
+    return '\n'.join(lines)+'\n'
+
+
+def write_report(output_path, fmt='json', file_name=None):
+    """
+    Writes recorded stages to output_path as JSON (records and per-stage
+    summary) or OpenMetrics text
+
+    Parameters
+    ------------------------------------------------
+    output_path: str
+        output directory
+    fmt: str
+        'json' or 'openmetrics'
+    file_name: str
+        defaults to profile.json or profile.prom
+    """
+    os.makedirs(output_path, exist_ok=True)
+    if fmt == 'openmetrics':
+        file_name = os.path.join(output_path, file_name or 'profile.prom')
+        with open(file_name, 'w', encoding="utf-8") as out_file:
+            out_file.write(_openmetrics())
+        return file_name
+
+    file_name = os.path.join(output_path, file_name or 'profile.json')
+    with open(file_name, 'w', encoding="utf-8") as out_file:
+        json.dump({'summary': summary(), 'records': records()}, out_file, indent=2)
+    return file_name
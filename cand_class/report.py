@@ -0,0 +1,343 @@
+import importlib.util
+import io
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from cand_class.concurrency import get_budget
+from cand_class.profiling import profiled
+
+# read-only data of the running report, inherited by the forked workers
+_shared = {}
+
+
+class Ref:
+    """
+    Argument placeholder: shared data of the report or the result of another node
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Ref('+repr(self.name)+')'
+
+
+class PdfOut:
+    """
+    Argument placeholder for a PdfPages output file: the node gets a PdfPages
+    writing to memory, the file is written by a background writer thread
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+
+class BackgroundWriter:
+    """
+    Writes rendered files on background threads, so a node can draw the next
+    figure while the previous one goes to disk
+    """
+
+    def __init__(self, n_threads=2):
+        self._pool = ThreadPoolExecutor(max_workers=n_threads)
+        self._futures = []
+        self.bytes = 0
+
+    @staticmethod
+    def _write(file_name, data):
+        tmp_file = file_name+'.tmp'
+        with open(tmp_file, 'wb') as out_file:
+            out_file.write(data)
+        os.replace(tmp_file, file_name)
+
+    def write(self, file_name, data):
+        self.bytes += len(data)
+        self._futures.append(self._pool.submit(self._write, str(file_name), data))
+
+    def close(self):
+        """
+        Waits for all writes and re-raises the first error
+        """
+        try:
+            for future in self._futures:
+                future.result()
+        finally:
+            self._pool.shutdown()
+
+
+@contextmanager
+def deferred_savefig(writer):
+    """
+    Within the block Figure.savefig (and so plt.savefig) to a file name renders
+    the figure into memory right away and hands the bytes to writer
+    """
+    from matplotlib.figure import Figure
+
+    original = Figure.savefig
+
+    def savefig(fig, fname, *args, **kwargs):
+        if not isinstance(fname, (str, os.PathLike)):
+            return original(fig, fname, *args, **kwargs)
+        if kwargs.get('format') is None:
+            kwargs['format'] = os.path.splitext(str(fname))[1][1:] or None
+        buffer = io.BytesIO()
+        original(fig, buffer, *args, **kwargs)
+        writer.write(fname, buffer.getvalue())
+
+    Figure.savefig = savefig
+    try:
+        yield
+    finally:
+        Figure.savefig = original
+
+
+def _resolve(value, pdfs):
+    if isinstance(value, Ref):
+        return _shared[value.name]
+    if isinstance(value, PdfOut):
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        buffer = io.BytesIO()
+        pdfs.append((value.file_name, buffer, PdfPages(buffer)))
+        return pdfs[-1][2]
+    return value
+
+
+def _run_node(name, func, args, kwargs, writer_threads):
+    import matplotlib
+
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    if isinstance(func, str):
+        # 'shared_object.method'
+        obj, method = func.split('.', 1)
+        func = getattr(_shared[obj], method)
+
+    writer = BackgroundWriter(writer_threads)
+    pdfs = []
+    try:
+        with deferred_savefig(writer):
+            result = func(*[_resolve(arg, pdfs) for arg in args],
+                          **{key: _resolve(value, pdfs) for key, value in kwargs.items()})
+        for file_name, buffer, pdf in pdfs:
+            # close() is a no-op if the node closed the file itself
+            pdf.close()
+            writer.write(file_name, buffer.getvalue())
+        compute = time.perf_counter() - start
+    finally:
+        plt.close('all')
+        writer.close()
+    return name, result, {'compute': compute, 'wall_time': time.perf_counter() - start, 'bytes': writer.bytes}
+
+
+class ReportGraph:
+    """
+    Report stages as a dependency graph. Nodes without pending dependencies
+    run concurrently on a forked process pool; the shared data (DataFrames,
+    the ApplyXGB object, the model) is inherited read-only by the workers
+    instead of being pickled for every node
+
+    Parameters
+    ------------------------------------------------
+    shared: dict
+        name -> read-only data, referenced by Ref(name) arguments or
+        'name.method' node functions
+    """
+
+    def __init__(self, shared=None):
+        self.shared = dict(shared or {})
+        self.nodes = {}
+
+    def add(self, name, func, *args, deps=(), **kwargs):
+        """
+        Adds a node calling func(*args, **kwargs). func is a picklable callable
+        or 'shared_name.method'; Ref(node) arguments pass the result of another
+        node and make it a dependency, deps adds dependencies without passing
+        results (e.g. stages writing into the same ROOT file)
+        """
+        if name in self.nodes or name in self.shared:
+            raise ValueError('Duplicate report node '+name)
+        refs = [value.name for value in list(args) + list(kwargs.values()) if isinstance(value, Ref)]
+        self.nodes[name] = {'func': func, 'args': args, 'kwargs': kwargs,
+                            'deps': set(deps) | {ref for ref in refs if ref not in self.shared}}
+        return self
+
+    def _check(self):
+        for name, node in self.nodes.items():
+            unknown = [dep for dep in node['deps'] if dep not in self.nodes]
+            if unknown:
+                raise ValueError('Report node '+name+' depends on unknown nodes '+', '.join(unknown))
+        done, pending = set(), dict(self.nodes)
+        while pending:
+            ready = [name for name, node in pending.items() if node['deps'] <= done]
+            if not ready:
+                raise ValueError('Report graph has a cycle between '+', '.join(sorted(pending)))
+            done.update(ready)
+            for name in ready:
+                del pending[name]
+
+    @profiled(name='ReportGraph.run')
+    def run(self, n_workers=None, writer_threads=2, output_path=None):
+        """
+        Runs all nodes and returns ({node: result}, {node: timings}). With
+        output_path the node timings go to run_metadata.json, and the next run
+        starts the ready nodes that took longest last time first
+        """
+        global _shared
+
+        self._check()
+        n_workers = max(1, min(n_workers or get_budget().total_cores, len(self.nodes)))
+        results, timings = {}, {}
+        previous = {}
+        if output_path is not None:
+            from cand_class.run_metadata import read_run_metadata
+
+            previous = read_run_metadata(output_path).get('report', {}).get('nodes', {})
+        order = sorted(self.nodes, key=lambda name: -previous.get(name, {}).get('wall_time', 0))
+        start = time.perf_counter()
+
+        def submit(pool, name):
+            node = self.nodes[name]
+            args = [results[arg.name] if isinstance(arg, Ref) and arg.name in results else arg
+                    for arg in node['args']]
+            kwargs = {key: results[value.name] if isinstance(value, Ref) and value.name in results else value
+                      for key, value in node['kwargs'].items()}
+            return pool.submit(_run_node, name, node['func'], args, kwargs, writer_threads)
+
+        _shared = self.shared
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp.get_context('fork')) as pool:
+                running = {}
+                pending = set(self.nodes)
+                while pending or running:
+                    for name in [name for name in order if name in pending]:
+                        if self.nodes[name]['deps'] <= set(results):
+                            running[submit(pool, name)] = name
+                            pending.discard(name)
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        del running[future]
+                        name, result, timing = future.result()
+                        results[name] = result
+                        timings[name] = timing
+        finally:
+            _shared = {}
+
+        wall_time = time.perf_counter() - start
+        print('Report: %d nodes on %d workers in %.2f s (sum of node times %.2f s)'
+              % (len(self.nodes), n_workers, wall_time, sum(t['wall_time'] for t in timings.values())))
+        if output_path is not None:
+            from cand_class.run_metadata import update_run_metadata
+
+            update_run_metadata(output_path, 'report', {'workers': n_workers, 'wall_time': wall_time,
+                                                        'nodes': timings})
+        return results, timings
+
+
+def _differences(df_orig, df_cut):
+    import pandas as pd
+
+    return pd.concat([df_orig, df_cut]).drop_duplicates(keep=False)
+
+
+def _root_hists(output_path, *args, **kwargs):
+    from cand_class.hists_root import HistBuilder
+
+    HistBuilder(output_path).hist_variables_root(*args, **kwargs)
+
+
+def _root_pt_rap(output_path, *args):
+    from cand_class.hists_root import HistBuilder
+
+    HistBuilder(output_path).pt_rap_root(*args)
+
+
+def standard_report(apply_xgb, model, signal, background, test_res, mass_var, peak, mass_range, x_range, y_range,
+                    pt_rap, output_path, sign_label='issignal', pred_label='xgb_preds1', root=None, robust=False):
+    """
+    ReportGraph of the usual evaluation plots after training: feature
+    importance, confusion matrices, pT-rapidity maps, variable histograms,
+    correlation matrices, mass profiles and 2D distributions of signal and
+    background and, if PyROOT is available, the HistBuilder histograms
+
+    Parameters
+    ------------------------------------------------
+    apply_xgb: ApplyXGB
+        after get_predictions and apply_prob_cut
+    model: XGBClassifier
+        trained model
+    signal, background: pandas.DataFrame
+        signal and background samples for the correlation and mass plots
+    test_res: pandas.DataFrame
+        test sample with the sign_label and pred_label columns
+    mass_var: str
+        invariant mass variable
+    peak: float
+        mass peak position
+    mass_range: list
+        mass range of the mass plots
+    x_range, y_range: list
+        rapidity and pT ranges
+    pt_rap: list
+        pT and rapidity names
+    root: bool
+        HistBuilder nodes, by default if PyROOT can be imported
+    robust: bool
+        histogram and 2D plot ranges cover the central 99.8% quantile range
+        instead of min to max
+
+    The column statistics (column_stats.ColumnStats) of signal, background
+    and test sample are computed once here and shared by all plotting nodes
+    """
+    if root is None:
+        # not imported here, PyROOT must not be loaded in the parent before the pool forks
+        root = importlib.util.find_spec('ROOT') is not None
+
+    from cand_class import MLconfig_variables as mlv
+    from cand_class.column_stats import ColumnStats
+
+    variables = [var for var in signal.columns if var != sign_label]
+    test_vars = [var for var in test_res.columns if var not in (sign_label, pred_label)]
+    graph = ReportGraph({'apply_xgb': apply_xgb, 'model': model, 'signal': signal[variables],
+                         'background': background[variables], 'test_res': test_res,
+                         'signal_stats': ColumnStats.from_frame(signal, variables),
+                         'background_stats': ColumnStats.from_frame(background, variables),
+                         'test_stats': ColumnStats.from_frame(test_res, test_vars)})
+
+    graph.add('features_importance', 'apply_xgb.features_importance', Ref('model'))
+    graph.add('confusion_matrix', 'apply_xgb.CM_plot_train_test', sign_label)
+    graph.add('pt_rap', 'apply_xgb.pT_vs_rapidity', Ref('test_res'), sign_label, pred_label, x_range, y_range,
+              'test', pt_rap)
+    graph.add('hist_variables', 'apply_xgb.hist_variables', mass_var, Ref('test_res'), sign_label, pred_label,
+              'test', PdfOut(output_path+'/hists_test.pdf'), stats=Ref('test_stats'), robust=robust)
+    graph.add('correlation_matrix', mlv.correlation_matrix, Ref('background'), Ref('signal'), variables,
+              ['background', 'signal'], output_path)
+    for sample, sgn in (('signal', 1), ('background', 0)):
+        graph.add('profile_mass_'+sample, mlv.profile_mass, Ref(sample), mass_var, sgn, peak, mass_range[0],
+                  mass_range[1], PdfOut(output_path+'/mass_profile_'+sample+'.pdf'))
+        graph.add('plot2D_all_'+sample, mlv.plot2D_all, Ref(sample), sample, sgn,
+                  PdfOut(output_path+'/dist_2D_all_'+sample+'.pdf'), stats=Ref(sample+'_stats'), robust=robust)
+        graph.add('plot2D_mass_'+sample, mlv.plot2D_mass, Ref(sample), sample, mass_var, mass_range, sgn, peak,
+                  PdfOut(output_path+'/dist_2D_mass_'+sample+'.pdf'), stats=Ref(sample+'_stats'), robust=robust)
+
+    if root:
+        # all HistBuilder stages update the same hists.root, so they run one after another
+        test_df = test_res[test_vars]
+        graph.shared.update({
+            'dfs_orig': test_df[test_res[sign_label] == 1],
+            'dfb_orig': test_df[test_res[sign_label] == 0],
+            'dfs_cut': test_df[(test_res[sign_label] == 1) & (test_res[pred_label] == 1)],
+            'dfb_cut': test_df[(test_res[sign_label] == 0) & (test_res[pred_label] == 1)],
+        })
+        graph.add('difference_s', _differences, Ref('dfs_orig'), Ref('dfs_cut'))
+        graph.add('hist_variables_root', _root_hists, output_path, mass_var, Ref('dfs_orig'), Ref('dfb_orig'),
+                  Ref('dfs_cut'), Ref('dfb_cut'), Ref('difference_s'), 'test', stats=Ref('test_stats'),
+                  robust=robust)
+        graph.add('pt_rap_root', _root_pt_rap, output_path, Ref('dfs_orig'), Ref('dfs_cut'), Ref('difference_s'),
+                  1, x_range, y_range, 'test', deps=['hist_variables_root'])
+    return graph
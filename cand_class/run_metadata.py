@@ -0,0 +1,31 @@
+import json
+import os
+
+
+RUN_METADATA_NAME = 'run_metadata.json'
+
+
+def read_run_metadata(output_path):
+    """
+    Returns the run metadata stored in output_path, empty dict if there is none
+    """
+    file_name = os.path.join(str(output_path), RUN_METADATA_NAME)
+    if not os.path.exists(file_name):
+        return {}
+    with open(file_name, encoding="utf-8") as inp_file:
+        return json.load(inp_file)
+
+
+def update_run_metadata(output_path, section, values):
+    """
+    Stores values under section in output_path/run_metadata.json, keeping
+    the other sections of the file
+    """
+    metadata = read_run_metadata(output_path)
+    metadata[section] = values
+
+    os.makedirs(str(output_path), exist_ok=True)
+    file_name = os.path.join(str(output_path), RUN_METADATA_NAME)
+    with open(file_name+'.tmp', 'w', encoding="utf-8") as out_file:
+        json.dump(metadata, out_file, indent=2, default=str)
+    os.replace(file_name+'.tmp', file_name)
@@ -0,0 +1,179 @@
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+from cand_class.features import feature_matrix, raw_branch
+from cand_class.memory import get_memory_budget
+from cand_class.model_io import as_booster, booster_features, load_booster
+
+
+def model_key(model):
+    """
+    sha256 of the model content (the UBJSON serialization of the Booster), the
+    same for a model loaded from .json, .ubj, an artifact or a pickle
+
+    Parameters
+    ------------------------------------------------
+    model: str, xgboost.Booster, XGBClassifier or ModelHandler
+        see model_io.load_booster and model_io.as_booster
+    """
+    if isinstance(model, (str, os.PathLike)):
+        model = load_booster(model)
+    return hashlib.sha256(bytes(as_booster(model).save_raw('ubj'))).hexdigest()
+
+
+def _file_fingerprint(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def dataset_key(dataset, columns):
+    """
+    Content hash of the columns a model reads, in row order, so stored scores
+    are aligned with the rows of the candidate table. For
+    {'files': [...], 'tree': 't'} datasets the files are fingerprinted by
+    path, size and modification time
+
+    Parameters
+    ------------------------------------------------
+    dataset: pandas.DataFrame or dict
+        candidate table or ROOT files
+    columns: list of str
+        model features, raw branches are used where a feature column is missing
+    """
+    sha = hashlib.sha256()
+    if isinstance(dataset, pd.DataFrame):
+        columns = [column if column in dataset.columns else raw_branch(column) for column in columns]
+        sha.update(json.dumps(columns).encode())
+        sha.update(pd.util.hash_pandas_object(dataset[columns], index=False).to_numpy().tobytes())
+    else:
+        files = [dataset['files']] if isinstance(dataset['files'], str) else dataset['files']
+        sha.update(json.dumps({'files': [_file_fingerprint(file_name) for file_name in files],
+                               'tree': dataset['tree'], 'columns': list(columns)}).encode())
+    return sha.hexdigest()
+
+
+class ScoreStore:
+    """
+    Model outputs as float32 arrays on disk, one .npy file per (model, dataset)
+    keyed by model_key and dataset_key and aligned with the rows of the dataset.
+    Scores are returned memory-mapped read-only, so several processes (e.g.
+    the workers of report.ReportGraph) share the same pages; entries are
+    written to a temporary file and renamed, so readers never see a partial one
+
+        store = ScoreStore('output/scores')
+        y_pred_test = store.scores(model, x_test)
+
+    Parameters
+    ------------------------------------------------
+    path: str
+        store directory
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def _path(self, mkey, dkey):
+        return os.path.join(self.path, mkey[:16], dkey[:16]+'.npy')
+
+    def __contains__(self, keys):
+        return os.path.isfile(self._path(*keys))
+
+    def get(self, mkey, dkey, mmap_mode='r'):
+        return np.load(self._path(mkey, dkey), mmap_mode=mmap_mode)
+
+    def info(self, mkey, dkey):
+        with open(self._path(mkey, dkey)[:-4]+'.json', encoding="utf-8") as inp_file:
+            return json.load(inp_file)
+
+    @contextmanager
+    def open_entry(self, mkey, dkey, n_rows, **info):
+        """
+        Yields a writable float32 memmap of n_rows scores; the entry appears in
+        the store when the block ends without an error
+        """
+        path = self._path(mkey, dkey)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_file = path+'.'+str(os.getpid())+'.tmp'
+        scores = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(n_rows,))
+        try:
+            yield scores
+            scores.flush()
+        except BaseException:
+            del scores
+            os.remove(tmp_file)
+            raise
+        del scores
+        with open(path[:-4]+'.json', 'w', encoding="utf-8") as out_file:
+            json.dump(dict(info, model=mkey, dataset=dkey, rows=n_rows, created=time.time()), out_file, indent=2)
+        os.replace(tmp_file, path)
+
+    def put(self, mkey, dkey, scores, **info):
+        scores = np.asarray(scores, dtype=np.float32)
+        with self.open_entry(mkey, dkey, len(scores), **info) as out:
+            out[:] = scores
+        return self.get(mkey, dkey)
+
+    def remove(self, mkey, dkey):
+        path = self._path(mkey, dkey)
+        for file_name in (path, path[:-4]+'.json'):
+            if os.path.isfile(file_name):
+                os.remove(file_name)
+
+    def entries(self):
+        """
+        Metadata of all stored entries
+        """
+        entries = []
+        for model_dir in sorted(os.listdir(self.path)):
+            if not os.path.isdir(os.path.join(self.path, model_dir)):
+                continue
+            for file_name in sorted(os.listdir(os.path.join(self.path, model_dir))):
+                if file_name.endswith('.json'):
+                    with open(os.path.join(self.path, model_dir, file_name), encoding="utf-8") as inp_file:
+                        entries.append(json.load(inp_file))
+        return entries
+
+    def scores(self, model, df, features=None, step_size=None, nthread=None, name=None):
+        """
+        Scores of model on the rows of df, read from the store or predicted
+        chunk by chunk straight into a new entry. df is only read, no column
+        is added to it
+
+        Parameters
+        ------------------------------------------------
+        model: str, xgboost.Booster, XGBClassifier or ModelHandler
+            trained model
+        df: pandas.DataFrame
+            candidates with the model features or their raw branches
+        features: list of str
+            train variables if they are not stored in the model
+        step_size: int
+            candidates predicted at once, sized from the memory budget by default
+        name: str
+            dataset name kept in the entry metadata
+        """
+        booster = as_booster(load_booster(model) if isinstance(model, (str, os.PathLike)) else model)
+        features = booster_features(booster, features)
+        mkey, dkey = model_key(booster), dataset_key(df, features)
+        if (mkey, dkey) in self:
+            return self.get(mkey, dkey)
+
+        if nthread is not None:
+            booster.set_param({'nthread': nthread})
+        step_size = step_size or get_memory_budget().chunk_rows(12 * len(features) + 4)
+        with self.open_entry(mkey, dkey, len(df), features=features, name=name) as out:
+            for start in range(0, len(df), step_size):
+                chunk = df.iloc[start:start + step_size]
+                if all(feature in chunk.columns for feature in features):
+                    x = chunk[features].to_numpy(dtype=np.float32)
+                else:
+                    x = feature_matrix(chunk, features)
+                out[start:start + len(chunk)] = booster.inplace_predict(x)
+        return self.get(mkey, dkey)
@@ -0,0 +1,344 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import uproot
+
+from cand_class.concurrency import get_budget
+from cand_class.features import feature_matrix, required_branches
+from cand_class.loader import ChunkLoader, LoaderStats
+from cand_class.memory import get_memory_budget
+from cand_class.model_io import booster_features, load_booster
+from cand_class import profiling
+from cand_class.profiling import profiled
+
+
+# model and settings loaded once per worker process by _init_worker
+_worker = {}
+
+
+def shard_files(files, n_shards):
+    """
+    Splits files into n_shards lists, file i goes to shard i % n_shards.
+    Empty shards are dropped, so the result is reproducible for a given file list
+    """
+    files = list(files)
+    n_shards = max(1, min(int(n_shards), len(files)))
+    return [files[i::n_shards] for i in range(n_shards)]
+
+
+def read_file_list(paths):
+    """
+    Expands paths into a list of ROOT files. Arguments ending with .txt or .list
+    are read as file lists with one path per line, '#' starts a comment
+    """
+    files = []
+    for path in paths:
+        if str(path).endswith(('.txt', '.list')):
+            with open(path, encoding="utf-8") as list_file:
+                for line in list_file:
+                    line = line.split('#')[0].strip()
+                    if line:
+                        files.append(line)
+        else:
+            files.append(str(path))
+    return files
+
+
+class _ShardWriter:
+    """
+    Appends scored chunks to a per-shard ROOT tree or Parquet file
+    """
+
+    def __init__(self, path, out_format, tree_name):
+        self.path = path
+        self.out_format = out_format
+        self.tree_name = tree_name
+        self._file = None
+        self._tree = None
+
+    def write(self, df):
+        if self.out_format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self._file is None:
+                self._file = pq.ParquetWriter(self.path, table.schema)
+            self._file.write_table(table)
+            return
+
+        branches = {col: df[col].to_numpy() for col in df.columns}
+        if self._file is None:
+            self._file = uproot.recreate(self.path)
+            # assigning a dict writes an RNTuple in recent uproot versions, the output stays a TTree
+            self._tree = self._file.mktree(self.tree_name, {col: array.dtype for col, array in branches.items()})
+        self._tree.extend(branches)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+def _init_worker(model_file, features, nthread, cascade=None, io_threads=None, profile=False, backend='booster'):
+    _worker['io_threads'] = io_threads or nthread
+    # forked workers inherit the profiling state and the records of the parent
+    profiling.reset()
+    if profile:
+        profiling.enable()
+    else:
+        profiling.disable()
+    if os.path.isfile(os.path.join(model_file, 'bundle.json')):
+        # per-(pT, rapidity)-bin bundle from binned_training.train_binned
+        from cand_class.binned_training import ModelBundle
+
+        bundle = ModelBundle.load(model_file, nthread)
+        _worker['features'] = bundle.features
+        _worker['predict'] = bundle.predict_df
+        _worker['extra_branches'] = [bundle.pt_var, bundle.rap_var]
+    elif backend == 'numpy' and os.path.isfile(os.path.join(model_file, 'artifact.json')):
+        # memory-mapped read-only, all workers on the node share the pages of one copy
+        from cand_class.artifact import ModelArtifact
+
+        artifact = ModelArtifact.load(model_file)
+        forest = artifact.forest()
+        _worker['features'] = list(features) if features is not None else artifact.features
+        _worker['predict'] = lambda chunk: forest.predict(feature_matrix(chunk, _worker['features']))
+        _worker['extra_branches'] = []
+    elif backend == 'numpy':
+        from cand_class.tree_eval import FlatForest
+
+        booster = load_booster(model_file)
+        _worker['features'] = booster_features(booster, features)
+        forest = FlatForest.from_booster(booster)
+        _worker['predict'] = lambda chunk: forest.predict(feature_matrix(chunk, _worker['features']))
+        _worker['extra_branches'] = []
+    else:
+        booster = load_booster(model_file)
+        booster.set_param({'nthread': nthread})
+        _worker['features'] = booster_features(booster, features)
+        _worker['predict'] = lambda chunk: booster.inplace_predict(feature_matrix(chunk, _worker['features']))
+        _worker['extra_branches'] = []
+    _worker['stage_one'] = None
+    if cascade is not None:
+        from cand_class.cascade import load_stage
+
+        _worker['stage_one'] = load_stage(cascade)
+        if _worker['stage_one'].kind == 'booster':
+            _worker['stage_one'].booster.set_param({'nthread': nthread})
+
+
+def _score_shard_profiled(*args):
+    # the stage records of a worker go back with the shard result and are merged in the parent
+    profiling.reset()
+    result = score_shard(*args)
+    return result, profiling.records()
+
+
+@profiled(rows=lambda res, *args, **kwargs: sum(f['candidates'] for f in res['files']))
+def score_shard(shard_id, files, tree_name, output_path, out_format='root', keep_branches=(),
+                step_size=100000, bins=100, threshold=None, prefetch=2):
+    """
+    Scores all candidates of the shard files in chunks and writes the scores
+    together with keep_branches to one output file per shard
+
+    Parameters
+    ------------------------------------------------
+    shard_id: int
+        shard index, used for the output name
+    files: list of str
+        ROOT files of the shard
+    tree_name: str
+        name of the candidate tree
+    output_path: str
+        directory for the per-shard outputs
+    out_format: str
+        'root' or 'parquet'
+    keep_branches: list of str
+        branches copied to the output next to the score
+    step_size: int or str
+        number of candidates per chunk or a size like '50 MB'
+    bins: int
+        number of bins of the score histogram in [0, 1]
+    threshold: float
+        if set, candidates with score > threshold are counted
+    prefetch: int
+        chunks read ahead while the current one is scored (see loader.ChunkLoader)
+
+    Returns
+    -------
+    dict with shard id, output file, per-file candidate counts, score histogram
+    and I/O counters (loader.LoaderStats).
+    With a cascade stage, candidates rejected by stage one get the score -1,
+    are counted as 'rejected' and are not in the score histogram
+    """
+    predict = _worker['predict']
+    features = _worker['features']
+    stage_one = _worker.get('stage_one')
+    extra = list(keep_branches) + _worker['extra_branches'] + (stage_one.branches if stage_one is not None else [])
+    branches = required_branches(features, extra)
+
+    extension = '.parquet' if out_format == 'parquet' else '.root'
+    out_file = os.path.join(output_path, 'scores_shard_%04d' % shard_id + extension)
+    writer = _ShardWriter(out_file, out_format, tree_name)
+
+    edges = np.linspace(0, 1, bins + 1)
+    hist = np.zeros(bins, dtype=np.int64)
+    file_counts = {file_name: {'file': file_name, 'candidates': 0, 'passed': 0, 'rejected': 0}
+                   for file_name in files}
+    loader = ChunkLoader(files, tree_name, branches, step_size, _worker.get('io_threads'), prefetch)
+
+    try:
+        for file_name, chunk in loader:
+            counts = file_counts[file_name]
+            if stage_one is None:
+                scores = np.asarray(predict(chunk), dtype=np.float32)
+            else:
+                survivors = stage_one.mask(chunk)
+                scores = np.full(len(chunk), -1, dtype=np.float32)
+                if survivors.any():
+                    scores[survivors] = predict(chunk[survivors])
+                counts['rejected'] += len(chunk) - int(np.count_nonzero(survivors))
+
+            out = pd.DataFrame({branch: chunk[branch].to_numpy() for branch in keep_branches})
+            out['xgb_preds'] = scores
+            writer.write(out)
+
+            hist += np.histogram(scores, bins=edges)[0]
+            counts['candidates'] += len(scores)
+            if threshold is not None:
+                counts['passed'] += int(np.count_nonzero(scores > threshold))
+    finally:
+        writer.close()
+
+    return {'shard': shard_id, 'output': out_file, 'files': list(file_counts.values()), 'score_hist': hist,
+            'io': loader.stats.as_dict()}
+
+
+def merge_shard_results(results, bins=100):
+    """
+    Merges per-shard results in shard order, so the merged summary does not
+    depend on the order in which workers finished
+    """
+    results = sorted(results, key=lambda res: res['shard'])
+
+    hist = np.zeros(bins, dtype=np.int64)
+    files = []
+    io = LoaderStats()
+    for res in results:
+        hist += res['score_hist']
+        files.extend(res['files'])
+        if 'io' in res:
+            io.merge(res['io'])
+
+    return {
+        'score_edges': np.linspace(0, 1, bins + 1).tolist(),
+        'score_hist': hist.tolist(),
+        'candidates': int(sum(f['candidates'] for f in files)),
+        'passed': int(sum(f['passed'] for f in files)),
+        'rejected': int(sum(f.get('rejected', 0) for f in files)),
+        'outputs': [res['output'] for res in results],
+        'files': files,
+        'io': io.as_dict(),
+    }
+
+
+@profiled(rows=lambda res, *args, **kwargs: res['candidates'])
+def score_files(files, model_file, tree_name, output_path, out_format='root', keep_branches=(),
+                n_workers=None, n_shards=None, step_size=None, bins=100, threshold=None,
+                features=None, cascade=None, io_threads=None, prefetch=2, backend='booster'):
+    """
+    Scores many ROOT files with a trained model on a process pool. Each worker
+    loads the model once, files are split into shards, every shard writes its
+    own output and the per-shard histograms and counts are merged into
+    output_path/summary.json
+
+    Parameters
+    ------------------------------------------------
+    files: list of str
+        input ROOT files
+    model_file: str
+        trained model, see model_io.load_booster (including model artifact
+        directories), or the directory of a per-bin bundle (binned_training.ModelBundle)
+    tree_name: str
+        name of the candidate tree
+    output_path: str
+        output directory
+    out_format: str
+        'root' or 'parquet'
+    keep_branches: list of str
+        branches written next to the score
+    n_workers: int
+        number of worker processes, defaults to the outer size of the thread
+        budget (see concurrency.ThreadBudget) if it is set above 1, otherwise
+        one process per core of the budget. The cores of the budget are
+        shared between the workers as XGBoost threads
+    n_shards: int
+        number of shards, defaults to n_workers
+    step_size: int
+        number of candidates scored at once, by default chunks of the memory
+        budget share of a worker (see memory.MemoryBudget.step_size)
+    bins: int
+        number of bins of the merged score histogram
+    threshold: float
+        BDT cut used for the passed-candidates counts, the threshold stored
+        in a model artifact by default
+    features: list of str
+        train variables if they are not stored in the model
+    cascade: str
+        stage-one spec written by cascade.save_stage, the full model only
+        scores candidates surviving stage one
+    io_threads: int
+        basket decompression threads per worker, by default the XGBoost
+        threads of a worker
+    prefetch: int
+        chunks each worker reads ahead while scoring
+    backend: str
+        'booster' (XGBoost inplace_predict, every worker holds its own booster)
+        or 'numpy' (tree_eval.FlatForest, for a model artifact its forest
+        arrays are memory-mapped, so all workers share one copy of the model
+        at the price of slower trees). Per-bin bundles always use their boosters
+
+    Returns
+    -------
+    merged summary dict, its 'io' entry holds the summed loader counters
+    (bytes_read, read_time, decompress_time, stall_time)
+    """
+    if backend not in ('booster', 'numpy'):
+        raise ValueError('Unknown scoring backend '+str(backend))
+    if threshold is None and os.path.isfile(os.path.join(model_file, 'artifact.json')):
+        from cand_class.artifact import read_spec
+
+        threshold = read_spec(model_file)['threshold']
+
+    budget = get_budget()
+    # scoring scales best with one single-threaded process per core
+    n_workers = n_workers or (budget.outer if budget.outer > 1 else budget.total_cores)
+    shards = shard_files(files, n_shards or n_workers)
+    n_workers = min(n_workers, len(shards))
+    nthread = max(1, budget.total_cores // n_workers)
+    step_size = step_size or get_memory_budget().step_size(n_workers)
+    os.makedirs(output_path, exist_ok=True)
+    get_memory_budget().record(output_path, 'score_files', workers=n_workers, step_size=step_size)
+    budget.record(output_path, 'score_files', workers=n_workers, nthread=nthread, io_threads=io_threads or nthread,
+                  prefetch=prefetch, backend=backend)
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(model_file, features, nthread, cascade, io_threads,
+                                       profiling.is_enabled(), backend)) as pool:
+        futures = [pool.submit(_score_shard_profiled, i, shard, tree_name, output_path, out_format,
+                               tuple(keep_branches), step_size, bins, threshold, prefetch)
+                   for i, shard in enumerate(shards)]
+        results = []
+        for shard_id, future in enumerate(futures):
+            result, records = future.result()
+            profiling.merge(records, shard=shard_id)
+            results.append(result)
+
+    summary = merge_shard_results(results, bins)
+    with open(os.path.join(output_path, 'summary.json'), 'w', encoding="utf-8") as out_file:
+        json.dump(summary, out_file, indent=2)
+
+    return summary
@@ -0,0 +1,379 @@
+import collections
+import http.client
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from cand_class.backends import load_backends
+from cand_class.concurrency import get_budget
+from cand_class.features import feature_matrix, required_branches
+
+
+class _Request:
+
+    def __init__(self, columns, n):
+        self.columns = columns
+        self.n = n
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.scores = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Collects concurrent scoring requests into micro-batches. The batch is
+    evaluated as soon as it holds max_batch candidates or max_delay seconds
+    after its first request arrived, whichever comes first, so a single
+    request never waits longer than the latency budget for company
+
+    Parameters
+    ------------------------------------------------
+    backend: cand_class.backends.Backend
+        resident model
+    features: list of str
+        model features in training order
+    max_batch: int
+        maximal number of candidates per batch
+    max_delay: float
+        latency budget in seconds
+    """
+
+    def __init__(self, backend, features, max_batch=4096, max_delay=0.002):
+        self.backend = backend
+        self.features = features
+        self.branches = required_branches(features)
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {'requests': 0, 'candidates': 0, 'batches': 0, 'errors': 0,
+                         'queued_candidates': 0, 'busy_seconds': 0.0}
+        # request latencies of the last requests for the p50/p99 gauges
+        self.latencies = collections.deque(maxlen=10000)
+
+        self.thread = threading.Thread(target=self._loop, name='cand_class-batcher', daemon=True)
+        self.thread.start()
+
+    def submit(self, columns):
+        """
+        Scores one request and blocks until its batch is evaluated
+
+        Parameters
+        ------------------------------------------------
+        columns: dict
+            branch name -> list of values, all branches of required_branches(features)
+            with the same number of values
+        """
+        missing = [branch for branch in self.branches if branch not in columns]
+        if missing:
+            raise ValueError('Missing branches: '+', '.join(missing))
+        # checked here, so a malformed request can neither fail nor shift the scores of its batch
+        arrays = {}
+        for branch in self.branches:
+            try:
+                arrays[branch] = np.asarray(columns[branch], dtype=np.float64)
+            except (TypeError, ValueError):
+                raise ValueError('Branch '+branch+' is not a list of numbers') from None
+            if arrays[branch].ndim != 1:
+                raise ValueError('Branch '+branch+' is not a list of numbers')
+        lengths = {branch: len(values) for branch, values in arrays.items()}
+        n = lengths[self.branches[0]]
+        if any(length != n for length in lengths.values()):
+            raise ValueError('Branches of different lengths: '+json.dumps(lengths))
+        request = _Request(arrays, n)
+        with self.lock:
+            self.counters['queued_candidates'] += n
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.scores
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _loop(self):
+        while True:
+            first = self.queue.get()
+            if first is None:
+                return
+            batch = [first]
+            n = first.n
+            deadline = first.arrival + self.max_delay
+            while n < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                try:
+                    request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._evaluate(batch)
+                    return
+                batch.append(request)
+                n += request.n
+            self._evaluate(batch)
+
+    def _score(self, requests):
+        df = pd.DataFrame({branch: np.concatenate([request.columns[branch] for request in requests])
+                           for branch in self.branches})
+        scores = np.asarray(self.backend.predict(feature_matrix(df, self.features)), dtype=np.float32)
+        offset = 0
+        for request in requests:
+            request.scores = scores[offset:offset + request.n]
+            offset += request.n
+
+    def _evaluate(self, batch):
+        start = time.perf_counter()
+        n = sum(request.n for request in batch)
+        try:
+            self._score(batch)
+        except Exception as error:
+            if len(batch) == 1:
+                batch[0].error = error
+            else:
+                # score the requests one by one, so one failing request does not fail the others
+                for request in batch:
+                    try:
+                        self._score([request])
+                    except Exception as request_error:
+                        request.error = request_error
+
+        end = time.perf_counter()
+        with self.lock:
+            self.counters['requests'] += len(batch)
+            self.counters['candidates'] += n
+            self.counters['batches'] += 1
+            self.counters['queued_candidates'] -= n
+            self.counters['busy_seconds'] += end - start
+            self.counters['errors'] += sum(request.error is not None for request in batch)
+            for request in batch:
+                self.latencies.append(end - request.arrival)
+        for request in batch:
+            request.done.set()
+
+    def stats(self):
+        """
+        Returns counters (totals since start) and gauges (queue depth,
+        throughput, mean batch size, latency percentiles)
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            latencies = np.array(self.latencies)
+        uptime = time.time() - self.started
+        stats['uptime_seconds'] = uptime
+        stats['queue_depth'] = self.queue.qsize()
+        stats['throughput'] = stats['candidates'] / uptime if uptime > 0 else 0.0
+        stats['mean_batch_size'] = stats['candidates'] / stats['batches'] if stats['batches'] else 0.0
+        stats['latency_p50_seconds'] = float(np.percentile(latencies, 50)) if len(latencies) else 0.0
+        stats['latency_p99_seconds'] = float(np.percentile(latencies, 99)) if len(latencies) else 0.0
+        return stats
+
+    def openmetrics(self):
+        stats = self.stats()
+        lines = []
+        for key, value in stats.items():
+            counter = key in self.counters and key != 'queued_candidates'
+            full_name = 'cand_class_service_'+key
+            lines.append('# TYPE '+full_name+' '+('counter' if counter else 'gauge'))
+            lines.append(full_name+('_total' if counter else '')+' '+repr(float(value)))
+        lines.append('# EOF')
+        return '\n'.join(lines)+'\n'
+
+
+def _handle(batcher, message, threshold):
+    if message.get('command') == 'stats':
+        return batcher.stats()
+    candidates = message['candidates']
+    if isinstance(candidates, list):
+        candidates = {branch: [row[branch] for row in candidates] for branch in batcher.branches}
+    scores = batcher.submit(candidates)
+    response = {'scores': scores.tolist()}
+    if threshold is not None:
+        response['selected'] = (scores > threshold).astype(int).tolist()
+    return response
+
+
+class _HTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # small keep-alive responses otherwise wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
+    def _send(self, code, body, content_type='application/json'):
+        data = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._send(200, json.dumps(self.server.batcher.stats()))
+        elif self.path == '/metrics':
+            self._send(200, self.server.batcher.openmetrics(), 'application/openmetrics-text; version=1.0.0')
+        elif self.path == '/health':
+            self._send(200, '{"status": "ok"}')
+        else:
+            self._send(404, '{"error": "not found"}')
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._send(404, '{"error": "not found"}')
+            return
+        try:
+            message = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            self._send(200, json.dumps(_handle(self.server.batcher, message, self.server.threshold)))
+        except (KeyError, ValueError, TypeError) as error:
+            self._send(400, json.dumps({'error': str(error)}))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _UnixHandler(socketserver.StreamRequestHandler):
+    # one JSON message per line, one JSON response per line
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = _handle(self.server.batcher, json.loads(line), self.server.threshold)
+            except (KeyError, ValueError, TypeError) as error:
+                response = {'error': str(error)}
+            self.wfile.write(json.dumps(response).encode('utf-8')+b'\n')
+
+
+class _UnixServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(model_file, socket_path=None, host='127.0.0.1', port=8765, backend='booster_inplace',
+                lib_path=None, max_batch=4096, max_delay_ms=2.0, threshold=None, features=None):
+    """
+    Loads the model once and creates a scoring server on a Unix socket
+    (socket_path) or on localhost HTTP (host, port). Requests are coalesced
+    by a MicroBatcher available as server.batcher
+
+    HTTP: POST /predict with {"candidates": {"branch": [values]}} (or a list of
+    per-candidate dicts) returns {"scores": [...]}, plus "selected" if threshold
+    is given; GET /stats (JSON) and /metrics (OpenMetrics) return the counters.
+    Unix socket: the same JSON messages, one per line; {"command": "stats"}
+    returns the counters
+
+    Parameters
+    ------------------------------------------------
+    model_file: str
+        trained model, see model_io.load_booster
+    socket_path: str
+        Unix socket to listen on, HTTP if None
+    host: str
+        HTTP host, keep it on localhost
+    port: int
+        HTTP port, 0 picks a free one
+    backend: str
+        one of backends.load_backends ('booster_inplace', 'numpy', 'treelite', 'model_handler')
+    lib_path: str
+        compiled treelite library for the treelite backend
+    max_batch: int
+        maximal number of candidates per micro-batch
+    max_delay_ms: float
+        latency budget a request may wait for further requests
+    threshold: float
+        BDT cut for the "selected" flags
+    features: list of str
+        train variables if they are not stored in the model
+    """
+    backends, features = load_backends(model_file, lib_path=lib_path, nthread=get_budget().total_cores,
+                                       features=features, names=[backend])
+    if backend not in backends:
+        raise ValueError('Backend '+backend+' is not available')
+    batcher = MicroBatcher(backends[backend], features, max_batch, max_delay_ms / 1000)
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixServer(socket_path, _UnixHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), _HTTPHandler)
+        server.daemon_threads = True
+    server.batcher = batcher
+    server.threshold = threshold
+    return server
+
+
+def serve(model_file, **kwargs):
+    """
+    Runs make_server(model_file, **kwargs) until interrupted
+    """
+    server = make_server(model_file, **kwargs)
+    address = server.server_address
+    print('Serving '+model_file+' on '+(address if isinstance(address, str) else
+                                        'http://'+address[0]+':'+str(address[1])))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.stop()
+
+
+class ServiceClient:
+    """
+    Keeps one connection to a running service, over HTTP (url like
+    'http://127.0.0.1:8765') or a Unix socket (socket_path)
+    """
+
+    def __init__(self, url=None, socket_path=None, timeout=30):
+        if socket_path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(socket_path)
+            self.stream = self.sock.makefile('rwb')
+            self.conn = None
+        else:
+            host_port = url.split('://', 1)[-1].rstrip('/')
+            self.conn = http.client.HTTPConnection(host_port, timeout=timeout)
+
+    def _request(self, message):
+        if self.conn is None:
+            self.stream.write(json.dumps(message).encode('utf-8')+b'\n')
+            self.stream.flush()
+            return json.loads(self.stream.readline())
+        if 'command' in message:
+            self.conn.request('GET', '/'+message['command'])
+        else:
+            # bytes body goes out in one packet with the headers
+            self.conn.request('POST', '/predict', json.dumps(message).encode('utf-8'),
+                              {'Content-Type': 'application/json'})
+        return json.loads(self.conn.getresponse().read())
+
+    def predict(self, candidates):
+        """
+        Returns the scores of candidates (dict branch -> list of values)
+        """
+        response = self._request({'candidates': candidates})
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return np.array(response['scores'], dtype=np.float32)
+
+    def stats(self):
+        return self._request({'command': 'stats'})
+
+    def close(self):
+        if self.conn is None:
+            self.stream.close()
+            self.sock.close()
+        else:
+            self.conn.close()
@@ -0,0 +1,116 @@
+import json
+import os
+import pickle
+import time
+
+from cand_class.profiling import profiled
+
+
+class StageCache:
+    """
+    On-disk memoization of stage outputs keyed by content hashes (see
+    manifest.RunManifest.stage_key). Entries are pickles, the least recently
+    used ones are evicted when the cache grows beyond max_bytes
+
+    Parameters
+    ------------------------------------------------
+    cache_dir: str
+        cache directory
+    max_bytes: int
+        size limit of all entries, no limit if None
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._index_file = os.path.join(self.cache_dir, 'index.json')
+        self.index = {}
+        if os.path.isfile(self._index_file):
+            with open(self._index_file, encoding="utf-8") as inp_file:
+                self.index = json.load(inp_file)
+        # drop entries whose file was removed by hand
+        self.index = {key: entry for key, entry in self.index.items() if os.path.isfile(self._path(key))}
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key+'.pkl')
+
+    def _write_index(self):
+        tmp_file = self._index_file+'.tmp'
+        with open(tmp_file, 'w', encoding="utf-8") as out_file:
+            json.dump(self.index, out_file, indent=2)
+        os.replace(tmp_file, self._index_file)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as inp_file:
+            value = pickle.load(inp_file)
+        self.index[key]['last_used'] = time.time()
+        self._write_index()
+        return value
+
+    def put(self, key, value, stage=None):
+        tmp_file = self._path(key)+'.tmp'
+        with open(tmp_file, 'wb') as out_file:
+            pickle.dump(value, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, self._path(key))
+        now = time.time()
+        self.index[key] = {'stage': stage, 'bytes': os.path.getsize(self._path(key)), 'created': now,
+                           'last_used': now}
+        self.evict(keep=key)
+        self._write_index()
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits into max_bytes
+        (the entry keep is never removed). Returns the evicted keys
+        """
+        evicted = []
+        if self.max_bytes is None:
+            return evicted
+        total = sum(entry['bytes'] for entry in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]['last_used']):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            os.remove(self._path(key))
+            del self.index[key]
+            total -= entry['bytes']
+            evicted.append(key)
+        return evicted
+
+    def discard(self, key):
+        if key in self.index:
+            os.remove(self._path(key))
+            del self.index[key]
+            self._write_index()
+
+    def clear(self):
+        for key in list(self.index):
+            os.remove(self._path(key))
+        self.index = {}
+        self._write_index()
+
+    def size(self):
+        return sum(entry['bytes'] for entry in self.index.values())
+
+    @profiled(name='StageCache.memoize')
+    def memoize(self, stage, key, func, *args, **kwargs):
+        """
+        Returns the cached output of stage for key or computes it with
+        func(*args, **kwargs) and stores it
+        """
+        if key in self.index:
+            self.hits += 1
+            print('Stage '+stage+': cached ('+key[:12]+')')
+            return self.get(key)
+        self.misses += 1
+        print('Stage '+stage+': running ('+key[:12]+')')
+        value = func(*args, **kwargs)
+        self.put(key, value, stage)
+        return value
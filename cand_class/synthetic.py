@@ -0,0 +1,176 @@
+import os
+
+import numpy as np
+import pandas as pd
+import uproot
+
+
+LAMBDA_MASS = 1.115683
+# proton + pi- mass, lower edge of the combinatorial background
+MASS_THRESHOLD = 0.938272 + 0.139570
+
+LOG_VARS = ['chi2geo', 'chi2primpos', 'chi2primneg', 'distance', 'ldl']
+NON_LOG_VARS = ['mass', 'pT', 'rapidity', 'cosinepos', 'cosineneg']
+TRAIN_VARS = ['log(chi2geo)', 'log(chi2primpos)', 'log(chi2primneg)', 'log(distance)', 'log(ldl)',
+              'cosinepos', 'cosineneg']
+
+
+def generate_candidates(n, signal, rng, y_cm=1.62, mass_sigma=0.0015):
+    """
+    Generates n synthetic Lambda candidates with CBM-like distributions
+
+    Parameters
+    ------------------------------------------------
+    n: int
+        number of candidates
+    signal: bool
+        signal (Gaussian mass peak, harder pT, displaced vertex) or
+        combinatorial background (mass continuum from the p pi threshold
+        covering the sidebands, softer pT, wider rapidity)
+    rng: numpy.random.Generator
+        random generator
+    y_cm: float
+        centre-of-mass rapidity
+    mass_sigma: float
+        width of the signal mass peak in GeV
+    """
+    if signal:
+        mass = rng.normal(LAMBDA_MASS, mass_sigma, n)
+        pt = rng.gamma(2.0, 0.28, n)
+        rapidity = rng.normal(y_cm, 0.45, n)
+        chi2geo = rng.chisquare(3, n) + 1e-3
+        chi2prim = rng.lognormal(3.5, 1.0, (2, n))
+        distance = rng.exponential(0.05, n) + 1e-4
+        ldl = rng.exponential(25, n) + 1
+        cosine = 1 - rng.exponential(0.002, (2, n))
+    else:
+        mass = MASS_THRESHOLD + rng.gamma(2.0, 0.03, n)
+        pt = rng.gamma(2.0, 0.22, n)
+        rapidity = rng.normal(y_cm, 0.7, n)
+        chi2geo = rng.exponential(8, n) + 1e-3
+        chi2prim = rng.lognormal(2.0, 1.3, (2, n))
+        distance = rng.exponential(0.3, n) + 1e-4
+        ldl = rng.exponential(6, n) + 1
+        cosine = 1 - rng.exponential(0.02, (2, n))
+
+    return pd.DataFrame({
+        'mass': mass.astype(np.float32),
+        'pT': pt.astype(np.float32),
+        'rapidity': rapidity.astype(np.float32),
+        'chi2geo': chi2geo.astype(np.float32),
+        'chi2primpos': chi2prim[0].astype(np.float32),
+        'chi2primneg': chi2prim[1].astype(np.float32),
+        'distance': distance.astype(np.float32),
+        'ldl': ldl.astype(np.float32),
+        'cosinepos': np.clip(cosine[0], -1, 1).astype(np.float32),
+        'cosineneg': np.clip(cosine[1], -1, 1).astype(np.float32),
+        'issignal': np.full(n, int(signal), dtype=np.int32),
+    })
+
+
+def write_candidates(file_name, n, signal, seed, tree_name='t', chunk_size=1000000):
+    """
+    Generates n candidates in chunks and writes them to a ROOT tree (.root)
+    or Parquet file (.parquet) without holding the full sample in memory.
+    Every chunk gets its own seed spawned from seed, so the output is
+    reproducible for a given seed and chunk_size
+    """
+    n_chunks = max(1, -(-n // chunk_size))
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds = seed.spawn(n_chunks)
+
+    if file_name.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        for i, chunk_seed in enumerate(seeds):
+            size = min(chunk_size, n - i*chunk_size)
+            table = pa.Table.from_pandas(generate_candidates(size, signal, np.random.default_rng(chunk_seed)),
+                                         preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(file_name, table.schema)
+            writer.write_table(table)
+        writer.close()
+        return file_name
+
+    with uproot.recreate(file_name) as root_file:
+        for i, chunk_seed in enumerate(seeds):
+            size = min(chunk_size, n - i*chunk_size)
+            df = generate_candidates(size, signal, np.random.default_rng(chunk_seed))
+            branches = {col: df[col].to_numpy() for col in df.columns}
+            if i == 0:
+                # a TTree like the CBM files, assigning a dict writes an RNTuple in recent uproot versions
+                tree = root_file.mktree(tree_name, {col: array.dtype for col, array in branches.items()})
+            tree.extend(branches)
+    return file_name
+
+
+def generate_dataset(output_path, n_signal, n_background, parquet=False, seed=42, tree_name='t',
+                     chunk_size=1000000):
+    """
+    Writes a synthetic signal and background sample plus matching input,
+    log-variables and train-variables toml files, so the full pipeline
+    (config_reader.convertDF, read_log_vars, read_train_vars) runs on it
+
+    Parameters
+    ------------------------------------------------
+    output_path: str
+        output directory
+    n_signal: int
+        number of signal candidates
+    n_background: int
+        number of background candidates
+    parquet: bool
+        write Parquet copies of the samples next to the ROOT files
+    seed: int
+        random seed
+    tree_name: str
+        name of the candidate tree
+
+    Returns
+    -------
+    dict with paths of the written files
+    """
+    os.makedirs(output_path, exist_ok=True)
+    seed_sig, seed_bgr = np.random.SeedSequence(seed).spawn(2)
+    paths = {}
+
+    formats = ['root', 'parquet'] if parquet else ['root']
+    for ext in formats:
+        for sample, n, sample_seed in (('signal', n_signal, seed_sig), ('background', n_background, seed_bgr)):
+            file_name = os.path.join(output_path, sample+'.'+ext)
+            paths[sample+'_'+ext] = write_candidates(file_name, n, sample == 'signal',
+                                                      sample_seed, tree_name, chunk_size)
+
+    # mass window +- 5 sigma around the peak, sidebands up to 1.2 GeV, which
+    # keep about 70% of the generated background
+    input_toml = os.path.join(output_path, 'input.toml')
+    with open(input_toml, 'w', encoding="utf-8") as out_file:
+        out_file.write('[signal]\npath = "'+os.path.join(output_path, 'signal.root')+'"\n'
+                       'tree = "'+tree_name+'"\n\n'
+                       '[background]\npath = "'+os.path.join(output_path, 'background.root')+'"\n'
+                       'tree = "'+tree_name+'"\n\n'
+                       '[peak_range]\nbgr_left_edge = 1.08\nbgr_right_edge = 1.2\n'
+                       'sgn_left_edge = 1.108\nsgn_right_edge = 1.124\n\n'
+                       '[number_of_events]\nnumber_of_signal_events = '+str(n_signal)+'\n'
+                       'number_of_background_events = '+str(int(0.6*n_background))+'\n')
+    paths['input_toml'] = input_toml
+
+    log_toml = os.path.join(output_path, 'log_vars.toml')
+    with open(log_toml, 'w', encoding="utf-8") as out_file:
+        out_file.write('[non_log_scale]\nvariables = '+_toml_list(NON_LOG_VARS)+'\n\n'
+                       '[log_scale]\nvariables = '+_toml_list(LOG_VARS)+'\n')
+    paths['log_vars_toml'] = log_toml
+
+    train_toml = os.path.join(output_path, 'train_vars.toml')
+    with open(train_toml, 'w', encoding="utf-8") as out_file:
+        out_file.write('train_vars = '+_toml_list(TRAIN_VARS)+'\n')
+    paths['train_vars_toml'] = train_toml
+
+    return paths
+
+
+def _toml_list(values):
+    return '['+', '.join('"'+value+'"' for value in values)+']'
@@ -0,0 +1,254 @@
+import ctypes
+import ctypes.util
+import json
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+
+import numpy as np
+
+
+@lru_cache(maxsize=None)
+def _libm():
+    name = ctypes.util.find_library('m') or ctypes.util.find_library('c')
+    try:
+        libm = ctypes.CDLL(name)
+        libm.logf.argtypes, libm.logf.restype = [ctypes.c_float], ctypes.c_float
+    except (OSError, AttributeError, TypeError):
+        return None
+    return libm
+
+
+def _logf(x):
+    # XGBoost turns the base score into a margin with logf of the C library,
+    # the float32 log of NumPy differs from it in the last bit for some values
+    libm = _libm()
+    if libm is None:
+        return np.float32(np.log(np.float64(x)))
+    return np.float32(libm.logf(float(x)))
+
+
+@dataclass
+class FlatForest:
+    """
+    All trees of a binary XGBoost gbtree model flattened into contiguous node
+    arrays. Leaves point to themselves and split on feature 0, so a fixed
+    number of max_depth traversal steps brings every (candidate, tree) pair
+    to its leaf. Only needs NumPy: no compiler, no native library
+
+    Attributes
+    ----------
+    feature : np.ndarray
+        int32 split feature per node
+    threshold : np.ndarray
+        float32 split condition per node, go left if x < threshold
+    left : np.ndarray
+        int32 index of the left child (the node itself for leaves)
+    right : np.ndarray
+        int32 index of the right child (the node itself for leaves)
+    default_left : np.ndarray
+        bool, direction of missing values
+    value : np.ndarray
+        float32 leaf value (0 for split nodes)
+    roots : np.ndarray
+        int32 index of the root node of every tree
+    base_margin : float
+        margin of the model before the first tree
+    max_depth : int
+        depth of the deepest tree
+    objective : str
+        XGBoost objective
+    feature_names : list
+        model features in training order
+    children : np.ndarray
+        interleaved right and left child of every node, built from left and
+        right if not given
+    """
+
+    feature: np.ndarray
+    threshold: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    default_left: np.ndarray
+    value: np.ndarray
+    roots: np.ndarray
+    base_margin: float
+    max_depth: int
+    objective: str = 'binary:logistic'
+    feature_names: list = None
+    children: np.ndarray = None
+
+    array_names = ('feature', 'threshold', 'left', 'right', 'default_left', 'value', 'roots')
+
+    def __post_init__(self):
+        # right and left child of node i at 2*i and 2*i + 1, so one gather
+        # indexed by 2*pos + go_left replaces two gathers and a select
+        if self.children is None:
+            self.children = np.stack([self.right, self.left], axis=1).ravel()
+
+    @classmethod
+    def from_json(cls, model):
+        """
+        Builds the forest from a parsed XGBoost JSON model (Booster.save_model('*.json'))
+        """
+        learner = model['learner']
+        booster = learner['gradient_booster']
+        if booster['name'] != 'gbtree':
+            raise ValueError('Only gbtree models are supported, got '+booster['name'])
+        if int(learner['learner_model_param'].get('num_class', 0)) > 1:
+            raise ValueError('Only binary classification and regression models are supported')
+
+        trees = booster['model']['trees']
+        sizes = [len(tree['left_children']) for tree in trees]
+        offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int32)
+
+        feature, threshold, left, right, default_left, value = [], [], [], [], [], []
+        max_depth = 0
+        for tree, offset in zip(trees, offsets):
+            if any(tree.get('split_type', [])):
+                raise ValueError('Categorical splits are not supported')
+
+            tree_left = np.asarray(tree['left_children'], dtype=np.int32)
+            tree_right = np.asarray(tree['right_children'], dtype=np.int32)
+            conditions = np.asarray(tree['split_conditions'], dtype=np.float32)
+            is_leaf = tree_left == -1
+            own = np.arange(len(tree_left), dtype=np.int32) + offset
+
+            feature.append(np.where(is_leaf, 0, tree['split_indices']).astype(np.int32))
+            threshold.append(np.where(is_leaf, np.float32(0), conditions))
+            left.append(np.where(is_leaf, own, tree_left + offset).astype(np.int32))
+            right.append(np.where(is_leaf, own, tree_right + offset).astype(np.int32))
+            default_left.append(np.asarray(tree['default_left'], dtype=bool))
+            value.append(np.where(is_leaf, conditions, np.float32(0)))
+            max_depth = max(max_depth, _tree_depth(tree_left, tree_right))
+
+        objective = learner['objective']['name']
+        base_score = np.float32(float(learner['learner_model_param']['base_score']))
+        if objective.startswith('binary:logistic') or objective == 'reg:logistic':
+            base_margin = -_logf(np.float32(1) / base_score - np.float32(1))
+        else:
+            base_margin = base_score
+
+        return cls(np.concatenate(feature), np.concatenate(threshold), np.concatenate(left),
+                   np.concatenate(right), np.concatenate(default_left), np.concatenate(value),
+                   offsets, float(base_margin), max_depth, objective, learner.get('feature_names') or None)
+
+    @classmethod
+    def from_booster(cls, booster):
+        """
+        Builds the forest from an xgboost Booster (for example XGBmodel.get_mode_booster().get_booster())
+        """
+        return cls.from_json(json.loads(bytes(booster.save_raw(raw_format='json'))))
+
+    @classmethod
+    def from_json_file(cls, file_name):
+        with open(file_name, encoding="utf-8") as inp_file:
+            return cls.from_json(json.load(inp_file))
+
+    @property
+    def n_trees(self):
+        return len(self.roots)
+
+    def leaf_indices(self, x):
+        """
+        Returns the (n_candidates, n_trees) indices of the reached leaves,
+        traversing all trees level by level at once
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        n_rows, n_features = x.shape
+        flat_x = x.ravel()
+        row_offsets = (np.arange(n_rows, dtype=np.int64) * n_features)[:, None]
+
+        pos = np.broadcast_to(self.roots, (n_rows, self.n_trees)).copy()
+        for _ in range(self.max_depth):
+            fvalue = np.take(flat_x, row_offsets + np.take(self.feature, pos))
+            go_left = fvalue < np.take(self.threshold, pos)
+            missing = np.isnan(fvalue)
+            if missing.any():
+                go_left |= missing & np.take(self.default_left, pos)
+            pos = np.take(self.children, 2*pos + go_left)
+        return pos
+
+    def margin(self, x, chunk_size=None):
+        """
+        Raw margins in float32. Leaf values are added tree by tree to the base
+        margin like in the XGBoost CPU predictor, so the result matches
+        Booster.predict(output_margin=True) bit by bit
+
+        Parameters
+        ------------------------------------------------
+        x: np.ndarray
+            (n_candidates, n_features) matrix in training feature order
+        chunk_size: int
+            candidates traversed at once, by default about 128k (candidate, tree)
+            pairs so that the per-level temporaries stay in cache
+        """
+        n_rows = len(x)
+        chunk_size = chunk_size or max(1, 2**17 // max(1, self.n_trees))
+        out = np.empty(n_rows, dtype=np.float32)
+
+        for start in range(0, n_rows, chunk_size):
+            leaves = self.value[self.leaf_indices(x[start:start + chunk_size])]
+            margin = np.full(len(leaves), self.base_margin, dtype=np.float32)
+            for tree in range(self.n_trees):
+                margin += leaves[:, tree]
+            out[start:start + chunk_size] = margin
+        return out
+
+    def predict(self, x, output_margin=False, chunk_size=None):
+        """
+        Signal probabilities (or margins with output_margin=True)
+        """
+        margin = self.margin(x, chunk_size)
+        if output_margin or 'logistic' not in self.objective:
+            return margin
+        return np.float32(1) / (np.float32(1) + np.exp(-margin))
+
+    def save(self, file_name):
+        """
+        Saves the flattened arrays to an .npz file
+        """
+        meta = {'base_margin': self.base_margin, 'max_depth': self.max_depth, 'objective': self.objective,
+                'feature_names': self.feature_names}
+        np.savez(file_name, meta=json.dumps(meta), **{name: getattr(self, name) for name in self.array_names})
+
+    @classmethod
+    def load(cls, file_name):
+        with np.load(file_name) as data:
+            meta = json.loads(str(data['meta']))
+            return cls(*[data[name] for name in cls.array_names], **meta)
+
+    def save_arrays(self, directory):
+        """
+        Saves every array (including children) as a separate .npy file and the
+        scalars to forest.json, so load_arrays can memory-map them
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in self.array_names + ('children',):
+            np.save(os.path.join(directory, name+'.npy'), np.ascontiguousarray(getattr(self, name)))
+        meta = {'base_margin': self.base_margin, 'max_depth': self.max_depth, 'objective': self.objective,
+                'feature_names': self.feature_names}
+        with open(os.path.join(directory, 'forest.json'), 'w', encoding="utf-8") as out_file:
+            json.dump(meta, out_file, indent=2)
+
+    @classmethod
+    def load_arrays(cls, directory, mmap_mode='r'):
+        """
+        Loads a forest written by save_arrays. With mmap_mode='r' the arrays are
+        read-only memory maps: all processes on a node share the page cache copy
+        """
+        with open(os.path.join(directory, 'forest.json'), encoding="utf-8") as inp_file:
+            meta = json.load(inp_file)
+        arrays = {name: np.load(os.path.join(directory, name+'.npy'), mmap_mode=mmap_mode)
+                  for name in cls.array_names + ('children',)}
+        return cls(**arrays, **meta)
+
+
+def _tree_depth(left, right):
+    depth = np.zeros(len(left), dtype=np.int32)
+    # XGBoost stores children after their parents
+    for node in range(len(left)):
+        if left[node] != -1:
+            depth[left[node]] = depth[node] + 1
+            depth[right[node]] = depth[node] + 1
+    return int(depth.max())
@@ -7,5 +7,18 @@ setup(
     author="olha lavoryk",
     license="MIT",
     url="https://github.com/conformist89/CandidatesClassifier.git",
-    packages=find_packages()
+    packages=find_packages(),
+    # core: loading, transforms, scoring and metrics
+    install_requires=["numpy", "pandas", "uproot", "tomli", "xgboost"],
+    # PyROOT (hists_root) is not on PyPI and comes with a ROOT installation
+    extras_require={
+        "plot": ["matplotlib", "scipy", "hipe4ml"],
+        "train": ["scikit-learn", "hipe4ml", "bayesian-optimization", "threadpoolctl"],
+        "treelite": ["treelite", "treelite_runtime"],
+        "all": ["matplotlib", "scipy", "hipe4ml", "scikit-learn", "bayesian-optimization", "threadpoolctl",
+                "treelite", "treelite_runtime"],
+    },
+    entry_points={
+        "console_scripts": ["cand_class=cand_class.__main__:main"],
+    },
 )